@@ -0,0 +1,189 @@
+"""Apptainer/Singularity instances, shared by the rules executed in the same environment.
+
+When ``instance`` is enabled in the configuration of an APPTAINER environment, the image is
+resolved when the workflow is loaded, and a named container instance is started when the workflow
+starts, and stopped when it finishes. The commands executed without Slurm run in the instance with
+``exec instance://<name>``, so they don't pay again the loading of the modules, the startup of the
+container and the mounting of the image.
+
+The executable is resolved only by the process starting the instances, since the workflow may be
+loaded by several processes, and it's exported in an env variable read by the commands.
+
+The instances are local to the node running Snakemake, so the commands executed in a Slurm
+allocation run the resolved image with the resolved executable, without loading the modules.
+"""
+
+import functools
+import logging
+import os
+import re
+import shlex
+import shutil
+import subprocess
+from dataclasses import dataclass
+from pathlib import Path
+
+from circuit_build.constants import (
+    APPTAINER_EXECUTABLE,
+    APPTAINER_IMAGEPATH,
+    APPTAINER_MODULEPATH,
+    APPTAINER_MODULES,
+    APPTAINER_OPTIONS,
+    ENV_TYPE_APPTAINER,
+)
+
+L = logging.getLogger(__name__)
+
+INSTANCE_PREFIX = "circuit-build"
+# options of ``instance start`` applied also to the processes started by ``exec instance://``
+EXEC_FLAGS = {
+    "--cleanenv": "--cleanenv",
+    "-e": "--cleanenv",
+    "--containall": "--cleanenv",
+    "-C": "--cleanenv",
+    "--no-eval": "--no-eval",
+}
+EXEC_OPTIONS = {"--env", "--env-file"}  # followed by a value
+
+
+@functools.lru_cache(maxsize=None)
+def resolve_executable(executable, modulepath, modules):
+    """Return the absolute path to the executable, loading the modules only if needed.
+
+    Args:
+        executable (str): name or path of the Apptainer/Singularity executable.
+        modulepath (str): path used to find the modules.
+        modules (tuple): modules providing the executable.
+    """
+    if Path(executable).is_absolute():
+        return executable
+    cmd = " && ".join(
+        [
+            ". /etc/profile.d/modules.sh",
+            "module purge",
+            f"module use {modulepath}",
+            f"module load {' '.join(modules)}",
+            f"command -v {executable}",
+        ]
+    )
+    result = subprocess.run(["bash", "-c", cmd], capture_output=True, text=True, check=False)
+    lines = result.stdout.splitlines()
+    if result.returncode != 0 or not lines:
+        # fall back to the executable in PATH, if the modules aren't available
+        if path := shutil.which(executable):
+            return path
+        raise RuntimeError(f"Unable to find the executable {executable}: {result.stderr.strip()}")
+    return lines[-1].strip()
+
+
+@dataclass(frozen=True)
+class ApptainerInstance:
+    """Named container instance of an environment."""
+
+    name: str
+    executable: str
+    image: Path
+    options: str
+    modulepath: str = APPTAINER_MODULEPATH
+    modules: tuple = tuple(APPTAINER_MODULES)
+
+    @classmethod
+    def from_config(cls, env_name, env_config, build_id):
+        """Return a new object, after resolving and verifying the image.
+
+        Args:
+            env_name (str): name of the environment.
+            env_config (dict): configuration of the environment.
+            build_id (str): identifier of the build, used to name the instance.
+        """
+        image = Path(APPTAINER_IMAGEPATH, env_config["image"]).resolve()
+        if not image.is_file():
+            raise ValueError(f"The image of the environment {env_name} doesn't exist: {image}")
+        name = re.sub(r"[^\w.-]", "_", f"{INSTANCE_PREFIX}-{env_name}-{build_id}")
+        return cls(
+            name=name,
+            executable=env_config.get("executable", APPTAINER_EXECUTABLE),
+            image=image,
+            options=env_config.get("options", APPTAINER_OPTIONS),
+            modulepath=env_config.get("modulepath", APPTAINER_MODULEPATH),
+            modules=tuple(env_config.get("modules", APPTAINER_MODULES)),
+        )
+
+    @property
+    def executable_var(self):
+        """Return the name of the env variable with the resolved executable."""
+        return re.sub(r"\W", "_", f"{self.name}_executable").upper()
+
+    @property
+    def exec_options(self):
+        """Return the options of the instance to be passed also to ``exec``."""
+        tokens = shlex.split(self.options)
+        result = []
+        for token, next_token in zip(tokens, tokens[1:] + [""]):
+            name, sep, _ = token.partition("=")
+            if token in EXEC_FLAGS:
+                option = EXEC_FLAGS[token]
+            elif name in EXEC_OPTIONS:
+                option = shlex.quote(token) if sep else f"{token} {shlex.quote(next_token)}"
+            else:
+                continue
+            if option not in result:
+                result.append(option)
+        return " ".join(result)
+
+    def resolve_executable(self):
+        """Return the absolute path to the executable."""
+        return resolve_executable(self.executable, self.modulepath, self.modules)
+
+    def start_cmd(self, executable):
+        """Return the command string starting the instance with the given executable."""
+        return (
+            f"{executable} --version && "
+            f"{executable} instance start {self.options} {self.image} {self.name}"
+        )
+
+    def start(self):
+        """Resolve the executable and export it in ``executable_var``, and start the instance."""
+        L.info("Starting the container instance %s of %s", self.name, self.image)
+        executable = self.resolve_executable()
+        # inherited by the commands executed by Snakemake in this process
+        os.environ[self.executable_var] = executable
+        result = subprocess.run(["bash", "-c", self.start_cmd(executable)], check=False)
+        if result.returncode != 0:
+            raise RuntimeError(f"Unable to start the container instance {self.name}")
+
+    def stop(self):
+        """Stop the instance if it has been started, ignoring any failure."""
+        executable = os.environ.get(self.executable_var)
+        if not executable:
+            return
+        L.info("Stopping the container instance %s", self.name)
+        cmd = [executable, "instance", "stop", self.name]
+        subprocess.run(cmd, check=False, stdout=subprocess.DEVNULL)
+
+
+def apptainer_instances(env_config, build_id):
+    """Return a dict with the ApptainerInstance of each environment configured to use it."""
+    return {
+        env_name: ApptainerInstance.from_config(env_name, conf, build_id)
+        for env_name, conf in env_config.items()
+        if conf["env_type"] == ENV_TYPE_APPTAINER and conf.get("instance")
+    }
+
+
+def start_instances(instances):
+    """Start the given instances, stopping the started ones if any of them fails."""
+    started = []
+    try:
+        for instance in instances:
+            instance.start()
+            started.append(instance)
+    except RuntimeError:
+        stop_instances(started)
+        raise
+
+
+def stop_instances(instances):
+    """Stop the given instances."""
+    for instance in instances:
+        instance.stop()
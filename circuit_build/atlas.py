@@ -0,0 +1,149 @@
+"""Minimal access to the atlas datasets, without depending on voxcell.
+
+Only the features needed by circuit-build are supported: NRRD files with raw or gzip encoding,
+the region hierarchy, and the lookup of the voxels containing given positions.
+"""
+
+import gzip
+import math
+import re
+from pathlib import Path
+
+import numpy as np
+
+NRRD_TYPES = {
+    "int8": "i1",
+    "uint8": "u1",
+    "int16": "i2",
+    "uint16": "u2",
+    "int32": "i4",
+    "uint32": "u4",
+    "int64": "i8",
+    "uint64": "u8",
+    "float": "f4",
+    "double": "f8",
+}
+NRRD_TYPE_ALIASES = {
+    "signed char": "int8",
+    "unsigned char": "uint8",
+    "uchar": "uint8",
+    "short": "int16",
+    "unsigned short": "uint16",
+    "ushort": "uint16",
+    "int": "int32",
+    "unsigned int": "uint32",
+    "uint": "uint32",
+    "long long": "int64",
+    "unsigned long long": "uint64",
+}
+
+
+def read_nrrd(path):
+    """Return the header and the flattened data of a NRRD file with raw or gzip encoding.
+
+    Only the features needed to count the voxels and the cells are supported, so the data
+    is returned as a 1D array, in the same order for all the volumes of the same atlas.
+    """
+    with open(path, "rb") as fd:
+        magic = fd.readline()
+        if not magic.startswith(b"NRRD"):
+            raise ValueError(f"Invalid NRRD file: {path}")
+        header = {}
+        for line in fd:
+            line = line.decode("ascii").strip()
+            if not line:
+                break
+            if line.startswith("#") or ":" not in line:
+                continue
+            key, value = line.split(":", 1)
+            header[key.strip()] = value.lstrip("=").strip()
+        raw = fd.read()
+    if "data file" in header:
+        raise ValueError(f"Detached NRRD data files are not supported: {path}")
+    encoding = header.get("encoding", "raw")
+    if encoding in ("gzip", "gz"):
+        raw = gzip.decompress(raw)
+    elif encoding != "raw":
+        raise ValueError(f"Unsupported NRRD encoding {encoding!r}: {path}")
+    nrrd_type = NRRD_TYPE_ALIASES.get(header["type"], header["type"])
+    endian = "<" if header.get("endian", "little") == "little" else ">"
+    dtype = np.dtype(endian + NRRD_TYPES[nrrd_type])
+    size = math.prod(int(s) for s in header["sizes"].split())
+    # any data preceding the last ``size`` elements is skipped, as done by the NRRD readers
+    data = np.frombuffer(raw, dtype=dtype, offset=len(raw) - size * dtype.itemsize)
+    return header, data
+
+
+def voxel_volume(header):
+    """Return the volume of a voxel in mm³, from the space directions in µm of the NRRD header."""
+    vectors = re.findall(r"\(([^)]*)\)", header["space directions"])
+    matrix = np.array([[float(v) for v in vector.split(",")] for vector in vectors])
+    return abs(float(np.linalg.det(matrix))) * 1e-9
+
+
+class RegionMap:
+    """Map the region names used in the bioname files to the ids of the atlas hierarchy."""
+
+    def __init__(self, hierarchy):
+        """Initialize the object from the content of ``hierarchy.json``."""
+        self.acronyms = {}
+        self.children = {}
+        stack = [hierarchy]
+        while stack:
+            node = stack.pop()
+            self.acronyms[node["id"]] = node["acronym"]
+            self.children[node["id"]] = [child["id"] for child in node.get("children", [])]
+            stack.extend(node.get("children", []))
+
+    def find(self, region):
+        """Return the ids matching the region, including the descendants.
+
+        The region can be an acronym, or a regular expression if it starts with ``@``.
+        """
+        if region.startswith("@"):
+            pattern = re.compile(region[1:])
+            ids = [id_ for id_, acronym in self.acronyms.items() if pattern.search(acronym)]
+        else:
+            ids = [id_ for id_, acronym in self.acronyms.items() if acronym == region]
+        result = set()
+        while ids:
+            id_ = ids.pop()
+            result.add(id_)
+            ids.extend(self.children[id_])
+        return result
+
+
+def atlas_file(atlas_dir, name):
+    """Return the path to a dataset in the atlas, as referenced in MANIFEST or cell_composition."""
+    name = name.strip("{}")
+    if not name.endswith(".nrrd"):
+        name = f"{name}.nrrd"
+    return Path(atlas_dir, name)
+
+
+def read_volume(path):
+    """Return the header and the data of a NRRD file, as an array indexed by voxel (i, j, k)."""
+    header, data = read_nrrd(path)
+    sizes = [int(s) for s in header["sizes"].split()]
+    # the first axis varies fastest in the NRRD files
+    return header, data.reshape(sizes, order="F")
+
+
+def voxel_indices(header, positions):
+    """Return the indices of the voxels containing the positions, and the mask of valid indices.
+
+    Only the volumes with the axes aligned to the space directions are supported.
+
+    Args:
+        header (dict): NRRD header.
+        positions (np.ndarray): array of shape (N, 3) with the positions in µm.
+    """
+    vectors = re.findall(r"\(([^)]*)\)", header["space directions"])
+    matrix = np.array([[float(v) for v in vector.split(",")] for vector in vectors])
+    if np.count_nonzero(matrix - np.diag(np.diagonal(matrix))):
+        raise ValueError("Only the volumes aligned to the axes are supported")
+    origin = [float(v) for v in header["space origin"].strip("()").split(",")]
+    sizes = np.array([int(s) for s in header["sizes"].split()])
+    indices = np.floor((positions - origin) / np.diagonal(matrix)).astype(np.int64)
+    valid = np.all((indices >= 0) & (indices < sizes), axis=1)
+    return indices, valid
@@ -12,7 +12,15 @@ from pathlib import Path
 
 import click
 
-from circuit_build.utils import clean_slurm_env
+from circuit_build import estimate as estimate_module
+from circuit_build.metrics import (
+    METRICS_FILE,
+    combine_job_events,
+    format_table,
+    load_events,
+    summarize_jobs,
+)
+from circuit_build.utils import clean_slurm_env, dump_yaml, load_yaml
 
 L = logging.getLogger()
 
@@ -221,3 +229,167 @@ def run(
     #   2: summary process failed
     #   4: report process failed
     sys.exit(exit_code)
+
+
+@cli.command()
+@click.option(
+    "-d",
+    "--directory",
+    type=click.Path(exists=True, file_okay=False),
+    help="Working directory of the circuit, used to find `logs/metrics.jsonl`.",
+    default=".",
+    show_default=True,
+)
+@click.option(
+    "--metrics-file",
+    "metrics_files",
+    multiple=True,
+    type=click.Path(exists=True, dir_okay=False),
+    help="Path to a metrics file, overriding the default. Multiple files are allowed.",
+)
+@click.option("--rule", "rules", multiple=True, help="Show only the given rule(s).")
+@click.option("--by-build", is_flag=True, help="Show one row for each build and rule.")
+@click.option("--json", "as_json", is_flag=True, help="Show the metrics of the jobs in JSON.")
+def stats(directory, metrics_files, rules, by_build, as_json):
+    """Show the metrics of the jobs recorded across builds."""
+    metrics_files = metrics_files or [Path(directory, "logs", METRICS_FILE)]
+    missing = [str(path) for path in metrics_files if not Path(path).is_file()]
+    if missing:
+        raise click.ClickException(f"Metrics file not found: {', '.join(missing)}")
+    jobs = combine_job_events(load_events(metrics_files))
+    if rules:
+        jobs = [job for job in jobs if job["rule"] in rules]
+    if as_json:
+        click.echo(json.dumps(jobs, indent=2))
+    else:
+        click.echo(format_table(summarize_jobs(jobs, by_build=by_build)))
+
+
+@cli.command()
+@click.option(
+    "-u",
+    "--cluster-config",
+    required=True,
+    type=click.Path(exists=True, dir_okay=False),
+    help="Path to cluster config, used as a base for the suggested cluster config.",
+)
+@click.option(
+    "--bioname",
+    required=True,
+    type=click.Path(exists=True, file_okay=False),
+    help="Path to `bioname` folder of a circuit.",
+)
+@click.option(
+    "--target",
+    type=click.Choice(["functional", "structural"]),
+    default="functional",
+    show_default=True,
+    help="Target to be built.",
+)
+@click.option(
+    "--cells",
+    type=click.IntRange(min=1),
+    help="Number of cells, overriding the number computed from the atlas.",
+)
+@click.option(
+    "--models",
+    type=click.Path(exists=True, dir_okay=False),
+    help="Path to a YAML file with the scaling models overriding the default models.",
+)
+@click.option(
+    "--cores-per-node",
+    type=click.IntRange(min=1),
+    default=estimate_module.CORES_PER_NODE,
+    show_default=True,
+    help="Number of cores of each node.",
+)
+@click.option(
+    "--safety-factor",
+    type=click.FloatRange(min=1),
+    default=estimate_module.SAFETY_FACTOR,
+    show_default=True,
+    help="Factor applied to the estimated runtime and memory in the suggested cluster config.",
+)
+@click.option(
+    "--slurm-partition",
+    default="prod",
+    show_default=True,
+    help="Slurm partition used in the suggested cluster config.",
+)
+@click.option(
+    "-o",
+    "--output",
+    type=click.Path(dir_okay=False),
+    help="Path to the suggested cluster config to be written.",
+)
+@click.option(
+    "--calibrate",
+    "calibration_dirs",
+    multiple=True,
+    type=click.Path(exists=True, file_okay=False),
+    help=(
+        "Directory of a circuit already built, whose metrics and number of cells are used "
+        "to calibrate the runtime and the output size of the models. Multiple dirs are allowed."
+    ),
+)
+@click.option(
+    "--calibrated-models",
+    type=click.Path(dir_okay=False),
+    help="Path to the calibrated models to be written, that can be passed later with --models.",
+)
+def estimate(
+    *,
+    cluster_config: str,
+    bioname: str,
+    target: str,
+    cells: int,
+    models: str,
+    cores_per_node: int,
+    safety_factor: float,
+    slurm_partition: str,
+    output: str,
+    calibration_dirs: tuple[str, ...],
+    calibrated_models: str,
+):
+    """Estimate the resources needed to build a circuit, without executing the workflow."""
+    # pylint: disable=too-many-arguments,too-many-locals,import-outside-toplevel
+    from circuit_build.context import Context
+
+    if calibrated_models and not calibration_dirs:
+        raise click.UsageError("--calibrated-models requires --calibrate")
+    ctx = Context(config={"bioname": bioname, "cluster_config": cluster_config})
+    if cells is None:
+        if not Path(ctx.ATLAS).is_dir():
+            raise click.ClickException(
+                f"The atlas {ctx.ATLAS} is not a local directory, use --cells to continue"
+            )
+        cells = estimate_module.count_cells(
+            atlas_dir=ctx.ATLAS,
+            composition=load_yaml(ctx.paths.bioname_path("cell_composition.yaml")),
+            region=ctx.conf.get(["common", "region"]),
+            mask=ctx.conf.get(["common", "mask"]),
+            density_factor=ctx.conf.get(["place_cells", "density_factor"], default=1.0),
+        )
+    scaling_models = estimate_module.load_scaling_models(models)
+    if calibration_dirs:
+        samples = [estimate_module.calibration_samples(path) for path in calibration_dirs]
+        scaling_models = estimate_module.calibrate_models(scaling_models, samples)
+        click.echo(f"Scaling models calibrated with {len(samples)} circuit(s)")
+        if calibrated_models:
+            dump_yaml(calibrated_models, {"version": 1, "models": scaling_models})
+            click.echo(f"Calibrated models written to {calibrated_models}")
+    rows = estimate_module.estimate(
+        ctx, cells, scaling_models, target=target, cores_per_node=cores_per_node
+    )
+    click.echo(f"Estimated number of cells: {cells}")
+    click.echo(format_table(estimate_module.format_rows(rows)))
+    if output:
+        suggested = estimate_module.suggest_cluster_config(
+            rows,
+            scaling_models,
+            cluster_config=ctx.cluster_config,
+            partition=slurm_partition,
+            safety_factor=safety_factor,
+        )
+        dump_yaml(output, suggested)
+        click.echo(f"Suggested cluster config written to {output}")
@@ -1,5 +1,8 @@
 """Utilities to build the commands to execute the Snakemake rules."""
 
+import functools
+import re
+from dataclasses import dataclass
 from pathlib import Path
 
 from circuit_build.constants import (
@@ -8,13 +11,19 @@ from circuit_build.constants import (
     APPTAINER_MODULEPATH,
     APPTAINER_MODULES,
     APPTAINER_OPTIONS,
+    DASK_LOCAL_SCRATCH_CONSTRAINTS,
+    DASK_SPILL_MIN_MEMORY_GB,
+    DASK_WORKER_RESERVED_MEMORY_GB,
     ENV_CONFIG,
     ENV_TYPE_APPTAINER,
     ENV_TYPE_MODULE,
     ENV_TYPE_VENV,
+    ENV_VARS_DASK_DEFAULT,
     SPACK_MODULEPATH,
+    WORKFLOW_ENV,
 )
-from circuit_build.utils import redirect_to_file
+from circuit_build.metrics import build_metrics_cmd, build_started_marker_cmd
+from circuit_build.utils import parse_salloc, redirect_to_file
 
 
 def _escape_single_quotes(value):
@@ -75,12 +84,70 @@ def _with_slurm(cmd, cluster_config):
     return cmd
 
 
-def _with_env_vars(cmd, env_config, cluster_config):
-    """Wrap the command with exporting the environment variables if needed."""
+def _has_local_scratch(salloc):
+    """Return True if the allocation is constrained to nodes with local scratch."""
+    match = re.search(r"(?:-C|--constraint)[= ]?(\S+)", salloc)
+    features = re.split(r"[&|,\[\]*]", match.group(1)) if match else []
+    return any(feature in DASK_LOCAL_SCRATCH_CONSTRAINTS for feature in features)
+
+
+def dask_worker_resources(salloc):
+    """Return the number of threads and the memory in GB of each task of the allocation.
+
+    The memory is None if it cannot be derived from the salloc parameters.
+    """
+    resources = parse_salloc(salloc)
+    return resources["cpus_per_task"], resources["memory_per_task"]
+
+
+def dask_env_vars(salloc):
+    """Return the Dask environment variables tuned for the tasks of the allocation.
+
+    The threads of the numerical libraries are limited to the cpus of each task, and the memory
+    thresholds leave to the worker process at least ``DASK_WORKER_RESERVED_MEMORY_GB``.
+    The workers spill to disk only if the nodes have local scratch and enough memory,
+    because spilling small workers or spilling to the shared filesystem is slower than pausing.
+    """
+    threads, memory = dask_worker_resources(salloc)
     env_vars = {
-        **env_config.get("env_vars", {}),
-        **cluster_config.get("env_vars", {}),
+        name: str(threads)
+        for name in [
+            "MKL_NUM_THREADS",
+            "NUMEXPR_NUM_THREADS",
+            "OMP_NUM_THREADS",
+            "OPENBLAS_NUM_THREADS",
+        ]
     }
+    if memory is None:
+        return env_vars
+    terminate = max(0.5, min(0.95, 1 - DASK_WORKER_RESERVED_MEMORY_GB / memory))
+    pause = terminate - 0.15
+    spill = _has_local_scratch(salloc) and memory >= DASK_SPILL_MIN_MEMORY_GB
+    env_vars.update(
+        {
+            "DASK_DISTRIBUTED__WORKER__MEMORY__TARGET": f"{pause - 0.2:.2f}" if spill else "False",
+            "DASK_DISTRIBUTED__WORKER__MEMORY__SPILL": f"{pause - 0.1:.2f}" if spill else "False",
+            "DASK_DISTRIBUTED__WORKER__MEMORY__PAUSE": f"{pause:.2f}",
+            "DASK_DISTRIBUTED__WORKER__MEMORY__TERMINATE": f"{terminate:.2f}",
+        }
+    )
+    return env_vars
+
+
+def _with_env_vars(cmd, env_config, cluster_config):
+    """Wrap the command with exporting the environment variables if needed.
+
+    If the environment uses Dask and the command is executed in a Slurm allocation,
+    the default Dask variables are replaced by the values tuned for the allocation.
+    The variables customized in the environment or in the cluster configuration are kept.
+    """
+    env_vars = dict(env_config.get("env_vars", {}))
+    if "salloc" in cluster_config and any(k.startswith("DASK_") for k in env_vars):
+        for key, value in dask_env_vars(cluster_config["salloc"]).items():
+            default = ENV_VARS_DASK_DEFAULT.get(key)
+            if env_vars.get(key, default) == default:
+                env_vars[key] = value
+    env_vars.update(cluster_config.get("env_vars", {}))
     if env_vars:
         variables = " ".join(f"{k}={v}" for k, v in env_vars.items())
         cmd = f"export {variables} && {cmd}"
@@ -106,6 +173,27 @@ def build_module_cmd(cmd, env_config, cluster_config):
     )
 
 
+def build_apptainer_instance_cmd(cmd, env_config, cluster_config, instance):
+    """Wrap the command with the running apptainer/singularity instance.
+
+    The image and the executable are already resolved, so the modules aren't loaded.
+    The executable is read from the env variable exported by the process starting the instances.
+    The instance is local to the node running the workflow, so the commands executed
+    in a Slurm allocation run the resolved image instead.
+    """
+    executable = f'"${instance.executable_var}"'
+    if cluster_config:
+        # the current working directory is used also inside the container
+        container = f"{executable} exec {instance.options} {instance.image}"
+        cmd = f'{container} bash <<EOF\ncd "$(pwd)" && {cmd}\nEOF\n'
+    else:
+        cmd = _escape_single_quotes(cmd)
+        options = " ".join(filter(None, [instance.exec_options, '--pwd "$(pwd)"']))
+        cmd = f"{executable} exec {options} instance://{instance.name} bash -c '{cmd}'"
+    cmd = _with_env_vars(cmd, env_config, cluster_config)
+    return _with_slurm(cmd, cluster_config)
+
+
 def build_apptainer_cmd(cmd, env_config, cluster_config):
     """Wrap the command with apptainer/singularity."""
     modulepath = env_config.get("modulepath", APPTAINER_MODULEPATH)
@@ -153,32 +241,136 @@ def build_venv_cmd(cmd, env_config, cluster_config):
     return cmd
 
 
-def build_command(cmd, env_config, env_name, cluster_config, slurm_env=None):
-    """Wrap and return the command string to be executed.
+def build_workflow_env_cmd(cmd, env_config, cluster_config):
+    """Wrap the command with slurm only, keeping the environment executing the workflow.
+
+    It's used to execute the helpers of circuit-build in the allocation of the rule, with the same
+    Python interpreter and packages, so no module is loaded and no container is started.
+    """
+    cmd = _with_env_vars(cmd, env_config, cluster_config)
+    return _with_slurm(cmd, cluster_config)
+
+
+_ENV_TYPE_FUNCS = {
+    ENV_TYPE_MODULE: build_module_cmd,
+    ENV_TYPE_APPTAINER: build_apptainer_cmd,
+    ENV_TYPE_VENV: build_venv_cmd,
+}
+
+
+def build_env_cmd(cmd, env_config, env_name):
+    """Return the command string executed in the given environment, without slurm and redirection.
+
+    It's used to execute a tool in a subshell of a command already executed in an allocation,
+    so that the environment of the tool doesn't affect the other commands.
 
     Args:
         cmd (list): command to be executed as a list of strings.
         env_config (dict): environment configuration.
         env_name (str): key in env_config.
+    """
+    selected_env_config = env_config[env_name]
+    func = _ENV_TYPE_FUNCS[selected_env_config["env_type"]]
+    cmd = func(cmd=" ".join(map(str, cmd)), env_config=selected_env_config, cluster_config={})
+    return f"( {cmd} )"
+
+
+COMMAND_PLACEHOLDER = "__CIRCUIT_BUILD_COMMAND__"  # replaced by the command in the templates
+
+
+@dataclass(frozen=True)
+class CommandTemplate:
+    """Wrapper of the commands executed in the same environment and Slurm allocation.
+
+    The wrapper is split in the prefix and the suffix around the command, so it can be built once
+    and reused by every rule. The command is escaped only when it's wrapped in single quotes.
+    """
+
+    prefix: str
+    suffix: str
+    escape: bool
+
+    def format(self, cmd):
+        """Return the command string to be executed.
+
+        Args:
+            cmd (list): command to be executed as a list of strings.
+        """
+        cmd = " ".join(map(str, cmd))
+        if self.escape:
+            cmd = _escape_single_quotes(cmd)
+        return f"{self.prefix}{cmd}{self.suffix}"
+
+
+def build_command_template(
+    env_config,
+    env_name,
+    cluster_config,
+    slurm_env=None,
+    metrics_file=None,
+    instance=None,
+    *,
+    partition=None,
+):
+    """Return the CommandTemplate wrapping the commands executed in the given environment.
+
+    Args:
+        env_config (dict): environment configuration.
+        env_name (str): key in env_config, or ``WORKFLOW_ENV`` to execute the helpers
+            of circuit-build in the environment executing the workflow.
         cluster_config (dict): cluster configuration.
         slurm_env (str): key in cluster_config.
+        metrics_file (str): optional path to the metrics file where the job events are recorded.
+        instance (circuit_build.apptainer.ApptainerInstance): optional container instance
+            of the environment, used instead of starting a new container for each command.
+        partition (str): optional placeholder of the partition wildcard, recorded in the metrics.
     """
-    selected_env_config = env_config[env_name]
     selected_cluster_config = _get_slurm_config(cluster_config, slurm_env)
-    func = {
-        ENV_TYPE_MODULE: build_module_cmd,
-        ENV_TYPE_APPTAINER: build_apptainer_cmd,
-        ENV_TYPE_VENV: build_venv_cmd,
-    }[selected_env_config["env_type"]]
-    cmd = " ".join(map(str, cmd))
+    if env_name == WORKFLOW_ENV:
+        selected_env_config = {}
+        func = build_workflow_env_cmd
+    else:
+        selected_env_config = env_config[env_name]
+        func = _ENV_TYPE_FUNCS[selected_env_config["env_type"]]
+    if instance:
+        func = functools.partial(build_apptainer_instance_cmd, instance=instance)
+    cmd = COMMAND_PLACEHOLDER
+    if metrics_file:
+        cmd = build_started_marker_cmd(cmd)
     cmd = func(
         cmd=cmd,
         env_config=selected_env_config,
         cluster_config=selected_cluster_config,
     )
     cmd = _unset_threads_vars(cmd)
-    cmd = redirect_to_file(cmd)
-    return cmd
+    cmd = redirect_to_file(cmd, log_config=selected_cluster_config.get("log"))
+    if metrics_file:
+        cmd = build_metrics_cmd(cmd, metrics_file, partition=partition)
+    prefix, suffix = cmd.split(COMMAND_PLACEHOLDER)
+    # the command is wrapped by sh -c '...' in Slurm, or by bash -c '...' in the instance
+    escape = bool(selected_cluster_config or instance)
+    return CommandTemplate(prefix=prefix, suffix=suffix, escape=escape)
+
+
+def build_command(cmd, env_config, env_name, cluster_config, slurm_env=None, metrics_file=None):
+    """Wrap and return the command string to be executed.
+
+    Args:
+        cmd (list): command to be executed as a list of strings.
+        env_config (dict): environment configuration.
+        env_name (str): key in env_config.
+        cluster_config (dict): cluster configuration.
+        slurm_env (str): key in cluster_config.
+        metrics_file (str): optional path to the metrics file where the job events are recorded.
+    """
+    template = build_command_template(
+        env_config=env_config,
+        env_name=env_name,
+        cluster_config=cluster_config,
+        slurm_env=slurm_env,
+        metrics_file=metrics_file,
+    )
+    return template.format(cmd)
 
 
 def load_legacy_env_config(custom_modules):
@@ -4,6 +4,8 @@ PACKAGE_NAME = "circuit_build"
 SCHEMAS_DIR = "snakemake/schemas"
 
 INDEX_SUCCESS_FILE = "meta_data.json"
+# priority of the rules started as soon as possible, higher than the critical path in seconds
+EARLY_PRIORITY = 10**9
 SPACK_MODULEPATH = "/gpfs/bbp.cscs.ch/ssd/apps/bsd/modules/_meta"
 NIX_MODULEPATH = (
     "/nix/var/nix/profiles/per-user/modules/bb5-x86_64/modules-all/release/share/modulefiles/"
@@ -14,10 +16,30 @@ APPTAINER_EXECUTABLE = "singularity"
 APPTAINER_OPTIONS = "--cleanenv --containall --bind $TMPDIR:/tmp,/gpfs/bbp.cscs.ch/project"
 APPTAINER_IMAGEPATH = "/gpfs/bbp.cscs.ch/ssd/containers"
 
+# resources of the cluster nodes, used when they cannot be derived from the allocation
+CORES_PER_NODE = 40
+MEMORY_PER_NODE_GB = 384
+
+# parameters used to tune the memory of the Dask workers
+DASK_LOCAL_SCRATCH_CONSTRAINTS = ["nvme"]  # features of the nodes with local scratch
+DASK_SPILL_MIN_MEMORY_GB = 4  # minimum memory of the workers allowed to spill to disk
+DASK_WORKER_RESERVED_MEMORY_GB = 0.5  # memory of the worker process, not used by the data
+
+# parameters used to tune the Spark properties of functionalizer
+SPARK_EXECUTOR_CORES = 5
+SPARK_PARTITION_SIZE_MB = 128
+SPARK_PARTITIONS_PER_CORE = 3
+
+LOG_SINK_MAX_SIZE_MB = 50
+LOG_SINK_SEGMENT_SIZE_MB = 512
+LOG_SINK_COMPRESSION = "zstd"
+
 ENV_FILE = "environments.yaml"  # in bioname
 ENV_TYPE_MODULE = "MODULE"
 ENV_TYPE_APPTAINER = "APPTAINER"
 ENV_TYPE_VENV = "VENV"
+# environment executing the helpers of circuit-build, with the interpreter running the workflow
+WORKFLOW_ENV = "circuit-build"
 
 ENV_VARS_NEURON_DEFAULT = {
     "NEURON_MODULE_OPTIONS": "-nogui",
@@ -134,6 +156,9 @@ ENV_CONFIG = {
     },
 }
 
+# rules executed once for each partition, when partitions are enabled
+PARTITIONED_RULES = ["touchdetector", "touch2parquet", "spykfunc_s2s", "spykfunc_s2f"]
+
 SPYKFUNC_RULES = {
     "spykfunc_s2s": {
         "mode": "--s2s",
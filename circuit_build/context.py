@@ -8,11 +8,41 @@ from datetime import datetime
 from pathlib import Path
 from typing import Dict
 
-from circuit_build.commands import build_command, load_legacy_env_config
-from circuit_build.constants import ENV_CONFIG, ENV_FILE, INDEX_SUCCESS_FILE, SPYKFUNC_RULES
+from circuit_build.apptainer import apptainer_instances
+from circuit_build.commands import build_command_template, build_env_cmd, load_legacy_env_config
+from circuit_build.constants import (
+    ENV_CONFIG,
+    ENV_FILE,
+    INDEX_SUCCESS_FILE,
+    PARTITIONED_RULES,
+    SPYKFUNC_RULES,
+    WORKFLOW_ENV,
+)
+from circuit_build.dask_cluster import CLUSTER_DIR as DASK_CLUSTER_DIR
+from circuit_build.dask_cluster import DaskCluster
+from circuit_build.emodels import MECOMBO_INDEX_FILE
+from circuit_build.functionalizer import (
+    CHECKPOINTS_RESUME,
+    build_checkpoints_cmd,
+    merge_spark_properties,
+    tune_rule_spark_properties,
+)
+from circuit_build.metrics import METRICS_FILE, append_event
+from circuit_build.morphology_staging import RELEASE_SUBDIRS, MorphologyStaging, with_staged_release
 from circuit_build.ngv import stage_ngv_base_circuit
+from circuit_build.node_sets import CACHE_DIR as NODE_SETS_CACHE_DIR
+from circuit_build.node_sets import build_node_sets_cmd, has_atlas_based_targets
+from circuit_build.preflight import DIGEST_CACHE_FILE, run_preflight
 from circuit_build.sonata_config import write_config
-from circuit_build.utils import dump_yaml, env_true, load_yaml, redirect_to_file
+from circuit_build.utils import (
+    PathRegistry,
+    dump_yaml,
+    env_true,
+    format_if,
+    if_then_else,
+    load_yaml,
+    redirect_to_file,
+)
 from circuit_build.validators import (
     validate_config,
     validate_edge_population_name,
@@ -21,6 +51,7 @@ from circuit_build.validators import (
 )
 
 logger = logging.getLogger(__name__)
+_STARTED = datetime.now()
 
 
 def _make_abs(parent_dir, path):
@@ -41,7 +72,6 @@ class Config:
 
         Args:
             config (dict): configuration dict.
-
         """
         self._config = config
 
@@ -91,6 +121,8 @@ class CircuitPaths:
         self.auxiliary_dir = self.circuit_dir / "auxiliary"
         self.logs_dir = self.circuit_dir / "logs"
 
+        self.registry = PathRegistry()
+
     def sonata_path(self, filename):
         """Return sonata filepath."""
         return Path(self.circuit_dir, "sonata", filename)
@@ -101,15 +133,21 @@ class CircuitPaths:
 
     def auxiliary_path(self, path):
         """Return a path relative to the auxiliary dir."""
-        return self.auxiliary_dir / path
+        return self.registry.get(("auxiliary", str(path)), lambda: self.auxiliary_dir / path)
 
     def nodes_path(self, population_name, filename):
         """Return nodes population filepath."""
-        return Path(self.nodes_dir, population_name, filename)
+        return self.registry.get(
+            ("nodes", population_name, filename),
+            lambda: Path(self.nodes_dir, population_name, filename),
+        )
 
     def edges_path(self, population_name, filename):
         """Return edges population filepath."""
-        return Path(self.edges_dir, population_name, filename)
+        return self.registry.get(
+            ("edges", population_name, filename),
+            lambda: Path(self.edges_dir, population_name, filename),
+        )
 
     def nodes_population_file(self, population_name):
         """Return nodes population nodes.h5 filepath."""
@@ -153,6 +191,8 @@ class Context:
 
         self.conf = Config(config=config)
         self.cluster_config = cluster_config
+        # wrappers of the commands, built once for each environment and Slurm allocation
+        self._command_templates = {}
 
         self.BUILDER_RECIPE = self.paths.bioname_path("builderRecipeAllPathways.xml")
         self.MORPHDB = self.paths.bioname_path("extNeuronDB.dat")
@@ -160,10 +200,17 @@ class Context:
 
         self.SYNTHESIZE = self.conf.get(["common", "synthesis"], default=False)
         self.NO_INDEX = self.conf.get(["common", "no_index"], default=False)
+        self.INDEX_EARLY = self.conf.get(["common", "index_early"], default=False)
         self.NO_EMODEL = self.conf.get(["common", "no_emodel"], default=False)
         self.SYNTHESIZE_MORPH_DIR = self.paths.nodes_population_morphologies_dir(
             self.nodes_neurons_name
         )
+        # HDF5 morphology container used instead of SYNTHESIZE_MORPH_DIR for the h5 morphologies
+        self.SYNTHESIZE_MORPH_CONTAINER = (
+            self.paths.morphologies_dir / f"{self.nodes_neurons_name}.h5"
+            if self.SYNTHESIZE and self.conf.get(["synthesize_morphologies", "container"])
+            else None
+        )
         self.SYNTHESIZE_MORPHDB = self.paths.bioname_path("neurondb-axon.dat")
         self.PARTITION = self.if_synthesis(self.conf.get(["common", "partition"]), [])
 
@@ -179,6 +226,12 @@ class Context:
             self.MORPH_RELEASE = validate_morphology_release(self.MORPH_RELEASE)
 
         self.MORPH_RELEASE = Path(self.MORPH_RELEASE).absolute()
+        # morphology release packed once, and staged on the local storage by the jobs reading it
+        self.MORPH_STAGING = (
+            MorphologyStaging.from_release(self.MORPH_RELEASE, self.paths.auxiliary_path)
+            if not self.SYNTHESIZE and self.conf.get(["common", "stage_morph_release"])
+            else None
+        )
 
         if self.SYNTHESIZE:
             self.EMODEL_RELEASE = ""
@@ -206,11 +259,28 @@ class Context:
             if not os.path.exists(self.EMODEL_RELEASE_HOC):
                 raise ValueError(f"{self.EMODEL_RELEASE} must contain 'hoc' folder")
 
+        self.MECOMBO_INDEX_FILE = None
+        if self.EMODEL_RELEASE_MECOMBO and self.conf.get(["provide_me_info", "chunk_size"]):
+            # indexed copy of the ME-combo table, used when processing the cells in chunks
+            self.MECOMBO_INDEX_FILE = self.paths.auxiliary_path(MECOMBO_INDEX_FILE)
+
         if self.SYNTHESIZE_EMODEL_RELEASE:
             self.EMODEL_RELEASE_HOC = self.conf.get(["common", "hoc_path"], default="hoc_files")
 
         self.NODESETS_FILE = self.paths.sonata_path("node_sets.json")
         self.ENV_CONFIG = self.load_env_config()
+        self.APPTAINER_INSTANCES = apptainer_instances(self.ENV_CONFIG, self.timestamp)
+        # Dask cluster shared by the rules of the synthesis, started when needed
+        self.DASK_CLUSTER = (
+            DaskCluster.from_config(
+                cluster_dir=self.paths.auxiliary_path(DASK_CLUSTER_DIR),
+                log_file=self.log_path("dask_cluster"),
+                env_config=self.ENV_CONFIG,
+                cluster_config=self.cluster_config,
+            )
+            if self.SYNTHESIZE and self.conf.get(["common", "dask_cluster"])
+            else None
+        )
 
         # stage the external base circuit to the dag's local target paths in order to only trigger
         # missing rules if needed by the ngv dag.
@@ -241,7 +311,12 @@ class Context:
 
     @property
     def nodes_neurons_file(self):
-        """Return path to neurons nodes file."""
+        """Return path to neurons nodes file.
+
+        Without the emodel tasks of the synthesis, the synthesized nodes are used without copying.
+        """
+        if self.SYNTHESIZE and self.NO_EMODEL:
+            return self.paths.auxiliary_path("circuit.synthesized_morphologies.h5")
         return self.paths.nodes_population_file(self.nodes_neurons_name)
 
     @property
@@ -327,6 +402,60 @@ class Context:
         """Return endfeet meshes file for endfoot connections."""
         return self.paths.edges_path(self.edges_astrocytes_vasculature_name, "endfeet_meshes.h5")
 
+    @property
+    def extra_node_populations(self):
+        """Return the extra node populations defined in MANIFEST.yaml, keyed by name."""
+        return self.conf.get(["extra_populations", "nodes"], default={})
+
+    @property
+    def extra_edge_populations(self):
+        """Return the extra edge populations defined in MANIFEST.yaml, keyed by name."""
+        return self.conf.get(["extra_populations", "edges"], default={})
+
+    @property
+    def projection_edges_names(self):
+        """Return the names of the extra edge populations to be converted from Parquet."""
+        return [name for name, pop in self.extra_edge_populations.items() if "parquet_dir" in pop]
+
+    def projection_parquet_dir(self, population_name):
+        """Return the Parquet directory of the given extra edge population."""
+        parquet_dir = self.extra_edge_populations[population_name]["parquet_dir"]
+        return _make_abs(self.paths.bioname_dir, parquet_dir)
+
+    def extra_edges_file(self, population_name):
+        """Return the edges file of the given extra edge population."""
+        edges_file = self.extra_edge_populations[population_name].get("edges_file")
+        if edges_file:
+            return _make_abs(self.paths.bioname_dir, edges_file)
+        return self.paths.edges_population_file(population_name)
+
+    @property
+    def projection_edges_files(self):
+        """Return the edges files to be built from the extra Parquet edge populations."""
+        return [self.extra_edges_file(name) for name in self.projection_edges_names]
+
+    def extra_network_entries(self):
+        """Return the nodes and edges entries of the extra populations for the SONATA config."""
+        nodes = [
+            {
+                "nodes_file": _make_abs(self.paths.bioname_dir, pop["nodes_file"]),
+                "population_type": pop["population_type"],
+                "population_name": name,
+                **self.provenance(),
+            }
+            for name, pop in self.extra_node_populations.items()
+        ]
+        edges = [
+            {
+                "edges_file": self.extra_edges_file(name),
+                "population_type": pop["population_type"],
+                "population_name": name,
+                **self.provenance(),
+            }
+            for name, pop in self.extra_edge_populations.items()
+        ]
+        return nodes, edges
+
     @property
     def edges_spatial_index_dir(self):
         """Return directory of edges spatial index files."""
@@ -398,17 +527,15 @@ class Context:
             self.conf.get(["ngv", "tetrahedral_mesh", "refinement_subdividing_steps"], default="1")
         )
 
-    def morphology_path(self, morphology_type: str):
-        """Return path to the morphology."""
+    def morphology_path(self, morphology_type: str, staged: bool = False):
+        """Return path to the morphology directory or container, or to the staged local copy."""
         if self.SYNTHESIZE:
+            if morphology_type == "h5" and self.SYNTHESIZE_MORPH_CONTAINER:
+                return self.SYNTHESIZE_MORPH_CONTAINER
             return self.SYNTHESIZE_MORPH_DIR
-
-        type_to_subdir = {
-            "asc": "ascii",
-            "swc": "swc",
-            "h5": "h5v1",
-        }
-        return Path(self.MORPH_RELEASE, type_to_subdir[morphology_type])
+        if staged and self.MORPH_STAGING:
+            return self.MORPH_STAGING.staged_path(RELEASE_SUBDIRS[morphology_type])
+        return Path(self.MORPH_RELEASE, RELEASE_SUBDIRS[morphology_type])
 
     def provenance(self):
         """Return the provenance part of the population."""
@@ -455,6 +582,42 @@ class Context:
             or env_true("CIRCUIT_BUILD_SKIP_GIT_CHECK")
         )
 
+    def skip_metrics(self):
+        """Return True if the metrics of the jobs should not be recorded.
+
+        This happens when the env variable CIRCUIT_BUILD_SKIP_METRICS is set to 'true'.
+        """
+        return env_true("CIRCUIT_BUILD_SKIP_METRICS")
+
+    @property
+    def metrics_file(self):
+        """Return the path to the metrics file, or None if the metrics are disabled.
+
+        The path can be overridden with the env variable CIRCUIT_BUILD_METRICS_FILE,
+        for example to collect the metrics of different circuits in the same file.
+        """
+        if self.skip_metrics():
+            return None
+        return os.getenv("CIRCUIT_BUILD_METRICS_FILE") or str(self.paths.logs_dir / METRICS_FILE)
+
+    def record_build_event(self, event, **kwargs):
+        """Append a build event to the metrics file, if the metrics are enabled."""
+        if not self.metrics_file:
+            return
+        try:
+            append_event(
+                self.metrics_file,
+                {
+                    "event": event,
+                    "build": self.timestamp,
+                    "circuit_dir": str(self.paths.circuit_dir),
+                    "bioname_dir": str(self.paths.bioname_dir),
+                    **kwargs,
+                },
+            )
+        except OSError as ex:
+            logger.warning("Unable to record the metrics: %s", ex)
+
     def if_synthesis(self, true_value, false_value):
         """Return ``true_value`` if synthesis is enabled, else ``false_value``."""
         return true_value if self.SYNTHESIZE else false_value
@@ -475,17 +638,34 @@ class Context:
         """Return the partition wildcard to be used in snakemake commands."""
         return self.if_partition("_{partition}", "")
 
-    def log_path(self, name, _now=datetime.now()):
-        """Return the path to the logfile for a given rule, and create the dir if needed."""
-        timestamp = self.conf.get("timestamp", default=_now.strftime("%Y%m%dT%H%M%S"))
-        path = str(self.paths.logs_dir / timestamp / f"{name}.log")
-        os.makedirs(os.path.dirname(path), exist_ok=True)
+    @property
+    def timestamp(self):
+        """Return the timestamp of the build, used to group the logs and the metrics."""
+        return self.conf.get("timestamp", default=_STARTED.strftime("%Y%m%dT%H%M%S"))
+
+    def log_path(self, name, create=False):
+        """Return the path to the logfile for a given rule.
+
+        The directory is created with the other registered directories when the workflow starts,
+        or immediately if ``create`` is True and it hasn't been created yet.
+        """
+        path = self.paths.registry.get(
+            ("log", name), lambda: str(self.paths.logs_dir / self.timestamp / f"{name}.log")
+        )
+        if create:
+            self.paths.registry.makedirs([Path(path).parent])
         return path
 
     def check_git(self, path):
-        """Log some information and raise an exception if bioname is not under git control."""
+        """Log some information and raise an exception if bioname is not under git control.
+
+        The digests of the bioname files are computed in Python, and written with the list of the
+        files changed since the previous build in ``logs/<timestamp>/bioname_provenance.json``.
+        """
         if self.skip_git_check():
             return
+        path = path if os.path.isdir(path) else os.path.dirname(path)
+        run_preflight(path, logs_dir=self.paths.logs_dir, timestamp=self.timestamp)
         # strip away any git credentials added by the CI from `git remote get-url origin`
         cmd = """
             set -e +x
@@ -497,8 +677,6 @@ class Context:
             echo "snakemake version: $(snakemake --version)"
             echo "git version: $(git --version)"
             echo "bioname path: $(realpath .)"
-            MD5SUM=$(which md5sum 2>/dev/null || which md5 2>/dev/null)
-            [[ -n $MD5SUM ]] && find . -maxdepth 1 -type f -print0 | xargs -0 $MD5SUM
             echo "### Git info"
             set -x
             git status
@@ -509,8 +687,7 @@ class Context:
             git --no-pager diff
             git --no-pager diff --staged
             """
-        cmd = redirect_to_file(cmd, filename=self.log_path("git_info"))
-        path = path if os.path.isdir(path) else os.path.dirname(path)
+        cmd = redirect_to_file(cmd, filename=self.log_path("git_info", create=True))
         try:
             subprocess.run(cmd, shell=True, check=True, cwd=path)
         except subprocess.CalledProcessError as ex:
@@ -546,36 +723,39 @@ class Context:
 
     def dump_env_config(self):
         """Write the environment configuration into the log directory."""
-        dump_yaml(self.log_path("environments"), data=self.ENV_CONFIG)
+        dump_yaml(self.log_path("environments", create=True), data=self.ENV_CONFIG)
 
     def bbp_env(self, module_env, command, slurm_env=None):
-        """Wrap and return the command string to be executed."""
-        return build_command(
-            cmd=command,
-            env_config=self.ENV_CONFIG,
-            env_name=module_env,
-            cluster_config=self.cluster_config,
-            slurm_env=slurm_env,
-        )
+        """Wrap and return the command string, with the wrapper built once for each environment."""
+        key = (module_env, slurm_env, self.metrics_file)
+        if key not in self._command_templates:
+            instance = self.APPTAINER_INSTANCES.get(module_env)
+            # the partitioned jobs process a subset of the cells, recorded in the metrics
+            partitioned = self.PARTITION and slurm_env in PARTITIONED_RULES
+            self._command_templates[key] = build_command_template(
+                self.ENV_CONFIG,
+                module_env,
+                self.cluster_config,
+                *key[1:],
+                instance,
+                partition="{wildcards.partition}" if partitioned else None,
+            )
+        return self._command_templates[key].format(command)
 
     def write_network_config(
         self, connectome_dir, output_file, nodes_file=None, is_partial_config=False
     ):
-        """Return the SONATA circuit configuration for neurons."""
-        morphologies_entry = self.if_synthesis(
-            {
-                "alternate_morphologies": {
-                    "h5v1": self.SYNTHESIZE_MORPH_DIR,
-                    "neurolucida-asc": self.SYNTHESIZE_MORPH_DIR,
-                }
-            },
-            {
-                "alternate_morphologies": {
-                    "h5v1": Path(self.MORPH_RELEASE, "h5v1"),
-                    "neurolucida-asc": Path(self.MORPH_RELEASE, "ascii"),
-                }
-            },
-        )
+        """Return the SONATA circuit configuration for neurons.
+
+        The extra populations defined in MANIFEST.yaml are included only when ``connectome_dir``
+        is specified, since they are not needed to build the neuronal connectome.
+        """
+        morphologies_entry = {
+            "alternate_morphologies": {
+                "h5v1": self.morphology_path("h5"),
+                "neurolucida-asc": self.morphology_path("asc"),
+            }
+        }
         if connectome_dir:
             edges_dict = {
                 "edges_file": self.edges_neurons_neurons_file(connectome_type=connectome_dir),
@@ -587,9 +767,11 @@ class Context:
             if self.spine_morphologies_dir:
                 edges_dict["spine_morphologies_dir"] = self.spine_morphologies_dir
             edges_entry = [edges_dict]
+            extra_nodes_entry, extra_edges_entry = self.extra_network_entries()
 
         else:
             edges_entry = []
+            extra_nodes_entry, extra_edges_entry = [], []
 
         write_config(
             output_file=output_file,
@@ -604,8 +786,9 @@ class Context:
                     "spatial_segment_index_dir": self.nodes_spatial_index_dir,
                     **self.provenance(),
                 },
+                *extra_nodes_entry,
             ],
-            edges=edges_entry,
+            edges=edges_entry + extra_edges_entry,
             node_sets_file=self.NODESETS_FILE,
             is_partial_config=is_partial_config,
         )
@@ -653,14 +836,8 @@ class Context:
                     "population_name": self.nodes_neurons_name,
                     "spatial_segment_index_dir": self.nodes_spatial_index_dir,
                     "alternate_morphologies": {
-                        "h5v1": self.if_synthesis(
-                            self.paths.nodes_population_morphologies_dir(self.nodes_neurons_name),
-                            Path(self.MORPH_RELEASE, "h5v1"),
-                        ),
-                        "neurolucida-asc": self.if_synthesis(
-                            self.paths.nodes_population_morphologies_dir(self.nodes_neurons_name),
-                            Path(self.MORPH_RELEASE, "ascii"),
-                        ),
+                        "h5v1": self.morphology_path("h5"),
+                        "neurolucida-asc": self.morphology_path("asc"),
                     },
                     "biophysical_neuron_models_dir": self.EMODEL_RELEASE_HOC or "",
                     **self.provenance(),
@@ -690,14 +867,77 @@ class Context:
             node_sets_file=self.NODESETS_FILE,
         )
 
+    def spark_properties(self, rule, input_dirs, statistics_files=()):
+        """Return the Spark properties for the given spykfunc rule, as command line options.
+
+        If ``auto_tune`` is enabled for the rule, the number of shuffle partitions and the
+        resources of the executors are derived from the size of the input data and from the
+        allocation in the cluster config. The size of the data is the uncompressed size read from
+        the touch statistics if available, or the size of the Parquet files in the input dirs.
+        The explicit ``spark_property`` entries in MANIFEST.yaml override the tuned values.
+
+        Args:
+            rule (str): name of the rule.
+            input_dirs (list): directories containing the input Parquet files.
+            statistics_files (list): statistics files written by the ``touch_statistics`` rule.
+        """
+        tuned = {}
+        if self.conf.get([rule, "auto_tune"], default=False):
+            job_config = self.cluster_config.get(rule) or self.cluster_config.get("__default__", {})
+            salloc = job_config.get("salloc", "")
+            tuned = tune_rule_spark_properties(rule, salloc, input_dirs, statistics_files)
+        explicit = self.conf.get([rule, "spark_property"], default=[])
+        properties = merge_spark_properties(tuned, explicit)
+        return " ".join(f"--spark-property {p}" for p in properties)
+
+    def run_node_sets(self):
+        """Return the command generating the node sets as a string.
+
+        When the targets file contains atlas based targets and the atlas is a local directory,
+        only the query based targets are resolved by brainbuilder, while the atlas based targets
+        are resolved by circuit-build with the voxel masks cached in the atlas cache dir,
+        in the same allocation but outside the environment of brainbuilder.
+        """
+        targets = self.conf.get(["node_sets", "targets"])
+        targets = self.paths.bioname_path(targets) if targets else None
+        allow_empty = self.conf.get(["node_sets", "allow_empty"], default=False)
+        split = targets and Path(self.ATLAS).is_dir() and has_atlas_based_targets(targets)
+        query_targets = self.paths.auxiliary_path("targets.query_based.yaml")
+        cmd = [
+            "brainbuilder targets node-sets",
+            format_if("--targets {}", query_targets if split else targets),
+            if_then_else(allow_empty, "--allow-empty", ""),
+            "--population",
+            self.nodes_neurons_name,
+            *([] if split else ["--atlas", self.ATLAS, "--atlas-cache", self.ATLAS_CACHE_DIR]),
+            "--output {output}",
+            "{input}",
+        ]
+        if not split:
+            return self.bbp_env("brainbuilder", cmd, slurm_env="node_sets")
+        cmd = build_node_sets_cmd(
+            build_env_cmd(cmd, self.ENV_CONFIG, "brainbuilder"),
+            targets=targets,
+            query_targets=query_targets,
+            atlas_dir=self.ATLAS,
+            cache_dir=Path(self.ATLAS_CACHE_DIR, NODE_SETS_CACHE_DIR),
+            population=self.nodes_neurons_name,
+            allow_empty=allow_empty,
+            digests_file=self.paths.logs_dir / DIGEST_CACHE_FILE,
+        )
+        return self.bbp_env(WORKFLOW_ENV, [cmd], slurm_env="node_sets")
+
     def run_spykfunc(self, rule):
-        """Return the spykfunc command as a string."""
+        """Return the spykfunc command as a string.
+
+        The checkpoints written in the work dir by a previous run of the same rule are reused
+        if the arguments and the input files didn't change, unless the ``checkpoints`` option
+        of the rule is set to ``overwrite``. The work dir is removed only after a successful run.
+        """
         if rule in SPYKFUNC_RULES:
             mode = SPYKFUNC_RULES[rule]["mode"]
             filters: list[str] = self.conf.get([rule, "filters"], default=[])
-            morphologies_dirs = self.if_synthesis(
-                self.SYNTHESIZE_MORPH_DIR, Path(self.MORPH_RELEASE, "h5v1")
-            )
+            morphologies_dirs = self.morphology_path("h5", staged=True)
             if self.spine_morphologies_dir:
                 spine_filters = ["SynapseProperties", "SpineMorphologies"]
                 morphologies_dirs = f"{morphologies_dirs} {self.spine_morphologies_dir}"
@@ -733,23 +973,28 @@ class Context:
         else:
             raise ValueError(f"Unrecognized rule {rule!r} in run_spykfunc")
 
-        spark_properties = self.conf.get([rule, "spark_property"], default=[])
+        work_dir = "{params.output_dir}/.fz"
+        functionalizer_args = [
+            self.cluster_config.get(rule, {}).get("functionalizer", ""),
+            f"--work-dir {work_dir}",
+            "--output-dir {params.output_dir}",
+            "{params.spark_properties}",
+            *extra_args,
+            "--",
+            "{params.parquet_dirs}",
+        ]
         cmd = self.bbp_env(
             "spykfunc",
-            [
-                "env",
-                "USER=$(whoami)",
-                "SPARK_USER=$(whoami)",
-                "dplace",
-                "functionalizer",
-                self.cluster_config.get(rule, {}).get("functionalizer", ""),
-                "--work-dir {params.output_dir}/.fz",
-                "--output-dir {params.output_dir}",
-                *[f"--spark-property {p}" for p in spark_properties],
-                *extra_args,
-                "--",
-                "{params.parquet_dirs}",
-            ],
+            with_staged_release(
+                self.MORPH_STAGING if rule in SPYKFUNC_RULES else None,
+                ["env", "USER=$(whoami)", "SPARK_USER=$(whoami)", "dplace", "functionalizer"]
+                + functionalizer_args,
+            ),
             slurm_env=rule,
         )
-        return cmd
+        return build_checkpoints_cmd(
+            cmd,
+            work_dir=work_dir,
+            args=functionalizer_args,
+            mode=self.conf.get([rule, "checkpoints"], default=CHECKPOINTS_RESUME),
+        )
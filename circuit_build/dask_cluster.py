@@ -0,0 +1,258 @@
+"""Shared Dask cluster, used by the rules that would start their own Dask cluster otherwise.
+
+The cluster is started in background by the first rule that needs it, in a dedicated Slurm
+allocation configured with ``dask_cluster`` in cluster.yaml, where the first task runs the
+scheduler and every task runs one worker. The following rules find the running cluster using the
+scheduler file, and attach to it instead of paying again the startup of the workers.
+The cluster is stopped when the workflow finishes.
+
+The rules attach to the cluster through the env variables ``DASK_SCHEDULER_ADDRESS``,
+used by ``distributed.Client()``, and ``PARALLEL_DASK_SCHEDULER_PATH``,
+used by the ``dask_dataframe`` parallel library of emodel-generalisation.
+Since the work is executed by the workers of the cluster, the clients don't use the allocations
+of the rules: they are executed in the allocation configured with ``dask_client`` in cluster.yaml,
+or without any allocation in the process executing the workflow if it isn't configured.
+"""
+
+import fcntl
+import json
+import logging
+import os
+import shlex
+import signal
+import subprocess
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Optional
+
+import click
+
+from circuit_build.commands import build_command, dask_worker_resources
+from circuit_build.utils import python_module_cmd
+
+L = logging.getLogger(__name__)
+
+SLURM_ENV = "dask_cluster"
+CLIENT_SLURM_ENV = "dask_client"
+ENV_NAME = "emodel-generalisation"
+CLUSTER_DIR = "dask_cluster"  # in the auxiliary dir
+START_TIMEOUT = 24 * 3600  # the allocation may be pending for a long time
+POLL_INTERVAL = 5
+
+
+def worker_cmd(scheduler_file, salloc=""):
+    """Return the command executed by each task of the allocation.
+
+    The threads and the memory limit of the workers are derived from the salloc parameters.
+    The braces are doubled because the command is formatted by Snakemake.
+    """
+    threads, memory = dask_worker_resources(salloc)
+    memory_limit = f" --memory-limit {memory:.2f}GB" if memory else ""
+    return (
+        f"if [ ${{{{SLURM_PROCID:-0}}}} = 0 ]; then "
+        f"dask scheduler --scheduler-file {scheduler_file} & fi; "
+        f"dask worker --scheduler-file {scheduler_file} --nworkers 1 --nthreads {threads}"
+        f"{memory_limit}"
+    )
+
+
+@dataclass(frozen=True)
+class DaskCluster:
+    """Shared Dask cluster."""
+
+    scheduler_file: Path
+    pid_file: Path
+    log_file: Path
+    start_cmd: str
+    client_slurm_env: Optional[str] = None
+
+    @classmethod
+    def from_config(cls, cluster_dir, log_file, env_config, cluster_config):
+        """Return a new object, with the command starting the cluster.
+
+        Args:
+            cluster_dir (str|Path): directory where the scheduler and pid files are written.
+            log_file (str|Path): log file of the cluster.
+            env_config (dict): environment configuration.
+            cluster_config (dict): cluster configuration.
+        """
+        cluster_dir = Path(cluster_dir)
+        scheduler_file = cluster_dir / "scheduler.json"
+        job_config = cluster_config.get(SLURM_ENV) or cluster_config.get("__default__", {})
+        salloc = job_config.get("salloc", "")
+        cmd = build_command(
+            cmd=[worker_cmd(scheduler_file, salloc)],
+            env_config=env_config,
+            env_name=ENV_NAME,
+            cluster_config=cluster_config,
+            slurm_env=SLURM_ENV,
+        )
+        # the cluster is not a job of the workflow, so it has its own log file
+        cmd = cmd.replace("{log}", str(log_file))
+        return cls(
+            scheduler_file=scheduler_file,
+            pid_file=cluster_dir / "cluster.pid",
+            log_file=Path(log_file),
+            start_cmd=cmd,
+            client_slurm_env=CLIENT_SLURM_ENV if CLIENT_SLURM_ENV in cluster_config else None,
+        )
+
+    def wrap(self, cmd):
+        """Return a command string starting the cluster if needed, and executing the command.
+
+        Args:
+            cmd (str): command attaching to the cluster.
+        """
+        helper = python_module_cmd(__name__)
+        return (
+            f"DASK_SCHEDULER_ADDRESS=$({helper} start "
+            f"--scheduler-file {self.scheduler_file} --pid-file {self.pid_file} "
+            f"{shlex.quote(self.start_cmd)} 2>>{self.log_file}) && "
+            "export DASK_SCHEDULER_ADDRESS && "
+            f"export PARALLEL_DASK_SCHEDULER_PATH={self.scheduler_file} && "
+            f"( {cmd} )"
+        )
+
+    def stop(self):
+        """Stop the cluster, if it has been started."""
+        stop_cluster(self.scheduler_file, self.pid_file)
+
+
+def with_dask_cluster(cluster, cmd):
+    """Return the command attaching to the cluster, or the same command if there isn't a cluster."""
+    return cluster.wrap(cmd) if cluster else cmd
+
+
+def dask_slurm_env(cluster, slurm_env):
+    """Return the slurm env of the rule, or of the client attaching to the cluster if any.
+
+    The client doesn't need the allocation of the rule, that would be held for all the time
+    spent by the cluster to execute the work, so it's executed in the allocation ``dask_client``,
+    or without any allocation (None) if ``dask_client`` isn't defined in the cluster config.
+    """
+    return cluster.client_slurm_env if cluster else slurm_env
+
+
+def _pid_alive(pid):
+    """Return True if the process with the given pid exists."""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _read_pid(pid_file):
+    """Return the pid read from the file, or None if missing."""
+    try:
+        return int(Path(pid_file).read_text(encoding="utf-8"))
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def _read_address(scheduler_file):
+    """Return the address of the scheduler, or None if the file is missing or incomplete."""
+    try:
+        with open(scheduler_file, encoding="utf-8") as fd:
+            return json.load(fd)["address"]
+    except (FileNotFoundError, ValueError, KeyError):
+        return None
+
+
+@contextmanager
+def _locked(pid_file):
+    """Hold an exclusive lock, to avoid starting more clusters concurrently."""
+    lock_file = Path(pid_file).with_suffix(".lock")
+    lock_file.parent.mkdir(parents=True, exist_ok=True)
+    with lock_file.open("w", encoding="utf-8") as fd:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+
+
+def start_cluster(cmd, scheduler_file, pid_file, timeout=START_TIMEOUT):
+    """Start the cluster in background if it isn't running, and return the scheduler address.
+
+    Args:
+        cmd (str): command starting the scheduler and the workers.
+        scheduler_file (str|Path): scheduler file written by the scheduler.
+        pid_file (str|Path): file where the pid of the cluster process is written.
+        timeout (float): maximum number of seconds to wait for the scheduler.
+    """
+    scheduler_file = Path(scheduler_file)
+    process = None
+    with _locked(pid_file):
+        pid = _read_pid(pid_file)
+        if pid and _pid_alive(pid):
+            L.info("Attaching to the running Dask cluster with pid %s", pid)
+        else:
+            scheduler_file.unlink(missing_ok=True)
+            # new session, so that the cluster survives this process and can be stopped as a group
+            process = subprocess.Popen(  # pylint: disable=consider-using-with
+                ["bash", "-c", cmd],
+                start_new_session=True,
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.DEVNULL,
+            )
+            Path(pid_file).write_text(str(process.pid), encoding="utf-8")
+            L.info("Started the Dask cluster with pid %s", process.pid)
+    deadline = time.monotonic() + timeout
+    while (address := _read_address(scheduler_file)) is None:
+        # the started process must be polled, or it would be a zombie still found by its pid
+        if process.poll() is not None if process else not _pid_alive(pid):
+            raise RuntimeError("The Dask cluster exited before starting the scheduler")
+        if time.monotonic() > deadline:
+            raise RuntimeError(f"The Dask scheduler didn't start in {timeout} seconds")
+        time.sleep(POLL_INTERVAL)
+    return address
+
+
+def stop_cluster(scheduler_file, pid_file):
+    """Stop the cluster and the Slurm allocation, and remove the scheduler file."""
+    pid = _read_pid(pid_file)
+    if pid and _pid_alive(pid):
+        L.info("Stopping the Dask cluster with pid %s", pid)
+        try:
+            os.killpg(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+    Path(pid_file).unlink(missing_ok=True)
+    Path(scheduler_file).unlink(missing_ok=True)
+
+
+@click.group()
+def main():
+    """Manage the shared Dask cluster."""
+    logging.basicConfig(level=logging.INFO, format="[circuit-build] %(message)s")
+
+
+@main.command("start")
+@click.argument("cmd")
+@click.option("--scheduler-file", required=True, type=click.Path(dir_okay=False))
+@click.option("--pid-file", required=True, type=click.Path(dir_okay=False))
+@click.option("--timeout", type=float, default=START_TIMEOUT, help="Timeout in seconds.")
+def start_cmd(cmd, scheduler_file, pid_file, timeout):
+    """Start the cluster with CMD if needed, and print the address of the scheduler."""
+    try:
+        address = start_cluster(cmd, scheduler_file, pid_file, timeout=timeout)
+    except RuntimeError as e:
+        raise click.ClickException(str(e)) from e
+    click.echo(address)
+
+
+@main.command("stop")
+@click.option("--scheduler-file", required=True, type=click.Path(dir_okay=False))
+@click.option("--pid-file", required=True, type=click.Path(dir_okay=False))
+def stop_cmd(scheduler_file, pid_file):
+    """Stop the cluster."""
+    stop_cluster(scheduler_file, pid_file)
+
+
+if __name__ == "__main__":  # pragma: no cover
+    main()
@@ -0,0 +1,360 @@
+"""Assign the emodels and the ME info to the SONATA nodes, processing the cells in chunks.
+
+This is an alternative to ``brainbuilder cells assign-emodels`` and
+``brainbuilder sonata provide-me-info``, that need to load all the cells in memory.
+The input nodes file is copied, and the new properties are appended chunk by chunk,
+so the memory needed depends only on the chunk size and on the size of the tables.
+
+The new string properties are written as enumerations, with the values in the ``@library`` group.
+"""
+
+import hashlib
+import logging
+import shutil
+import tempfile
+from contextlib import contextmanager
+from pathlib import Path
+
+import click
+import h5py
+import numpy as np
+
+from circuit_build.utils import python_module_cmd
+
+L = logging.getLogger(__name__)
+
+ME_COMBO = "me_combo"
+LIBRARY = "@library"
+DYNAMICS_PARAMS = "dynamics_params"
+MORPHDB_COLUMNS = ["morphology", "layer", "mtype", "etype", ME_COMBO]
+# columns of mecombo_emodel.tsv ignored, as done by brainbuilder
+MECOMBO_IGNORED_COLUMNS = {"morph_name", "layer", "subregion", "fullmtype", "etype"}
+DEFAULT_CHUNK_SIZE = 1_000_000
+MECOMBO_INDEX_FILE = "mecombo_emodel.h5"  # in the auxiliary dir
+
+
+def helper_cmd():
+    """Return the command executing this module with the interpreter executing the workflow."""
+    return python_module_cmd(__name__)
+
+
+def load_table(path):
+    """Return the header and the rows of a whitespace separated file."""
+    with open(path, encoding="utf-8") as fd:
+        lines = [line.split() for line in fd if line.strip() and not line.startswith("#")]
+    return lines[0], lines[1:]
+
+
+def load_morphdb(path):
+    """Return a dict {(morphology, layer, mtype, etype): [me_combo indices]}, and the me_combos.
+
+    Args:
+        path (str|Path): path to ``extNeuronDB.dat``, without header.
+    """
+    index = {}
+    combos = []
+    with open(path, encoding="utf-8") as fd:
+        for line in fd:
+            if not line.strip():
+                continue
+            morphology, layer, mtype, etype, combo = line.split()[: len(MORPHDB_COLUMNS)]
+            index.setdefault((morphology, layer, mtype, etype), []).append(len(combos))
+            combos.append(combo)
+    return index, combos
+
+
+def load_mecombo_info(path):
+    """Return the combo names, the emodels, and the dynamics params by name.
+
+    Args:
+        path (str|Path): path to ``mecombo_emodel.tsv``.
+    """
+    header, rows = load_table(path)
+    columns = [name for name in header if name not in MECOMBO_IGNORED_COLUMNS]
+    positions = [header.index(name) for name in columns]
+    data = {name: [row[i] for row in rows] for name, i in zip(columns, positions)}
+    combo_names = data.pop("combo_name")
+    if len(set(combo_names)) != len(combo_names):
+        raise ValueError("Duplicate me-combos in the ME-combo table")
+    emodels = data.pop("emodel")
+    dynamics_params = {name: np.array(values, dtype=float) for name, values in data.items()}
+    return combo_names, emodels, dynamics_params
+
+
+def combo_hash(names):
+    """Return the stable 64-bit hashes of the given combo names."""
+    return np.array(
+        [
+            int.from_bytes(hashlib.blake2b(name.encode(), digest_size=8).digest(), "little")
+            for name in names
+        ],
+        dtype=np.uint64,
+    )
+
+
+def write_mecombo_index(path, output):
+    """Convert the ME-combo table to HDF5, with an index of the hashes of the combo names.
+
+    The columns are stored as separate datasets, so that only the needed rows can be read,
+    and the rows can be found with a binary search on the sorted hashes.
+
+    Args:
+        path (str|Path): path to ``mecombo_emodel.tsv``.
+        output (str|Path): path to the HDF5 file to be written.
+    """
+    combo_names, emodels, dynamics_params = load_mecombo_info(path)
+    templates, template_codes = np.unique(
+        [f"hoc:{emodel}" for emodel in emodels], return_inverse=True
+    )
+    hashes = combo_hash(combo_names)
+    order = np.argsort(hashes, kind="stable")
+    with h5py.File(output, "w") as h5:
+        h5.attrs["source"] = str(path)
+        h5.create_dataset("combo_name", data=combo_names, dtype=h5py.string_dtype())
+        h5.create_dataset(
+            f"{LIBRARY}/model_template", data=templates.tolist(), dtype=h5py.string_dtype()
+        )
+        h5["model_template"] = template_codes.astype(np.uint32)
+        for name, values in dynamics_params.items():
+            h5[f"{DYNAMICS_PARAMS}/{name}"] = values
+        h5["index/hash"] = hashes[order]
+        h5["index/row"] = order
+    L.info("Indexed %s me-combos from %s", len(combo_names), path)
+
+
+class MEComboIndex:
+    """Find the rows of the ME-combo table written by :func:`write_mecombo_index`.
+
+    Only the index is loaded in memory, while the other columns are read when needed.
+    """
+
+    def __init__(self, h5):
+        """Initialize the object from the open HDF5 file."""
+        self.h5 = h5
+        self.hashes = h5["index/hash"][:]
+        self.rows = h5["index/row"][:]
+
+    def take(self, name, rows):
+        """Return the values of the dataset at the given rows."""
+        dataset = self.h5[name]
+        if h5py.check_string_dtype(dataset.dtype):
+            dataset = dataset.asstr()
+        unique_rows, inverse = np.unique(rows, return_inverse=True)
+        return np.asarray(dataset[unique_rows])[inverse]
+
+    def find(self, names):
+        """Return the rows of the given combo names, or -1 for the missing combo names."""
+        unique_names, inverse = np.unique(np.asarray(names, dtype=str), return_inverse=True)
+        hashes = combo_hash(unique_names)
+        positions = np.searchsorted(self.hashes, hashes)
+        result = np.full(len(unique_names), -1, dtype=np.int64)
+        pending = np.arange(len(unique_names))
+        # different combo names may have the same hash, so the candidates are compared in turn
+        while len(pending) > 0:
+            pending = pending[positions[pending] < len(self.hashes)]
+            pending = pending[self.hashes[positions[pending]] == hashes[pending]]
+            if len(pending) == 0:
+                break
+            rows = self.rows[positions[pending]]
+            matching = self.take("combo_name", rows) == unique_names[pending]
+            result[pending[matching]] = rows[matching]
+            pending = pending[~matching]
+            positions[pending] += 1
+        return result[inverse]
+
+
+@contextmanager
+def open_population(path):
+    """Open the nodes file in append mode, and yield the group with the properties, and the size."""
+    with h5py.File(path, "r+") as h5:
+        (population,) = h5["nodes"]
+        root = h5["nodes"][population]
+        yield root["0"], len(root["node_type_id"])
+
+
+def read_strings(group, name, start, stop):
+    """Return the string values of a property in the given range, decoding the enumerations."""
+    if LIBRARY in group and name in group[LIBRARY]:
+        library = group[LIBRARY][name].asstr()[:]
+        return library[group[name][start:stop]]
+    dataset = group[name]
+    if h5py.check_string_dtype(dataset.dtype):
+        return dataset.asstr()[start:stop]
+    return dataset[start:stop].astype(str)
+
+
+def _create_appendable(group, name, dtype):
+    """Create a dataset with unlimited size, where the values can be appended."""
+    if name in group:
+        L.warning("'%s' property would be overwritten", name)
+        del group[name]
+    return group.create_dataset(name, shape=(0,), maxshape=(None,), dtype=dtype, chunks=True)
+
+
+def _append(dataset, values):
+    size = len(dataset)
+    dataset.resize((size + len(values),))
+    dataset[size:] = values
+
+
+def _write_library(group, name, values):
+    library = group.require_group(LIBRARY)
+    if name in library:
+        del library[name]
+    library.create_dataset(name, data=values, dtype=h5py.string_dtype())
+
+
+def chunk_uniform(seed, start, stop):
+    """Return uniform random numbers for the cells in the given range.
+
+    The number assigned to each cell depends only on the seed and on the index of the cell,
+    so the result doesn't depend on the chunk size.
+    """
+    bit_generator = np.random.Philox(key=seed)
+    bit_generator.advance(start)
+    # each step of the counter produces 4 numbers, and only the first one is used
+    return np.random.Generator(bit_generator).random(4 * (stop - start))[::4]
+
+
+def _chunks(size, chunk_size):
+    """Yield the start and stop indices of the chunks, logging the progress."""
+    for start in range(0, size, chunk_size):
+        stop = min(start + chunk_size, size)
+        yield start, stop
+        L.info("Processed %s/%s cells", stop, size)
+
+
+def _pick_me_combos(group, index, columns, start, stop, seed):
+    """Return the indices of the me_combos assigned to the cells in the given range."""
+    keys = zip(*(read_strings(group, name, start, stop) for name in columns))
+    candidates = [index.get(key) for key in keys]
+    not_assigned = sum(1 for c in candidates if c is None)
+    if not_assigned:
+        raise ValueError(f"Could not pick emodel for {not_assigned} cell(s)")
+    uniform = chunk_uniform(seed, start, stop)
+    return [c[int(u * len(c))] for c, u in zip(candidates, uniform)]
+
+
+def assign_emodels(nodes_file, morphdb_file, output, seed=0, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Assign the ``me_combo`` property, choosing randomly if several are available.
+
+    Args:
+        nodes_file (str|Path): path to the input SONATA nodes.
+        morphdb_file (str|Path): path to ``extNeuronDB.dat``.
+        output (str|Path): path to the output SONATA nodes.
+        seed (int): pseudo-random generator seed.
+        chunk_size (int): number of cells processed in each chunk.
+    """
+    index, combos = load_morphdb(morphdb_file)
+    shutil.copyfile(nodes_file, output)
+    with open_population(output) as (group, size):
+        layer = "layer" if "layer" in group else "subregion"
+        if layer not in group:
+            raise ValueError("Missing `layer` and `subregion` in cells")
+        columns = ["morphology", layer, "mtype", "etype"]
+        _write_library(group, ME_COMBO, combos)
+        dataset = _create_appendable(group, ME_COMBO, np.uint32)
+        for start, stop in _chunks(size, chunk_size):
+            _append(dataset, _pick_me_combos(group, index, columns, start, stop, seed))
+
+
+def provide_me_info(
+    nodes_file, output, model_type="biophysical", mecombo_info=None, chunk_size=DEFAULT_CHUNK_SIZE
+):
+    """Add the ME info from the ME-combo table, and the model type.
+
+    Args:
+        nodes_file (str|Path): path to the input SONATA nodes, with the ``me_combo`` property.
+        output (str|Path): path to the output SONATA nodes.
+        model_type (str): model type of all the nodes.
+        mecombo_info (str|Path): optional path to ``mecombo_emodel.tsv``,
+            or to the same table converted by :func:`write_mecombo_index`.
+        chunk_size (int): number of cells processed in each chunk.
+    """
+    shutil.copyfile(nodes_file, output)
+    with open_population(output) as (group, size):
+        if mecombo_info is not None and ME_COMBO in group:
+            with _open_mecombo_index(mecombo_info, Path(output).parent) as index:
+                _add_me_info(group, size, index, chunk_size=chunk_size)
+        _write_library(group, "model_type", [model_type])
+        _append(_create_appendable(group, "model_type", np.uint32), np.zeros(size, np.uint32))
+
+
+@contextmanager
+def _open_mecombo_index(path, tmp_dir):
+    """Yield the index of the ME-combo table, converting the table to HDF5 if needed."""
+    with tempfile.TemporaryDirectory(dir=tmp_dir) as tmp:
+        if not h5py.is_hdf5(path):
+            L.info("Indexing the ME-combo table %s", path)
+            write_mecombo_index(path, Path(tmp, MECOMBO_INDEX_FILE))
+            path = Path(tmp, MECOMBO_INDEX_FILE)
+        with h5py.File(path, "r") as h5:
+            yield MEComboIndex(h5)
+
+
+def _me_combo_rows(group, index, start, stop):
+    """Return the rows of the ME-combo table corresponding to the cells in the given range."""
+    me_combos = read_strings(group, ME_COMBO, start, stop)
+    rows = index.find(me_combos)
+    if np.any(rows == -1):
+        missing = sorted(set(me_combos[rows == -1].tolist()))
+        raise ValueError(f"The me_combo :{missing} are missing from the e-model release")
+    return rows
+
+
+def _add_me_info(group, size, index, chunk_size):
+    templates = index.h5[f"{LIBRARY}/model_template"].asstr()[:]
+    _write_library(group, "model_template", templates.tolist())
+    template_dataset = _create_appendable(group, "model_template", np.uint32)
+    params_names = list(index.h5.get(DYNAMICS_PARAMS, {}))
+    params_datasets = {
+        name: _create_appendable(group.require_group(DYNAMICS_PARAMS), name, np.float64)
+        for name in params_names
+    }
+    for start, stop in _chunks(size, chunk_size):
+        rows = _me_combo_rows(group, index, start, stop)
+        _append(template_dataset, index.take("model_template", rows))
+        for name in params_names:
+            _append(params_datasets[name], index.take(f"{DYNAMICS_PARAMS}/{name}", rows))
+
+
+@click.group()
+def main():
+    """Assign the emodels and the ME info to the SONATA nodes, processing the cells in chunks."""
+    logging.basicConfig(level=logging.INFO, format="[circuit-build] %(message)s")
+
+
+@main.command("assign-emodels")
+@click.argument("nodes_file", type=click.Path(exists=True, dir_okay=False))
+@click.option("--morphdb", required=True, type=click.Path(exists=True, dir_okay=False))
+@click.option("--seed", type=int, default=0, help="Pseudo-random generator seed.")
+@click.option("--chunk-size", type=click.IntRange(min=1), default=DEFAULT_CHUNK_SIZE)
+@click.option("-o", "--output", required=True, type=click.Path(dir_okay=False))
+def assign_emodels_cmd(nodes_file, morphdb, seed, chunk_size, output):
+    """Assign the me_combo property to the cells in NODES_FILE."""
+    assign_emodels(nodes_file, morphdb, output, seed=seed, chunk_size=chunk_size)
+
+
+@main.command("provide-me-info")
+@click.argument("nodes_file", type=click.Path(exists=True, dir_okay=False))
+@click.option("--mecombo-info", type=click.Path(exists=True, dir_okay=False))
+@click.option("--model-type", default="biophysical")
+@click.option("--chunk-size", type=click.IntRange(min=1), default=DEFAULT_CHUNK_SIZE)
+@click.option("-o", "--output", required=True, type=click.Path(dir_okay=False))
+def provide_me_info_cmd(nodes_file, mecombo_info, model_type, chunk_size, output):
+    """Provide the cells in NODES_FILE with the ME info."""
+    provide_me_info(
+        nodes_file, output, model_type=model_type, mecombo_info=mecombo_info, chunk_size=chunk_size
+    )
+
+
+@main.command("index-mecombo")
+@click.argument("mecombo_info", type=click.Path(exists=True, dir_okay=False))
+@click.option("-o", "--output", required=True, type=click.Path(dir_okay=False))
+def index_mecombo_cmd(mecombo_info, output):
+    """Convert the ME-combo table MECOMBO_INFO to HDF5, indexed by combo name."""
+    write_mecombo_index(mecombo_info, output)
+
+
+if __name__ == "__main__":  # pragma: no cover
+    main()
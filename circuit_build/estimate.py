@@ -0,0 +1,307 @@
+"""Estimate the resources needed to build a circuit, without executing the workflow.
+
+The number of cells is computed from the densities in ``cell_composition.yaml`` and from the volume
+of the atlas regions, and it's used to evaluate the scaling models of the rules executed to build
+the target, giving the estimated runtime, memory and output size of each job.
+
+The runtime and the output size of the models can be calibrated with the metrics recorded
+in the directories of the circuits already built, and with the number of cells of each circuit.
+"""
+
+import importlib.resources
+import json
+import math
+from collections import defaultdict
+from pathlib import Path
+
+import h5py
+import numpy as np
+import yaml
+
+from circuit_build.atlas import RegionMap, atlas_file, read_nrrd, voxel_volume
+from circuit_build.constants import CORES_PER_NODE, PACKAGE_NAME
+from circuit_build.metrics import METRICS_FILE, combine_job_events, load_events
+from circuit_build.utils import load_yaml
+from circuit_build.validators import validate_config
+
+SCALING_MODELS_FILE = "snakemake/scaling_models.yaml"
+CIRCUIT_CONFIG = "sonata/circuit_config.json"  # in the circuit dir
+SAFETY_FACTOR = 2.0
+MIN_TIME = 600  # minimum time in seconds requested for the allocations
+TIME_STEP = 300  # the time requested for the allocations is rounded up to a multiple of this
+
+
+def count_cells(atlas_dir, composition, region=None, mask=None, density_factor=1.0):
+    """Return the estimated number of cells placed in the atlas.
+
+    Args:
+        atlas_dir (str|Path): path to the atlas directory.
+        composition (dict): content of ``cell_composition.yaml``.
+        region (str): optional region to populate, as defined in MANIFEST.yaml.
+        mask (str): optional mask to apply, as defined in MANIFEST.yaml.
+        density_factor (float): factor applied to the densities.
+    """
+    header, brain_regions = read_nrrd(Path(atlas_dir, "brain_regions.nrrd"))
+    with open(Path(atlas_dir, "hierarchy.json"), encoding="utf-8") as fd:
+        region_map = RegionMap(json.load(fd))
+
+    def _select(region):
+        return np.isin(brain_regions, list(region_map.find(region)))
+
+    selected = _select(region) if region else np.ones(brain_regions.shape, dtype=bool)
+    if mask:
+        selected &= read_nrrd(atlas_file(atlas_dir, mask))[1] != 0
+    cells = 0.0
+    for item in composition["neurons"]:
+        voxels = selected & _select(item["region"])
+        if isinstance(item["density"], str):
+            density = read_nrrd(atlas_file(atlas_dir, item["density"]))[1]
+            cells += float(density[voxels].sum())
+        else:
+            cells += float(item["density"]) * np.count_nonzero(voxels)
+    return int(round(cells * voxel_volume(header) * density_factor))
+
+
+def load_scaling_models(path=None):
+    """Return the default scaling models, updated with the models in the given file if any."""
+    resource = importlib.resources.files(PACKAGE_NAME) / SCALING_MODELS_FILE
+    models = yaml.safe_load(resource.read_text())["models"]
+    if path:
+        custom = load_yaml(path)
+        validate_config(custom, "scaling_models.yaml")
+        models.update(custom["models"])
+    return models
+
+
+def count_built_cells(circuit_dir):
+    """Return the number of biophysical cells in the circuit built in the given directory.
+
+    The circuit config isn't validated, so that it can be read also if the circuit is incomplete.
+    """
+    config_file = Path(circuit_dir, CIRCUIT_CONFIG).resolve()
+    config = json.loads(config_file.read_text(encoding="utf-8"))
+    base_dir = config_file.parent / config.get("manifest", {}).get("$BASE_DIR", ".")
+    cells = 0
+    for entry in config["networks"]["nodes"]:
+        nodes_file = config_file.parent / entry["nodes_file"].replace("$BASE_DIR", str(base_dir))
+        for name, population in entry["populations"].items():
+            if population.get("type") == "biophysical":
+                with h5py.File(nodes_file, "r") as h5:
+                    cells += len(h5[f"nodes/{name}/node_type_id"])
+    return cells
+
+
+def calibration_samples(circuit_dir, cells=None):
+    """Return a dict {rule: [(cells per job, job)]} with the successful jobs in the metrics file.
+
+    The cells are assumed to be equally divided among the partitions of the partitioned rules,
+    identified by the partition recorded in the metrics, while the other jobs process all the cells,
+    even when the rule is executed more times with different wildcards.
+
+    Args:
+        circuit_dir (str|Path): directory of the circuit, containing ``logs/metrics.jsonl``.
+        cells (int): number of cells of the circuit, or None to count the cells of the circuit.
+    """
+    cells = count_built_cells(circuit_dir) if cells is None else cells
+    jobs = combine_job_events(load_events([Path(circuit_dir, "logs", METRICS_FILE)]))
+    partitions = defaultdict(set)
+    for job in jobs:
+        if job["partition"] is not None:
+            partitions[job["rule"]].add(job["partition"])
+    result = defaultdict(list)
+    for job in jobs:
+        if job["exit_status"] == 0 and job["runtime"] is not None:
+            job_cells = cells / len(partitions[job["rule"]]) if job["partition"] else cells
+            result[job["rule"]].append((job_cells, job))
+    return dict(result)
+
+
+def _round(value):
+    return float(f"{value:.4g}")
+
+
+def fit_term(term, points):
+    """Return the term fitted to the given points (cells, value), keeping the exponent.
+
+    The base and the coefficient are fitted with the least squares if the points have
+    different numbers of cells, otherwise only the coefficient is fitted.
+    Both of them are constrained to be non-negative.
+    """
+    term = term or {}
+    exponent = term.get("exponent", 1)
+    x = np.array([(cells / 1e6) ** exponent for cells, _ in points], dtype=float)
+    y = np.array([value for _, value in points], dtype=float)
+    if len(np.unique(x)) > 1:
+        coefficient, base = np.polyfit(x, y, 1)
+    else:
+        base = min(term.get("base", 0), y.mean())
+        coefficient = (y.mean() - base) / x.mean() if x.mean() > 0 else 0
+    if coefficient < 0:
+        coefficient, base = 0, y.mean()
+    elif base < 0:
+        coefficient, base = (x @ y) / (x @ x), 0
+    result = {"base": _round(base), "coefficient": _round(coefficient)}
+    if exponent != 1:
+        result["exponent"] = exponent
+    return result
+
+
+def calibrate_models(models, samples):
+    """Return the scaling models with the runtime and the output size fitted to the samples.
+
+    The memory isn't recorded in the metrics, so it's not calibrated.
+
+    Args:
+        models (dict): scaling models to be calibrated.
+        samples (list): list of dicts returned by :func:`calibration_samples`.
+    """
+    points = defaultdict(list)
+    for sample in samples:
+        for rule, values in sample.items():
+            points[rule] += values
+    result = dict(models)
+    for rule, values in points.items():
+        if rule not in models:
+            continue
+        model = dict(models[rule])
+        model["runtime"] = fit_term(model["runtime"], [(c, job["runtime"]) for c, job in values])
+        sizes = [(c, job["output_size"]) for c, job in values if job["output_size"] is not None]
+        if sizes:
+            model["output_size"] = fit_term(model.get("output_size"), sizes)
+        result[rule] = model
+    return result
+
+
+def planned_rules(ctx, target="functional"):
+    """Return the list of rules that would be executed to build the target from scratch.
+
+    Only the rules with a scaling model are considered, while the local rules are ignored.
+    """
+    rules = ["place_cells"]
+    if ctx.SYNTHESIZE:
+        rules += ["synthesize_morphologies"]
+        if not ctx.NO_EMODEL:
+            rules += ["assign_synthesis_emodels", "adapt_emodels", "compute_currents"]
+    else:
+        rules += ["choose_morphologies", "assign_morphologies", "assign_emodels", "provide_me_info"]
+    rules += ["node_sets", "touchdetector", "touch2parquet"]
+    rules += ["spykfunc_s2f" if target == "functional" else "spykfunc_s2s"]
+    rules += ctx.if_partition(["spykfunc_merge"], [])
+    rules += ["parquet_to_sonata"]
+    rules += ctx.if_no_index([], ["spatial_index_segment", "spatial_index_synapse"])
+    return rules
+
+
+def _evaluate(model, cells):
+    """Evaluate a term of the scaling model for the given number of cells."""
+    if not model:
+        return None
+    base = model.get("base", 0)
+    return base + model.get("coefficient", 0) * (cells / 1e6) ** model.get("exponent", 1)
+
+
+def estimate_rule(rule, model, cells, partitions=1, cores_per_node=CORES_PER_NODE):
+    """Return a dict with the estimated resources of a rule.
+
+    When the rule is partitioned, the cells are assumed to be equally divided among the partitions.
+    """
+    jobs = partitions if model.get("partitioned") else 1
+    cells_per_job = cells / jobs
+    if "nodes" in model:
+        cores = model["nodes"] * cores_per_node
+    else:
+        cores = model.get("tasks", 1) * model.get("cpus_per_task", 1)
+    runtime = _evaluate(model["runtime"], cells_per_job)
+    output_size = _evaluate(model.get("output_size"), cells_per_job)
+    return {
+        "rule": rule,
+        "jobs": jobs,
+        "cells": int(cells_per_job),
+        "runtime": runtime,
+        "memory": _evaluate(model.get("memory"), cells_per_job),
+        "cores": cores,
+        "core_hours": jobs * cores * runtime / 3600,
+        "output_size": jobs * output_size if output_size is not None else None,
+    }
+
+
+def estimate(ctx, cells, models, target="functional", cores_per_node=CORES_PER_NODE):
+    """Return a list of dicts with the estimated resources of the rules needed for the target."""
+    partitions = len(ctx.PARTITION) or 1
+    return [
+        estimate_rule(rule, models[rule], cells, partitions, cores_per_node)
+        for rule in planned_rules(ctx, target=target)
+        if rule in models
+    ]
+
+
+def _format_time(seconds):
+    seconds = int(seconds)
+    return f"{seconds // 3600}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}"
+
+
+def suggest_salloc(model, row, partition="prod", safety_factor=SAFETY_FACTOR):
+    """Return the suggested parameters for ``salloc``, from the estimated resources of a rule."""
+    time = max(MIN_TIME, math.ceil(row["runtime"] * safety_factor / TIME_STEP) * TIME_STEP)
+    args = ["-A ${{SALLOC_ACCOUNT}}", f"-p {partition}"]
+    if "nodes" in model:
+        args += [f"-N{model['nodes']}", "--exclusive", "--mem 0"]
+    else:
+        tasks, cpus = model.get("tasks", 1), model.get("cpus_per_task", 1)
+        args += [f"-n{tasks}"] + ([f"-c{cpus}"] if cpus > 1 else [])
+        if row["memory"] is not None:
+            memory = row["memory"] * safety_factor
+            if tasks * cpus == 1:
+                args += [f"--mem {math.ceil(memory)}G"]
+            else:
+                args += [f"--mem-per-cpu {math.ceil(memory * 1024 / (tasks * cpus))}M"]
+    if model.get("salloc"):
+        args += [model["salloc"]]
+    args += [f"--time {_format_time(time)}"]
+    return " ".join(args)
+
+
+def suggest_cluster_config(rows, models, cluster_config=None, **kwargs):
+    """Return the suggested cluster configuration.
+
+    The existing configuration of the rules is preserved, except for the ``salloc`` parameters.
+    """
+    result = dict(cluster_config or {})
+    for row in rows:
+        rule = row["rule"]
+        result[rule] = {
+            **result.get(rule, {}),
+            "salloc": suggest_salloc(models[rule], row, **kwargs),
+        }
+    validate_config(result, "cluster.yaml")
+    return result
+
+
+def format_rows(rows):
+    """Return the estimated resources with the values formatted as strings, including the total."""
+    result = [
+        {
+            "rule": row["rule"],
+            "jobs": str(row["jobs"]),
+            "cells_per_job": str(row["cells"]),
+            "runtime": _format_time(row["runtime"]),
+            "memory": f"{row['memory']:.1f}GB" if row["memory"] is not None else None,
+            "cores": str(row["cores"]),
+            "core_hours": f"{row['core_hours']:.1f}",
+            "output_size": row["output_size"],
+        }
+        for row in rows
+    ]
+    result.append(
+        {
+            "rule": "total",
+            "jobs": str(sum(row["jobs"] for row in rows)),
+            "cells_per_job": None,
+            "runtime": None,
+            "memory": None,
+            "cores": None,
+            "core_hours": f"{sum(row['core_hours'] for row in rows):.1f}",
+            "output_size": sum(row["output_size"] or 0 for row in rows),
+        }
+    )
+    return result
@@ -0,0 +1,230 @@
+"""Helpers to manage the work directory of functionalizer, used by the spykfunc rules.
+
+Functionalizer writes the checkpoints of the filters in its work directory, and it resumes from
+them when it's executed again with the same work directory. To avoid reusing checkpoints that
+are not valid anymore, a fingerprint of the arguments and of the input files is saved in the work
+directory, and the checkpoints are reused only if the fingerprint of the new run is the same.
+
+The previous work directory is not deleted when the checkpoints cannot be reused, but it's moved
+aside, and removed together with the current work directory only after the run succeeded.
+
+The module provides also the tuning of the Spark properties, derived from the size of the input
+data and from the Slurm allocation of the rule, parsed with ``circuit_build.utils.parse_salloc``.
+"""
+
+import hashlib
+import json
+import logging
+import math
+import shlex
+import shutil
+import sys
+import time
+from pathlib import Path
+
+import click
+
+from circuit_build.constants import (
+    SPARK_EXECUTOR_CORES,
+    SPARK_PARTITION_SIZE_MB,
+    SPARK_PARTITIONS_PER_CORE,
+)
+from circuit_build.parquet_stats import input_data_size
+from circuit_build.utils import parse_salloc
+
+L = logging.getLogger(__name__)
+
+FINGERPRINT_FILE = "circuit_build_fingerprint.json"
+CHECKPOINTS_DIR = "_checkpoints"  # default checkpoints directory inside the work dir
+STALE_SUFFIX = ".stale"
+CHECKPOINTS_RESUME = "resume"
+CHECKPOINTS_OVERWRITE = "overwrite"
+SPARK_PROPERTY_OPTION = "--spark-property"
+IGNORED_OPTIONS = {SPARK_PROPERTY_OPTION, "--work-dir", "--output-dir"}
+SUCCESS_FILE = "_SUCCESS"  # marker written by Spark in the completed output directories
+
+
+def compute_fingerprint(args):
+    """Return the fingerprint of the given arguments and of the files they refer to.
+
+    For the arguments that are existing files, the size and the modification time are considered.
+    The directories are considered only by their path, because their modification time changes
+    whenever a file is created in them, and their content may be very large. The Parquet files
+    are passed to functionalizer as single files, and the directories written by Spark are
+    considered by the modification time of their ``_SUCCESS`` marker.
+    The Spark properties and the work and output directories are ignored.
+    """
+    items = []
+    # the Spark properties don't affect the checkpoints, and they may change with the allocation,
+    # while the work and output directories are modified by the run itself
+    args = [
+        arg
+        for prev, arg in zip([None, *args], args)
+        if not {prev, arg.partition("=")[0]}.intersection(IGNORED_OPTIONS)
+    ]
+    for arg in args:
+        item = {"arg": arg}
+        try:
+            path = Path(arg)
+            if path.is_dir():
+                path = path / SUCCESS_FILE
+            stat = path.stat()
+        except (OSError, ValueError):
+            pass
+        else:
+            if path.is_file():
+                item["mtime"] = stat.st_mtime
+                item["size"] = stat.st_size
+        items.append(item)
+    return hashlib.sha256(json.dumps(items).encode()).hexdigest()
+
+
+def list_checkpoints(work_dir):
+    """Return the sorted list of checkpoints found in the work directory."""
+    checkpoints_dir = Path(work_dir, CHECKPOINTS_DIR)
+    if not checkpoints_dir.is_dir():
+        return []
+    return sorted(path.name for path in checkpoints_dir.iterdir())
+
+
+def prepare_work_dir(work_dir, args, overwrite=False):
+    """Prepare the work directory, and return True if the existing checkpoints can be reused.
+
+    Args:
+        work_dir (str|Path): path to the work directory of functionalizer.
+        args (list): arguments passed to functionalizer, used to compute the fingerprint.
+        overwrite (bool): if True, never reuse the existing checkpoints.
+    """
+    work_dir = Path(work_dir)
+    fingerprint_file = work_dir / FINGERPRINT_FILE
+    fingerprint = compute_fingerprint(args)
+    if work_dir.exists():
+        previous = fingerprint_file.read_text(encoding="utf-8") if fingerprint_file.exists() else ""
+        if not overwrite and previous == fingerprint:
+            L.info("Resuming from the checkpoints: %s", list_checkpoints(work_dir) or "none")
+            return True
+        stale = work_dir.with_name(f"{work_dir.name}{STALE_SUFFIX}.{time.time_ns()}")
+        reason = "overwrite requested" if overwrite else "fingerprint changed"
+        L.info("Moving the work dir to %s (%s)", stale, reason)
+        work_dir.rename(stale)
+    work_dir.mkdir(parents=True)
+    fingerprint_file.write_text(fingerprint, encoding="utf-8")
+    return False
+
+
+def clean_work_dir(work_dir):
+    """Remove the work directory and the stale work directories moved aside."""
+    work_dir = Path(work_dir)
+    for path in [work_dir, *work_dir.parent.glob(f"{work_dir.name}{STALE_SUFFIX}.*")]:
+        L.info("Removing %s", path)
+        shutil.rmtree(path, ignore_errors=True)
+
+
+def build_checkpoints_cmd(cmd, work_dir, args, mode=CHECKPOINTS_RESUME):
+    """Return a command string preparing the work dir before the command, and cleaning it after.
+
+    Args:
+        cmd (str): command executing functionalizer.
+        work_dir (str): path to the work directory, or placeholder to be formatted by Snakemake.
+        args (list): arguments passed to functionalizer, used to compute the fingerprint.
+        mode (str): ``resume`` to reuse the compatible checkpoints, or ``overwrite``.
+    """
+    helper = f"{shlex.quote(sys.executable)} -m {__name__}"
+    overwrite = " --overwrite" if mode == CHECKPOINTS_OVERWRITE else ""
+    return (
+        f"{helper} prepare{overwrite} {work_dir} -- {' '.join(map(str, args))} && "
+        f"( {cmd} ) && "
+        f"{helper} clean {work_dir}"
+    )
+
+
+def tune_spark_properties(data_size, nodes, cores_per_node, memory_per_node):
+    """Return a dict of Spark properties tuned for the data size and the allocation.
+
+    Args:
+        data_size (int): size in bytes of the input data.
+        nodes (int): number of nodes.
+        cores_per_node (int): number of cores available in each node.
+        memory_per_node (float): memory in GB available in each node.
+    """
+    executor_cores = min(SPARK_EXECUTOR_CORES, cores_per_node)
+    executors_per_node = max(1, cores_per_node // executor_cores)
+    # leave 10% of the memory to the system, and 10% of each executor to the memory overhead
+    executor_memory = max(1, math.floor(memory_per_node * 0.9 / executors_per_node / 1.1))
+    total_cores = nodes * executors_per_node * executor_cores
+    partitions = max(
+        SPARK_PARTITIONS_PER_CORE * total_cores,
+        math.ceil(data_size / (SPARK_PARTITION_SIZE_MB * 1024**2)),
+    )
+    # use a multiple of the number of cores to avoid idle cores in the last wave of tasks
+    partitions = math.ceil(partitions / total_cores) * total_cores
+    return {
+        "spark.sql.shuffle.partitions": str(partitions),
+        "spark.executor.cores": str(executor_cores),
+        "spark.executor.memory": f"{executor_memory}g",
+    }
+
+
+def tune_rule_spark_properties(rule, salloc, input_dirs, statistics_files=()):
+    """Return a dict of Spark properties tuned for the input data and the allocation of the rule.
+
+    Args:
+        rule (str): name of the rule.
+        salloc (str): salloc parameters of the rule in the cluster config.
+        input_dirs (list): directories containing the input Parquet files.
+        statistics_files (list): statistics files written by the ``touch_statistics`` rule.
+    """
+    allocation = parse_salloc(salloc)
+    data_size = input_data_size(input_dirs, statistics_files)
+    tuned = tune_spark_properties(
+        data_size,
+        **{k: allocation[k] for k in ["nodes", "cores_per_node", "memory_per_node"]},
+    )
+    L.info(
+        "Tuned Spark properties for %s with %s bytes of input data and allocation %s: %s",
+        rule,
+        data_size,
+        allocation,
+        tuned,
+    )
+    return tuned
+
+
+def merge_spark_properties(tuned, explicit):
+    """Return the list of Spark properties, where the explicit properties override the tuned ones.
+
+    Args:
+        tuned (dict): tuned Spark properties.
+        explicit (list): explicit Spark properties, as strings in the format ``key=value``.
+    """
+    result = dict(tuned)
+    for prop in explicit:
+        key, _, value = prop.partition("=")
+        result[key] = value
+    return [f"{key}={value}" for key, value in result.items()]
+
+
+@click.group()
+def main():
+    """Manage the work directory of functionalizer."""
+    logging.basicConfig(level=logging.INFO, format="[circuit-build] %(message)s")
+
+
+@main.command()
+@click.option("--overwrite", is_flag=True, help="Do not reuse the existing checkpoints.")
+@click.argument("work_dir", type=click.Path(file_okay=False))
+@click.argument("args", nargs=-1)
+def prepare(work_dir, args, overwrite):
+    """Prepare WORK_DIR for functionalizer executed with ARGS."""
+    prepare_work_dir(work_dir, args, overwrite=overwrite)
+
+
+@main.command()
+@click.argument("work_dir", type=click.Path(file_okay=False))
+def clean(work_dir):
+    """Remove WORK_DIR and the stale work directories, after functionalizer succeeded."""
+    clean_work_dir(work_dir)
+
+
+if __name__ == "__main__":  # pragma: no cover
+    main()
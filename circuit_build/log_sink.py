@@ -0,0 +1,255 @@
+"""Log sink used to cap, rotate and compress the output of the commands executed by the rules.
+
+The output of the command is read from stdin and written to the log file, that contains:
+
+- the whole output, if its size doesn't exceed ``max_size``, or
+- only the head and the tail of the output, separated by a truncation marker.
+
+In the latter case, the full output is written also to compressed segments next to the log file,
+rotated every ``segment_size`` bytes of uncompressed output, so that it can be recovered with::
+
+    zstdcat <logfile>.full.*.zst  # or zcat <logfile>.full.*.gz
+
+A filtered summary containing only the lines about progress and errors is sent to stderr,
+so that it's displayed by the controlling Snakemake process.
+"""
+
+import gzip
+import re
+import shlex
+import signal
+import sys
+from collections import deque
+from pathlib import Path
+
+import click
+
+from circuit_build.constants import (
+    LOG_SINK_COMPRESSION,
+    LOG_SINK_MAX_SIZE_MB,
+    LOG_SINK_SEGMENT_SIZE_MB,
+)
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None
+
+MB = 1024**2
+SUMMARY_PATTERN = re.compile(
+    rb"error|exception|traceback|fatal|killed|warning|\b\d{1,3}(\.\d+)?\s?%",
+    re.IGNORECASE,
+)
+# lines printed by ``set -x`` are excluded from the summary
+XTRACE_PATTERN = re.compile(rb"^\++ ")
+SUMMARY_MAX_LINE_LENGTH = 500
+COMPRESSION_EXTENSIONS = {"zstd": "zst", "gzip": "gz"}
+
+
+def _open_compressed(path, compression):
+    """Open and return a compressed binary file for writing."""
+    if compression == "zstd":
+        return zstandard.ZstdCompressor().stream_writer(open(path, "wb"), closefd=True)
+    return gzip.open(path, "wb")
+
+
+class LogSink:
+    """Write the output of a command to a log file with a capped size."""
+
+    def __init__(
+        self,
+        path,
+        *,
+        max_size,
+        segment_size,
+        compression=LOG_SINK_COMPRESSION,
+        summary=None,
+        tee=None,
+    ):
+        """Initialize the object.
+
+        Args:
+            path (str|Path): path to the plain log file.
+            max_size (int): maximum size in bytes of the plain log file, head and tail included.
+            segment_size (int): size in bytes of uncompressed output in each compressed segment.
+            compression (str): compression of the segments, ``zstd`` or ``gzip``.
+                If ``zstandard`` is not installed, ``gzip`` is used.
+            summary (io.BufferedWriter): binary stream where the summary lines are written.
+            tee (io.BufferedWriter): binary stream where all the lines are written.
+        """
+        if compression == "zstd" and zstandard is None:
+            compression = "gzip"
+        self.path = Path(path)
+        self.head_size = max_size // 2
+        self.tail_size = max_size - self.head_size
+        self.segment_size = segment_size
+        self.compression = compression
+        self.summary = summary
+        self.tee = tee
+        self.truncated = 0
+        self._plain = open(self.path, "wb")  # pylint: disable=consider-using-with
+        self._head_bytes = 0
+        self._tail = deque()
+        self._tail_bytes = 0
+        self._segment = None
+        self._segment_bytes = 0
+        self._segment_paths = []
+
+    @property
+    def segment_paths(self):
+        """Return the list of paths to the compressed segments written so far."""
+        return list(self._segment_paths)
+
+    def _segment_path(self, index):
+        extension = COMPRESSION_EXTENSIONS[self.compression]
+        return self.path.with_name(f"{self.path.name}.full.{index:03d}.{extension}")
+
+    def _rotate(self):
+        if self._segment is not None:
+            self._segment.close()
+        path = self._segment_path(len(self._segment_paths))
+        self._segment = _open_compressed(path, self.compression)
+        self._segment_paths.append(path)
+        self._segment_bytes = 0
+
+    def _write_full(self, data):
+        if self._segment is None or self._segment_bytes >= self.segment_size:
+            self._rotate()
+        self._segment.write(data)
+        self._segment_bytes += len(data)
+
+    def _start_full(self):
+        """Start writing the full output, beginning with the head already in the plain log."""
+        self._plain.flush()
+        self._write_full(self.path.read_bytes())
+        for line in self._tail:
+            self._write_full(line)
+
+    def _write_summary(self, line):
+        if self.tee is not None:
+            self.tee.write(line)
+            self.tee.flush()
+        elif (
+            self.summary is not None
+            and SUMMARY_PATTERN.search(line)
+            and not XTRACE_PATTERN.match(line)
+        ):
+            if len(line) > SUMMARY_MAX_LINE_LENGTH:
+                line = line[:SUMMARY_MAX_LINE_LENGTH] + b"...\n"
+            self.summary.write(line)
+            self.summary.flush()
+
+    def write(self, line):
+        """Write a line of output, given as bytes."""
+        self._write_summary(line)
+        if self._head_bytes < self.head_size:
+            self._plain.write(line)
+            self._head_bytes += len(line)
+            return
+        if self._segment is not None:
+            self._write_full(line)
+        self._tail.append(line)
+        self._tail_bytes += len(line)
+        while self._tail_bytes > self.tail_size:
+            if self._segment is None:
+                self._start_full()
+            dropped = self._tail.popleft()
+            self._tail_bytes -= len(dropped)
+            self.truncated += len(dropped)
+
+    def close(self):
+        """Write the tail of the output and close the files."""
+        if self._plain.closed:
+            return
+        if self.truncated:
+            pattern = self._segment_path(0).name.replace(".000.", ".*.")
+            self._plain.write(
+                f"\n[circuit-build] {self.truncated} bytes truncated, "
+                f"the full log is available in {pattern}\n\n".encode()
+            )
+        for line in self._tail:
+            self._plain.write(line)
+        self._plain.close()
+        if self._segment is not None:
+            self._segment.close()
+
+    def __enter__(self):
+        """Enter the context manager."""
+        return self
+
+    def __exit__(self, *args):
+        """Close the files when exiting the context manager."""
+        self.close()
+
+
+def build_log_sink_cmd(filename, log_config, tee=False):
+    """Return the command used to pipe the output of a command to the log sink.
+
+    Args:
+        filename (str): path to the log file, or placeholder to be formatted by Snakemake.
+        log_config (dict): log configuration for the rule, as defined in the cluster config.
+        tee (bool): if True, propagate all the output to stderr instead of the summary only.
+    """
+    args = [
+        shlex.quote(sys.executable),
+        "-m",
+        __name__,
+        "--max-size",
+        str(log_config.get("max_size", LOG_SINK_MAX_SIZE_MB)),
+        "--segment-size",
+        str(log_config.get("segment_size", LOG_SINK_SEGMENT_SIZE_MB)),
+        "--compression",
+        log_config.get("compression", LOG_SINK_COMPRESSION),
+    ]
+    if not log_config.get("summary", True):
+        args.append("--no-summary")
+    if tee:
+        args.append("--tee")
+    args.append(filename)
+    return " ".join(args)
+
+
+@click.command()
+@click.option(
+    "--max-size",
+    type=click.IntRange(min=1),
+    default=LOG_SINK_MAX_SIZE_MB,
+    show_default=True,
+    help="Maximum size in MB of the plain log file.",
+)
+@click.option(
+    "--segment-size",
+    type=click.IntRange(min=1),
+    default=LOG_SINK_SEGMENT_SIZE_MB,
+    show_default=True,
+    help="Size in MB of uncompressed output in each compressed segment.",
+)
+@click.option(
+    "--compression",
+    type=click.Choice(list(COMPRESSION_EXTENSIONS)),
+    default=LOG_SINK_COMPRESSION,
+    show_default=True,
+    help="Compression of the segments containing the full output.",
+)
+@click.option("--summary/--no-summary", default=True, help="Write the summary to stderr.")
+@click.option("--tee", is_flag=True, help="Write all the output to stderr.")
+@click.argument("log_file", type=click.Path(dir_okay=False))
+def main(log_file, max_size, segment_size, compression, summary, tee):
+    """Read the output of a command from stdin and write it to LOG_FILE."""
+    # ensure that the tail is written when the pipeline is terminated
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    stderr = sys.stderr.buffer
+    with LogSink(
+        log_file,
+        max_size=max_size * MB,
+        segment_size=segment_size * MB,
+        compression=compression,
+        summary=stderr if summary else None,
+        tee=stderr if tee else None,
+    ) as sink:
+        for line in sys.stdin.buffer:
+            sink.write(line)
+
+
+if __name__ == "__main__":  # pragma: no cover
+    main()  # pylint: disable=no-value-for-parameter
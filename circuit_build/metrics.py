@@ -0,0 +1,328 @@
+"""Metrics of the jobs executed by the rules, stored in an append-only JSONL file.
+
+Each line of the metrics file is a JSON object describing one event:
+
+- ``build_started`` and ``build_finished``, written by the hooks of the Snakefile.
+- ``job_queued``, written before the environment is prepared and the Slurm allocation requested,
+  with the partition processed by the job, if the rule is executed once for each partition.
+- ``job_finished``, written when the job is terminated, with the time when the command started
+  inside the allocation, the exit status, and the size of the outputs. The size of the output
+  directories is recorded only if the env variable ``CIRCUIT_BUILD_METRICS_DIR_SIZES`` is true.
+
+The events of the same job are identified by the build timestamp and by the path of the log file,
+and they can be combined and summarized across builds with ``circuit-build stats``.
+"""
+
+import json
+import os
+import shlex
+import socket
+import statistics
+import sys
+import time
+from collections import defaultdict
+from pathlib import Path
+
+import click
+
+METRICS_FILE = "metrics.jsonl"  # in the logs dir
+STARTED_SUFFIX = ".started"  # suffix of the file written when the command starts
+
+
+def append_event(path, event):
+    """Append an event to the metrics file.
+
+    The event is written with a single call to ``os.write`` on a file opened in append mode,
+    so that the events written concurrently by different jobs are not interleaved.
+
+    Args:
+        path (str|Path): path to the metrics file.
+        event (dict): event to be written, the current time is added if not specified.
+    """
+    event = {"time": time.time(), **event}
+    data = (json.dumps(event, separators=(",", ":")) + "\n").encode()
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, data)
+    finally:
+        os.close(fd)
+
+
+def load_events(paths):
+    """Return the list of events loaded from the given metrics files, ignoring invalid lines."""
+    events = []
+    for path in paths:
+        with open(path, "r", encoding="utf-8") as fd:
+            for line in fd:
+                try:
+                    event = json.loads(line)
+                except ValueError:
+                    # the last line may be incomplete if the writer has been killed
+                    continue
+                if isinstance(event, dict):
+                    events.append(event)
+    return events
+
+
+def _path_size(path, recursive=False):
+    """Return the size in bytes of a file, or of all the files in a directory if recursive."""
+    if path.is_dir():
+        if not recursive:
+            return None
+        return sum(p.stat().st_size for p in path.rglob("*") if p.is_file())
+    return path.stat().st_size
+
+
+def output_sizes(paths, recursive=False):
+    """Return a dict {path: size in bytes} of the existing outputs.
+
+    The size of the directories is None, unless ``recursive`` is True, because the outputs are
+    sized after every job, and walking a directory stats each file on the parallel filesystem.
+    """
+    result = {}
+    for path in map(Path, paths):
+        try:
+            result[str(path)] = _path_size(path, recursive=recursive)
+        except OSError:
+            continue
+    return result
+
+
+def build_metrics_cmd(cmd, metrics_file, log="{log}", partition=None):
+    """Return a command string recording the metrics of the given command.
+
+    The returned command preserves the exit code of the given command,
+    while any failure in recording the metrics is ignored.
+
+    Args:
+        cmd (str): command to be executed, already redirected to the log file.
+        metrics_file (str|Path): path to the metrics file.
+        log (str): path to the log file, or placeholder to be formatted by Snakemake.
+        partition (str): optional partition of the job, or placeholder to be formatted by Snakemake.
+    """
+    recorder = " ".join(
+        [
+            shlex.quote(sys.executable),
+            "-m",
+            __name__,
+            "--metrics-file",
+            shlex.quote(str(metrics_file)),
+        ]
+    )
+    queued_options = f"--partition {partition} " if partition else ""
+    return (
+        f"{recorder} job-queued {queued_options}{{rule}} {log} || :; "
+        f"( {cmd} ) && rc=0 || rc=$?; "
+        f"{recorder} job-finished --exit-status $rc {{rule}} {log} {{output}} || :; "
+        "exit $rc"
+    )
+
+
+def build_started_marker_cmd(cmd, log="{log}"):
+    """Return a command string writing the current time to a marker file before the command.
+
+    The marker is written inside the allocation, so it can be used to compute the allocation wait.
+    Any failure in writing the marker is ignored.
+    """
+    return f"( date +%s.%N >{log}{STARTED_SUFFIX} || : ) 2>/dev/null && {cmd}"
+
+
+def _job_key(event):
+    return event.get("build"), event.get("log")
+
+
+def combine_job_events(events):
+    """Combine the events of each job, and return a list of dicts with the metrics of the jobs.
+
+    The jobs not finished yet, or killed without recording the final event, have ``exit_status``
+    set to None.
+    """
+    jobs = {}
+    for event in events:
+        kind = event.get("event")
+        if kind not in ("job_queued", "job_finished"):
+            continue
+        job = jobs.setdefault(
+            _job_key(event),
+            {
+                "build": event.get("build"),
+                "rule": event.get("rule"),
+                "log": event.get("log"),
+                "partition": None,
+                "queued": None,
+                "started": None,
+                "finished": None,
+                "exit_status": None,
+                "output_size": None,
+            },
+        )
+        if kind == "job_queued":
+            job["queued"] = event.get("time")
+            job["partition"] = event.get("partition")
+        else:
+            job["started"] = event.get("started")
+            job["finished"] = event.get("time")
+            job["exit_status"] = event.get("exit_status")
+            sizes = list(event.get("outputs", {}).values())
+            job["output_size"] = None if None in sizes else sum(sizes)
+    for job in jobs.values():
+        queued, started, finished = job["queued"], job["started"], job["finished"]
+        job["allocation_wait"] = started - queued if None not in (queued, started) else None
+        start = started if started is not None else queued
+        job["runtime"] = finished - start if None not in (start, finished) else None
+    return sorted(jobs.values(), key=lambda job: (job["queued"] or job["finished"] or 0))
+
+
+def _mean(values):
+    values = [v for v in values if v is not None]
+    return statistics.mean(values) if values else None
+
+
+def _trend(jobs, last_build):
+    """Return the ratio between the mean runtime in the last build and in the previous builds."""
+    last_mean = _mean(job["runtime"] for job in jobs if job["build"] == last_build)
+    previous_mean = _mean(job["runtime"] for job in jobs if job["build"] != last_build)
+    return last_mean / previous_mean if last_mean and previous_mean else None
+
+
+def summarize_jobs(jobs, by_build=False):
+    """Return a list of dicts with the metrics aggregated by rule, or by build and rule.
+
+    When the metrics are aggregated by rule, the trend is the ratio between the mean runtime
+    of the rule in the last build, and the mean runtime of the rule in all the previous builds.
+    """
+    groups = defaultdict(list)
+    for job in jobs:
+        key = (job["build"], job["rule"]) if by_build else (None, job["rule"])
+        groups[key].append(job)
+    rows = []
+    for (build, rule), group in groups.items():
+        successful = [job for job in group if job["exit_status"] == 0]
+        builds = sorted({job["build"] for job in group})
+        row = {
+            "rule": rule,
+            "jobs": len(group),
+            "failed": sum(1 for job in group if job["exit_status"] not in (0, None)),
+            "runtime_mean": _mean(job["runtime"] for job in successful),
+            "runtime_max": max(
+                (job["runtime"] for job in successful if job["runtime"] is not None),
+                default=None,
+            ),
+            "allocation_wait_mean": _mean(job["allocation_wait"] for job in group),
+            "output_size_last": successful[-1]["output_size"] if successful else None,
+        }
+        if by_build:
+            row = {"build": build, **row}
+        else:
+            row["builds"] = len(builds)
+            row["trend"] = _trend(successful, last_build=builds[-1])
+        rows.append(row)
+    return sorted(rows, key=lambda row: (row.get("build") or "", row["rule"] or ""))
+
+
+def _format_value(key, value):
+    if value is None:
+        return "-"
+    if isinstance(value, str):
+        return value
+    if key.startswith(("runtime", "allocation_wait")):
+        return f"{value:.1f}s"
+    if key.startswith("output_size"):
+        for unit in ("B", "KB", "MB", "GB", "TB"):
+            if value < 1024 or unit == "TB":
+                return f"{value:.0f}{unit}" if unit == "B" else f"{value:.1f}{unit}"
+            value /= 1024
+    if key == "trend":
+        return f"x{value:.2f}"
+    return str(value)
+
+
+def format_table(rows):
+    """Return the given rows formatted as a text table."""
+    if not rows:
+        return "No metrics found"
+    columns = list(rows[0])
+    cells = [columns] + [[_format_value(k, row[k]) for k in columns] for row in rows]
+    widths = [max(len(line[i]) for line in cells) for i in range(len(columns))]
+    return "\n".join(
+        "  ".join(cell.ljust(width) for cell, width in zip(line, widths)).rstrip() for line in cells
+    )
+
+
+def _build_id(log):
+    """Return the build timestamp from the path of the log file."""
+    return Path(log).parent.name
+
+
+@click.group()
+@click.option(
+    "--metrics-file",
+    required=True,
+    type=click.Path(dir_okay=False),
+    help="Path to the metrics file.",
+)
+@click.pass_context
+def main(ctx, metrics_file):
+    """Record the metrics of the jobs."""
+    ctx.obj = metrics_file
+
+
+@main.command()
+@click.option("--partition", help="Partition processed by the job, if any.")
+@click.argument("rule")
+@click.argument("log")
+@click.pass_obj
+def job_queued(metrics_file, partition, rule, log):
+    """Record the event written before the job is executed."""
+    # remove any marker left by a previous attempt
+    Path(f"{log}{STARTED_SUFFIX}").unlink(missing_ok=True)
+    append_event(
+        metrics_file,
+        {
+            "event": "job_queued",
+            "build": _build_id(log),
+            "rule": rule,
+            "log": log,
+            "host": socket.gethostname(),
+            **({"partition": partition} if partition else {}),
+        },
+    )
+
+
+@main.command()
+@click.option("--exit-status", type=int, required=True, help="Exit status of the job.")
+@click.option(
+    "--dir-sizes",
+    is_flag=True,
+    envvar="CIRCUIT_BUILD_METRICS_DIR_SIZES",
+    help="Record the size of the output directories, summing the size of all their files.",
+)
+@click.argument("rule")
+@click.argument("log")
+@click.argument("outputs", nargs=-1)
+@click.pass_obj
+def job_finished(metrics_file, exit_status, dir_sizes, rule, log, outputs):
+    """Record the event written after the job is terminated."""
+    marker = Path(f"{log}{STARTED_SUFFIX}")
+    try:
+        started = float(marker.read_text(encoding="utf-8"))
+        marker.unlink()
+    except (OSError, ValueError):
+        started = None
+    append_event(
+        metrics_file,
+        {
+            "event": "job_finished",
+            "build": _build_id(log),
+            "rule": rule,
+            "log": log,
+            "started": started,
+            "exit_status": exit_status,
+            "outputs": output_sizes(outputs, recursive=dir_sizes),
+        },
+    )
+
+
+if __name__ == "__main__":  # pragma: no cover
+    main()  # pylint: disable=no-value-for-parameter
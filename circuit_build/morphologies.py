@@ -0,0 +1,110 @@
+"""Merge the synthesized morphologies into HDF5 morphology containers.
+
+A morphology container is a single HDF5 file with one group for each morphology, in the same
+format of the h5v1 files, that can be read by MorphIO and libsonata instead of a directory.
+Opening one large file instead of one file for each cell avoids the load on the metadata servers
+of the shared filesystems.
+
+When the morphologies are split in more shards, the container contains only external links
+to the groups in the shards, written in the same directory, so it can still be used as a single
+container by the consumers.
+"""
+
+import logging
+from pathlib import Path
+
+import click
+import h5py
+import numpy as np
+
+from circuit_build.utils import python_module_cmd
+
+L = logging.getLogger(__name__)
+
+MORPHOLOGY = "morphology"
+
+
+def helper_cmd():
+    """Return the command executing this module with the interpreter executing the workflow."""
+    return python_module_cmd(__name__)
+
+
+def morphology_names(nodes_file):
+    """Return the sorted unique names of the morphologies assigned to the nodes."""
+    with h5py.File(nodes_file, "r") as h5:
+        (population,) = h5["nodes"]
+        group = h5["nodes"][population]["0"]
+        if "@library" in group and MORPHOLOGY in group["@library"]:
+            return sorted(group["@library"][MORPHOLOGY].asstr()[:])
+        return sorted(set(group[MORPHOLOGY].asstr()[:]))
+
+
+def shard_path(output, index):
+    """Return the path to the shard with the given index, in the same directory of the container."""
+    output = Path(output)
+    return output.with_name(f"{output.stem}.{index:03d}{output.suffix}")
+
+
+def _link_create_properties():
+    """Return the link creation properties, creating the missing intermediate groups."""
+    lcpl = h5py.h5p.create(h5py.h5p.LINK_CREATE)
+    lcpl.set_create_intermediate_group(True)
+    return lcpl
+
+
+def _write_morphologies(output, names, morph_dir):
+    """Copy the h5 morphologies with the given names into the container ``output``."""
+    lcpl = _link_create_properties()
+    with h5py.File(output, "w") as dst:
+        for name in names:
+            with h5py.File(Path(morph_dir, f"{name}.h5"), "r") as src:
+                # copy the root group with the attributes of the morphology
+                h5py.h5o.copy(src.id, b"/", dst.id, name.encode(), lcpl=lcpl)
+
+
+def merge_morphologies(nodes_file, morph_dir, output, shards=1):
+    """Merge the h5 morphologies assigned to the nodes into one or more containers.
+
+    Args:
+        nodes_file (str|Path): path to the nodes file with the morphology property.
+        morph_dir (str|Path): directory containing the h5 morphologies.
+        output (str|Path): path to the morphology container.
+        shards (int): number of containers where the morphologies are written.
+            If greater than 1, ``output`` contains only the external links to the shards.
+    """
+    names = morphology_names(nodes_file)
+    if shards == 1:
+        _write_morphologies(output, names, morph_dir)
+        L.info("Merged %s morphologies into %s", len(names), output)
+        return
+    # contiguous blocks of sorted names, to keep the morphologies in the same subdir together
+    blocks = np.array_split(np.arange(len(names)), shards)
+    with h5py.File(output, "w") as h5:
+        for index, block in enumerate(blocks):
+            path = shard_path(output, index)
+            shard_names = [names[i] for i in block]
+            _write_morphologies(path, shard_names, morph_dir)
+            for name in shard_names:
+                # relative links, resolved from the directory of the container
+                h5[name] = h5py.ExternalLink(path.name, f"/{name}")
+    L.info("Merged %s morphologies into %s shards linked from %s", len(names), shards, output)
+
+
+@click.group()
+def main():
+    """Merge the synthesized morphologies into HDF5 morphology containers."""
+    logging.basicConfig(level=logging.INFO, format="[circuit-build] %(message)s")
+
+
+@main.command("merge")
+@click.argument("nodes_file", type=click.Path(exists=True, dir_okay=False))
+@click.option("--morph-dir", required=True, type=click.Path(exists=True, file_okay=False))
+@click.option("--shards", type=click.IntRange(min=1), default=1, help="Number of shards.")
+@click.option("-o", "--output", required=True, type=click.Path(dir_okay=False))
+def merge_cmd(nodes_file, morph_dir, shards, output):
+    """Merge the h5 morphologies of the cells in NODES_FILE into a morphology container."""
+    merge_morphologies(nodes_file, morph_dir, output, shards=shards)
+
+
+if __name__ == "__main__":  # pragma: no cover
+    main()
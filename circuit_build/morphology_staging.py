@@ -0,0 +1,207 @@
+"""Staging of the morphology release on the local storage of the nodes.
+
+The morphology directories of the release are packed once in an uncompressed tar archive in the
+auxiliary dir, with an index listing the offset and the size of each file. The jobs reading the
+morphologies extract the archive to the local storage of their node before executing the tool,
+so the parallel filesystem serves a single sequential read instead of the random access to many
+small files. The tasks of the same job running on the same node share the local copy.
+
+The local copy is found by the commands through the env variable ``STAGED_RELEASE_VAR``,
+exported by the staging command in the allocation of the job. The staging command uses only
+``sha256sum``, ``flock``, ``tar`` and ``sed``, because it's executed by each task in the
+environment of the tool, where the interpreter executing the workflow shouldn't be used.
+"""
+
+import json
+import logging
+import tarfile
+from dataclasses import dataclass
+from pathlib import Path
+
+import click
+
+from circuit_build.utils import python_module_cmd
+
+L = logging.getLogger(__name__)
+
+ARCHIVE_FILE = "morphology_release.tar"  # in the auxiliary dir
+INDEX_FILE = "morphology_release.json"  # in the auxiliary dir
+RELEASE_SUBDIRS = {"asc": "ascii", "swc": "swc", "h5": "h5v1"}
+STAGED_RELEASE_VAR = "CIRCUIT_BUILD_STAGED_MORPHOLOGIES"
+CONFIG_TEMPLATE_FILE = "circuit_config_hpc.staged.json"  # in the auxiliary dir
+STAGED_CIRCUIT_CONFIG = "circuit_config.json"  # in the local copy
+STAGED_RELEASE_PLACEHOLDER = "@CIRCUIT_BUILD_STAGED_MORPHOLOGIES@"  # in the config template
+# the braces are doubled because the commands are formatted by Snakemake
+STAGING_DIR = "${{TMPDIR:-/tmp}}/circuit-build-morphologies"
+
+
+@dataclass(frozen=True)
+class MorphologyStaging:
+    """Morphology release packed in the auxiliary dir, and staged by the jobs."""
+
+    release_dir: Path
+    archive_file: Path
+    index_file: Path
+    config_template_file: Path
+
+    @classmethod
+    def from_release(cls, release_dir, auxiliary_path):
+        """Return a new object, with the archive and the index in the auxiliary dir.
+
+        Args:
+            release_dir (str|Path): path to the morphology release.
+            auxiliary_path (callable): function returning a path in the auxiliary dir.
+        """
+        return cls(
+            release_dir=Path(release_dir),
+            archive_file=auxiliary_path(ARCHIVE_FILE),
+            index_file=auxiliary_path(INDEX_FILE),
+            config_template_file=auxiliary_path(CONFIG_TEMPLATE_FILE),
+        )
+
+    @staticmethod
+    def staged_path(*parts):
+        """Return the path to a file in the local copy, valid only in the staged commands."""
+        return Path(f"${STAGED_RELEASE_VAR}", *parts)
+
+    def stage_cmd(self, circuit_config=None):
+        """Return the command string staging the release, and exporting ``STAGED_RELEASE_VAR``.
+
+        The local copy is named after the digest of the index, so a different release is never
+        confused with a previous copy, and it's renamed only when it's complete. The archive is
+        extracted only once on each node, holding an exclusive lock on a file next to the copy.
+
+        Args:
+            circuit_config (str): optional template written by :func:`write_staged_config`,
+                copied in the local copy after replacing ``STAGED_RELEASE_PLACEHOLDER``.
+        """
+        # the local storage is limited, so an incomplete copy isn't kept
+        extract = (
+            'rm -rf "$local_dir.partial" && mkdir "$local_dir.partial" && '
+            f'{{{{ tar -xf {self.archive_file} -C "$local_dir.partial" && '
+            'mv "$local_dir.partial" "$local_dir" || '
+            '{{ rm -rf "$local_dir.partial"; exit 1; }}; }} && '
+            'echo "Staged the morphology release in $local_dir" >&2'
+        )
+        config = ""
+        if circuit_config:
+            staged_config = f'"$local_dir/{STAGED_CIRCUIT_CONFIG}"'
+            # the tasks on the same node write the same content, so the last one wins
+            config = (
+                f'sed "s|{STAGED_RELEASE_PLACEHOLDER}|$local_dir|g" {circuit_config} '
+                f">{staged_config}.$$ && mv -f {staged_config}.$$ {staged_config} && "
+            )
+        return (
+            f"{STAGED_RELEASE_VAR}=$("
+            f"local_dir={STAGING_DIR}/$(sha256sum {self.index_file} | cut -c1-16) && "
+            'mkdir -p "${{local_dir%/*}}" && '
+            f'( flock 9 && if [ ! -d "$local_dir" ]; then {extract}; fi ) 9>"$local_dir.lock" && '
+            f'{config}echo "$local_dir") && '
+            f"export {STAGED_RELEASE_VAR} &&"
+        )
+
+    def pack_cmd(self):
+        """Return the command string packing the release."""
+        helper = python_module_cmd(__name__)
+        return (
+            f"{helper} pack --release-dir {self.release_dir} "
+            f"--archive {self.archive_file} --index {self.index_file}"
+        )
+
+
+def staged_inputs(staging, circuit_config=False):
+    """Return a dict with the inputs needed to stage the release, or an empty dict.
+
+    If ``circuit_config`` is True, the template of the staged circuit config is included
+    as ``staged_circuit_config``.
+    """
+    if not staging:
+        return {}
+    result = {"morphology_archive": staging.archive_file, "morphology_index": staging.index_file}
+    if circuit_config:
+        result["staged_circuit_config"] = staging.config_template_file
+    return result
+
+
+def with_staged_release(staging, cmd, circuit_config=None):
+    """Return the command staging the release before the given command, as a list of strings.
+
+    The same command is returned if the release isn't staged.
+    """
+    return [staging.stage_cmd(circuit_config), *cmd] if staging else cmd
+
+
+def pack_release(release_dir, archive_file, index_file):
+    """Pack the morphology directories of the release, and write the index.
+
+    The symbolic links are followed, so that the local copy doesn't depend on the release.
+    """
+    release_dir = Path(release_dir)
+    subdirs = sorted(s for s in set(RELEASE_SUBDIRS.values()) if (release_dir / s).is_dir())
+    if not subdirs:
+        raise ValueError(f"No morphology directory found in {release_dir}")
+    with tarfile.open(archive_file, "w", dereference=True) as tar:
+        for subdir in subdirs:
+            tar.add(release_dir / subdir, arcname=subdir)
+    with tarfile.open(archive_file) as tar:
+        files = [[m.name, m.offset_data, m.size] for m in tar if m.isfile()]
+    index = {
+        "release_dir": str(release_dir),
+        "subdirs": subdirs,
+        "size": sum(size for _, _, size in files),
+        "files": files,
+    }
+    Path(index_file).write_text(json.dumps(index), encoding="utf-8")
+    L.info("Packed %s files from %s in %s", len(files), release_dir, archive_file)
+    return index
+
+
+def _replace_release(value, release_dir, local_dir):
+    """Return the value with the paths in the release replaced by the paths in the local copy."""
+    if isinstance(value, dict):
+        return {k: _replace_release(v, release_dir, local_dir) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_replace_release(v, release_dir, local_dir) for v in value]
+    if isinstance(value, str) and Path(value).is_relative_to(release_dir):
+        return str(local_dir / Path(value).relative_to(release_dir))
+    return value
+
+
+def write_staged_config(circuit_config, release_dir, out, local_dir=STAGED_RELEASE_PLACEHOLDER):
+    """Write a copy of the circuit config using the morphologies in the local copy.
+
+    By default, the paths to the local copy start with ``STAGED_RELEASE_PLACEHOLDER``, replaced
+    by the staging command when the local copy is known.
+    The paths relative to the original config are kept valid by setting ``$BASE_DIR``.
+
+    Args:
+        circuit_config (str|Path): path to the circuit config.
+        release_dir (str|Path): path to the morphology release.
+        out (io.TextIOWrapper): file object where the config is written.
+        local_dir (str|Path): path to the local copy.
+    """
+    circuit_config = Path(circuit_config).resolve()
+    config = json.loads(circuit_config.read_text(encoding="utf-8"))
+    config = _replace_release(config, Path(release_dir), Path(local_dir))
+    manifest = config.setdefault("manifest", {})
+    manifest["$BASE_DIR"] = str(circuit_config.parent / manifest.get("$BASE_DIR", "."))
+    json.dump(config, out, indent=2)
+
+
+@click.group()
+def main():
+    """Pack the morphology release."""
+    logging.basicConfig(level=logging.INFO, format="[circuit-build] %(message)s")
+
+
+@main.command("pack")
+@click.option("--release-dir", required=True, type=click.Path(exists=True, file_okay=False))
+@click.option("--archive", required=True, type=click.Path(dir_okay=False))
+@click.option("--index", required=True, type=click.Path(dir_okay=False))
+def pack_cmd(release_dir, archive, index):
+    """Pack the morphology release in a single archive with an index."""
+    pack_release(release_dir, archive, index)
+
+
+if __name__ == "__main__":  # pragma: no cover
+    main()
@@ -0,0 +1,255 @@
+"""Resolve the atlas based node sets, using the voxel masks compiled from the atlas and cached.
+
+The voxel mask of each atlas based target is compiled once, and saved in the atlas cache dir with
+a name derived from the digest of the definition and of the atlas files used to compile it.
+When the node sets are generated again with the same atlas, the masks are loaded from the cache,
+and only the lookup of the positions of the cells is executed, vectorized over all the nodes.
+The digests of the atlas files are cached in the same file used for the bioname files,
+``logs/digests.json``, so they are computed again only when the files are modified.
+
+The atlas based target can be defined as a 0/1 mask registered in the atlas, e.g.
+``'{S1HL-cylinder}'``, or as a region of the hierarchy, e.g. ``{'region': '@^mc2'}``.
+The query based targets are resolved by ``brainbuilder targets node-sets``.
+"""
+
+import hashlib
+import json
+import logging
+from pathlib import Path
+from typing import Optional
+
+import click
+import numpy as np
+
+from circuit_build.atlas import RegionMap, atlas_file, read_volume, voxel_indices
+from circuit_build.preflight import DigestCache
+from circuit_build.utils import dump_yaml, load_yaml, python_module_cmd
+
+L = logging.getLogger(__name__)
+
+CACHE_DIR = "node_sets"  # inside the atlas cache dir
+ATLAS_BASED = "atlas_based"
+HEADER_KEYS = ("sizes", "space directions", "space origin")
+
+
+def _source_files(atlas_dir, definition):
+    """Return the atlas files needed to compile the mask of the target."""
+    if isinstance(definition, dict):
+        return [Path(atlas_dir, "brain_regions.nrrd"), Path(atlas_dir, "hierarchy.json")]
+    return [atlas_file(atlas_dir, definition)]
+
+
+def mask_digest(atlas_dir, definition, digests=None):
+    """Return the digest of the definition of the target and of the atlas files it depends on.
+
+    Args:
+        atlas_dir (str|Path): path to the atlas directory.
+        definition (str|dict): definition of the atlas based target.
+        digests (DigestCache): optional cache of the digests of the atlas files.
+    """
+    digests = digests or DigestCache()
+    paths = _source_files(atlas_dir, definition)
+    file_digests = digests.digests(paths)
+    content = {
+        "definition": definition,
+        "files": [file_digests[str(path)] for path in paths],
+    }
+    return hashlib.sha256(json.dumps(content, sort_keys=True).encode()).hexdigest()
+
+
+def compile_mask(atlas_dir, definition):
+    """Return the NRRD header and the boolean voxel mask of the target.
+
+    Args:
+        atlas_dir (str|Path): path to the atlas directory.
+        definition (str|dict): name of a 0/1 mask in the atlas, or dict with the key ``region``.
+    """
+    if isinstance(definition, dict):
+        header, brain_regions = read_volume(Path(atlas_dir, "brain_regions.nrrd"))
+        with open(Path(atlas_dir, "hierarchy.json"), encoding="utf-8") as fd:
+            region_map = RegionMap(json.load(fd))
+        ids = region_map.find(definition["region"])
+        return header, np.isin(brain_regions, list(ids))
+    header, data = read_volume(atlas_file(atlas_dir, definition))
+    return header, data != 0
+
+
+def load_mask(atlas_dir, definition, cache_dir, digests=None):
+    """Return the NRRD header and the voxel mask of the target, loaded from the cache if possible.
+
+    Args:
+        atlas_dir (str|Path): path to the atlas directory.
+        definition (str|dict): definition of the atlas based target.
+        cache_dir (str|Path): directory where the compiled masks are cached.
+        digests (DigestCache): optional cache of the digests of the atlas files.
+    """
+    path = Path(cache_dir, f"{mask_digest(atlas_dir, definition, digests)}.npz")
+    if path.exists():
+        L.info("Loading the compiled mask of %s from %s", definition, path)
+        with np.load(path) as content:
+            header = json.loads(str(content["header"]))
+            return header, content["mask"]
+    L.info("Compiling the mask of %s to %s", definition, path)
+    header, mask = compile_mask(atlas_dir, definition)
+    header = {key: header[key] for key in HEADER_KEYS}
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # write to a temporary file first, so that the cache is never left incomplete
+    tmp_path = path.with_name(f".{path.stem}.tmp.npz")
+    np.savez_compressed(tmp_path, header=json.dumps(header), mask=mask)
+    tmp_path.rename(path)
+    return header, mask
+
+
+def select_positions(header, mask, positions):
+    """Return the boolean array of the positions inside the mask, vectorized over the positions.
+
+    Raise a ValueError if any position is outside the atlas, as done by ``voxcell``.
+    """
+    indices, valid = voxel_indices(header, positions)
+    if not np.all(valid):
+        raise ValueError(f"{np.count_nonzero(~valid)} positions are outside the atlas")
+    return mask[tuple(indices.T)]
+
+
+def load_positions(nodes_file, population):
+    """Return the positions of the nodes as an array of shape (N, 3)."""
+    # pylint: disable=import-outside-toplevel
+    import libsonata
+
+    pop = libsonata.NodeStorage(str(nodes_file)).open_population(population)
+    selection = libsonata.Selection([(0, pop.size)])
+    return np.column_stack([pop.get_attribute(axis, selection) for axis in "xyz"])
+
+
+def resolve_atlas_node_sets(
+    targets, atlas_dir, positions, population, cache_dir, allow_empty, *, digests_file=None
+):
+    """Return a dict with the node sets resolved from the atlas based targets.
+
+    Args:
+        targets (dict): atlas based targets, as defined in the targets file.
+        atlas_dir (str|Path): path to the atlas directory.
+        positions (np.ndarray): array of shape (N, 3) with the positions of the nodes.
+        population (str): name of the nodes population.
+        cache_dir (str|Path): directory where the compiled masks are cached.
+        allow_empty (bool): if False, raise an error if any node set is empty.
+        digests_file (str|Path): optional file caching the digests, shared with the pre-flight.
+    """
+    result = {}
+    # the atlas files are hashed only when modified, since they are shared by many targets
+    digests = DigestCache(digests_file)
+    for name, definition in targets.items():
+        header, mask = load_mask(atlas_dir, definition, cache_dir, digests)
+        digests.save()
+        node_ids = np.flatnonzero(select_positions(header, mask, positions))
+        if len(node_ids) == 0 and not allow_empty:
+            raise ValueError(f"Empty atlas based node set: {name}")
+        L.info("Resolved %s nodes in the node set %s", len(node_ids), name)
+        result[name] = {"population": population, "node_id": node_ids.tolist()}
+    return result
+
+
+def split_targets(targets_file, output_file):
+    """Write the targets file without the atlas based targets, and return the removed targets."""
+    content = load_yaml(targets_file)
+    atlas_based = content["targets"].pop(ATLAS_BASED, {})
+    dump_yaml(output_file, content)
+    return atlas_based
+
+
+def has_atlas_based_targets(targets_file):
+    """Return True if the targets file contains any atlas based target."""
+    return bool(load_yaml(targets_file).get("targets", {}).get(ATLAS_BASED))
+
+
+def build_node_sets_cmd(cmd, targets, query_targets, atlas_dir, cache_dir, population, **kwargs):
+    """Return a command string adding the atlas based node sets to the output of the command.
+
+    The command is expected to write the node sets of the query based targets,
+    read from ``query_targets``, that is written before executing the command.
+    The helpers are executed with the interpreter running the workflow, so the command should
+    load the environment of brainbuilder in a subshell.
+
+    Args:
+        cmd (str): command generating the query based node sets.
+        targets (str): path to the targets file.
+        query_targets (str): path to the targets file without the atlas based targets.
+        atlas_dir (str): path to the atlas directory.
+        cache_dir (str): directory where the compiled masks are cached.
+        population (str): name of the nodes population.
+        kwargs: optional ``allow_empty`` and ``digests_file``,
+            and the placeholders ``nodes`` and ``output``.
+    """
+    helper = python_module_cmd(__name__)
+    options = " --allow-empty" if kwargs.get("allow_empty") else ""
+    if digests_file := kwargs.get("digests_file"):
+        options += f" --digests-file {digests_file}"
+    nodes = kwargs.get("nodes", "{input}")
+    output = kwargs.get("output", "{output}")
+    return (
+        f"{helper} split-targets {targets} {query_targets} && "
+        f"{cmd} && "
+        f"{helper} add-atlas-based{options} --atlas {atlas_dir} --cache-dir {cache_dir} "
+        f"--population {population} {targets} {nodes} {output}"
+    )
+
+
+@click.group()
+def main():
+    """Resolve the atlas based node sets."""
+    logging.basicConfig(level=logging.INFO, format="[circuit-build] %(message)s")
+
+
+@main.command("split-targets")
+@click.argument("targets_file", type=click.Path(exists=True, dir_okay=False))
+@click.argument("output_file", type=click.Path(dir_okay=False))
+def split_targets_cmd(targets_file, output_file):
+    """Write OUTPUT_FILE with the targets in TARGETS_FILE, except the atlas based targets."""
+    split_targets(targets_file, output_file)
+
+
+@main.command("add-atlas-based")
+@click.option("--atlas", required=True, type=click.Path(exists=True, file_okay=False))
+@click.option("--cache-dir", required=True, type=click.Path(file_okay=False))
+@click.option("--population", required=True)
+@click.option("--allow-empty", is_flag=True, help="Allow empty node sets.")
+@click.option(
+    "--digests-file",
+    type=click.Path(dir_okay=False),
+    help="File caching the digests of the atlas files, shared with the pre-flight.",
+)
+@click.argument("targets_file", type=click.Path(exists=True, dir_okay=False))
+@click.argument("nodes_file", type=click.Path(exists=True, dir_okay=False))
+@click.argument("node_sets_file", type=click.Path(exists=True, dir_okay=False))
+def add_atlas_based(
+    *,
+    atlas: str,
+    cache_dir: str,
+    population: str,
+    allow_empty: bool,
+    digests_file: Optional[str],
+    targets_file: str,
+    nodes_file: str,
+    node_sets_file: str,
+):
+    """Add to NODE_SETS_FILE the atlas based targets in TARGETS_FILE."""
+    targets = load_yaml(targets_file)["targets"].get(ATLAS_BASED, {})
+    with open(node_sets_file, encoding="utf-8") as fd:
+        node_sets = json.load(fd)
+    duplicated = sorted(set(targets).intersection(node_sets))
+    if duplicated:
+        raise click.ClickException(f"Duplicated node sets: {', '.join(duplicated)}")
+    positions = load_positions(nodes_file, population)
+    try:
+        resolved = resolve_atlas_node_sets(
+            targets, atlas, positions, population, cache_dir, allow_empty, digests_file=digests_file
+        )
+    except ValueError as e:
+        raise click.ClickException(str(e)) from e
+    node_sets.update(resolved)
+    with open(node_sets_file, "w", encoding="utf-8") as fd:
+        json.dump(node_sets, fd, indent=2)
+
+
+if __name__ == "__main__":  # pragma: no cover
+    main()
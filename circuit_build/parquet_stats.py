@@ -0,0 +1,147 @@
+"""Statistics of Parquet datasets, collected only from the footers of the files.
+
+The footers contain the number of rows, the size of the row groups, and the min/max statistics
+of the columns, so they can be read quickly without loading the data.
+If ``pyarrow`` is not installed, only the number and the size of the files are collected.
+"""
+
+import json
+import logging
+import statistics
+from pathlib import Path
+
+try:
+    import pyarrow.parquet as pq
+except ImportError:  # pragma: no cover
+    pq = None
+
+L = logging.getLogger(__name__)
+
+GID_COLUMNS = ("pre_neuron_id", "post_neuron_id")
+SKEW_WARNING_THRESHOLD = 2.0
+
+
+def _summary(values):
+    """Return the min, max and mean of the given values."""
+    if not values:
+        return None
+    return {"min": min(values), "max": max(values), "mean": statistics.mean(values)}
+
+
+def file_statistics(path, columns=GID_COLUMNS):
+    """Return a dict with the statistics of a Parquet file, read from the footer.
+
+    Args:
+        path (str|Path): path to the Parquet file.
+        columns (list): columns for which the min/max values are collected, if present.
+    """
+    path = Path(path)
+    result = {"name": path.name, "size": path.stat().st_size}
+    if pq is None:
+        return result
+    metadata = pq.ParquetFile(path).metadata
+    names = [metadata.schema.column(i).name for i in range(metadata.num_columns)]
+    row_groups = [metadata.row_group(i) for i in range(metadata.num_row_groups)]
+    result |= {
+        "rows": metadata.num_rows,
+        "row_groups": metadata.num_row_groups,
+        "rows_per_row_group": [rg.num_rows for rg in row_groups],
+        "uncompressed_size": sum(rg.total_byte_size for rg in row_groups),
+        "columns": {},
+    }
+    for name in columns:
+        if name not in names:
+            continue
+        index = names.index(name)
+        column_stats = [rg.column(index).statistics for rg in row_groups]
+        if all(s is not None and s.has_min_max for s in column_stats) and column_stats:
+            result["columns"][name] = {
+                "min": min(s.min for s in column_stats),
+                "max": max(s.max for s in column_stats),
+            }
+    return result
+
+
+def collect_statistics(parquet_dir, columns=GID_COLUMNS):
+    """Return a dict with the statistics of all the Parquet files in a directory.
+
+    The skew is the ratio between the maximum and the mean number of rows per file,
+    or of the size per file if the number of rows is not available.
+    """
+    files = [file_statistics(path, columns) for path in sorted(Path(parquet_dir).glob("*.parquet"))]
+    result = {
+        "path": str(parquet_dir),
+        "footers": pq is not None,
+        "files": len(files),
+        "size": sum(f["size"] for f in files),
+    }
+    key = "size"
+    if pq is not None:
+        key = "rows"
+        rows_per_row_group = [n for f in files for n in f["rows_per_row_group"]]
+        result |= {
+            "rows": sum(f["rows"] for f in files),
+            "uncompressed_size": sum(f["uncompressed_size"] for f in files),
+            "row_groups": len(rows_per_row_group),
+            "rows_per_file": _summary([f["rows"] for f in files]),
+            "rows_per_row_group": _summary(rows_per_row_group),
+            "columns": {},
+        }
+        for name in columns:
+            values = [f["columns"][name] for f in files if name in f["columns"]]
+            if values and len(values) == len(files):
+                result["columns"][name] = {
+                    "min": min(v["min"] for v in values),
+                    "max": max(v["max"] for v in values),
+                }
+    values = [f[key] for f in files]
+    mean = statistics.mean(values) if values else 0
+    result["skew"] = max(values) / mean if mean else None
+    if result["skew"] and result["skew"] > SKEW_WARNING_THRESHOLD:
+        L.warning(
+            "Skewed Parquet files in %s: the largest file has %.1f times the mean %s",
+            parquet_dir,
+            result["skew"],
+            key,
+        )
+    result["per_file"] = files
+    return result
+
+
+def write_statistics(parquet_dir, output_file, columns=GID_COLUMNS):
+    """Collect the statistics of the Parquet files in a directory, and write them in JSON.
+
+    Args:
+        parquet_dir (str|Path): directory containing the Parquet files.
+        output_file (io.TextIOBase): file object where the statistics are written.
+        columns (list): columns for which the min/max values are collected, if present.
+    """
+    result = collect_statistics(parquet_dir, columns)
+    L.info(
+        "Collected the statistics of %s Parquet files (%s bytes) in %s",
+        result["files"],
+        result["size"],
+        parquet_dir,
+    )
+    json.dump(result, output_file, indent=2)
+
+
+def input_data_size(parquet_dirs, statistics_files=()):
+    """Return the size in bytes of the data in the given directories.
+
+    The uncompressed size read from the statistics files is used when available,
+    because it's closer to the memory needed to process the data than the size of the files.
+    """
+    loaded = [load_statistics(path) for path in statistics_files]
+    if loaded and all(s and s.get("footers") for s in loaded):
+        return sum(s["uncompressed_size"] for s in loaded)
+    return sum(p.stat().st_size for path in parquet_dirs for p in Path(path).glob("*.parquet"))
+
+
+def load_statistics(path):
+    """Return the statistics loaded from a JSON file, or None if the file doesn't exist."""
+    path = Path(path)
+    if not path.exists():
+        return None
+    with path.open(encoding="utf-8") as fd:
+        return json.load(fd)
@@ -0,0 +1,194 @@
+"""Pre-flight checks of the bioname files, with a persistent cache of the digests.
+
+The digests of the files are computed in parallel, and saved in a cache file indexed by the
+absolute path of the files. The digest of a file is computed again only when the size or the
+modification time of the file changed since the previous computation, so large recipes and TSV
+files are not hashed again at each build.
+
+The digests of the bioname files are written in a provenance file in JSON, that is compared
+with the provenance file of the previous build to report the added, removed and changed files.
+"""
+
+import hashlib
+import json
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from pathlib import Path
+
+from circuit_build.version import __version__
+
+L = logging.getLogger(__name__)
+
+DIGEST_CACHE_FILE = "digests.json"
+PROVENANCE_FILE = "bioname_provenance.json"
+CHUNK_SIZE = 2**20
+MAX_WORKERS = 8
+
+
+def file_digest(path):
+    """Return the sha256 digest of the content of a file."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as fd:
+        while chunk := fd.read(CHUNK_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _dump_json(path, data):
+    """Write the data in JSON, using a temporary file to never leave the file incomplete."""
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+    with tmp_path.open("w", encoding="utf-8") as fd:
+        json.dump(data, fd, indent=2, sort_keys=True)
+    tmp_path.replace(path)
+
+
+def _load_json(path):
+    """Return the data loaded from a JSON file, or None if the file is missing or invalid."""
+    try:
+        with open(path, encoding="utf-8") as fd:
+            return json.load(fd)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as ex:
+        L.warning("Ignoring the invalid file %s: %s", path, ex)
+        return None
+
+
+class DigestCache:
+    """Digests of files, cached with the size and the modification time of the files."""
+
+    def __init__(self, path=None):
+        """Initialize the object.
+
+        Args:
+            path (str|Path): path to the cache file, or None to keep the cache only in memory.
+        """
+        self.path = Path(path) if path else None
+        self._entries = {}
+        if self.path:
+            self._entries = (_load_json(self.path) or {}).get("files", {})
+        self._modified = False
+
+    @staticmethod
+    def _key(path):
+        path = Path(path).resolve()
+        stat = path.stat()
+        return str(path), {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+    def _lookup(self, key, signature):
+        entry = self._entries.get(key)
+        if entry and all(entry.get(k) == v for k, v in signature.items()):
+            return entry["sha256"]
+        return None
+
+    def _store(self, key, signature, digest):
+        self._entries[key] = {**signature, "sha256": digest}
+        self._modified = True
+
+    def digest(self, path):
+        """Return the sha256 digest of a file, computed only if not found in the cache."""
+        return self.digests([path])[str(path)]
+
+    def digests(self, paths, max_workers=MAX_WORKERS):
+        """Return a dict path -> sha256 digest, computing in parallel the digests not cached.
+
+        Args:
+            paths (list): paths to the files.
+            max_workers (int): maximum number of threads used to compute the digests.
+        """
+        result = {}
+        missing = {}
+        for path in paths:
+            key, signature = self._key(path)
+            if digest := self._lookup(key, signature):
+                result[str(path)] = digest
+            else:
+                missing[str(path)] = (key, signature)
+        if missing:
+            L.debug("Computing the digest of %s files", len(missing))
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                computed = executor.map(file_digest, missing)
+                for (path, (key, signature)), digest in zip(missing.items(), computed):
+                    self._store(key, signature, digest)
+                    result[path] = digest
+        return result
+
+    def save(self):
+        """Write the cache file, if any digest has been added or updated."""
+        if self.path and self._modified:
+            _dump_json(self.path, {"files": self._entries})
+            self._modified = False
+
+
+def bioname_files(bioname_dir):
+    """Return the sorted list of the regular files in the top level of the bioname directory."""
+    return sorted(p for p in Path(bioname_dir).iterdir() if p.is_file())
+
+
+def compare_digests(previous, current):
+    """Return a dict with the lists of the added, removed and changed files.
+
+    Args:
+        previous (dict): dict name -> digest of the previous build.
+        current (dict): dict name -> digest of the current build.
+    """
+    return {
+        "added": sorted(set(current).difference(previous)),
+        "removed": sorted(set(previous).difference(current)),
+        "changed": sorted(
+            k for k in set(current).intersection(previous) if current[k] != previous[k]
+        ),
+    }
+
+
+def run_preflight(bioname_dir, logs_dir, timestamp):
+    """Compute the digests of the bioname files, and write the provenance of the build.
+
+    The provenance is written in the logs directory of the build, and copied in the top level of
+    the logs directory, to be compared with the provenance of the following build.
+
+    Args:
+        bioname_dir (str|Path): path to the bioname directory.
+        logs_dir (str|Path): path to the logs directory of the circuit.
+        timestamp (str): timestamp of the build.
+
+    Returns:
+        the provenance dict.
+    """
+    bioname_dir, logs_dir = Path(bioname_dir), Path(logs_dir)
+    cache = DigestCache(logs_dir / DIGEST_CACHE_FILE)
+    paths = bioname_files(bioname_dir)
+    digests = cache.digests(paths)
+    cache.save()
+    files = {p.name: {"size": p.stat().st_size, "sha256": digests[str(p)]} for p in paths}
+    previous = _load_json(logs_dir / PROVENANCE_FILE)
+    changes = None
+    if previous:
+        changes = compare_digests(
+            {k: v["sha256"] for k, v in previous["files"].items()},
+            {k: v["sha256"] for k, v in files.items()},
+        )
+    provenance = {
+        "timestamp": timestamp,
+        "date": datetime.now().astimezone().isoformat(timespec="seconds"),
+        "circuit_build_version": __version__,
+        "bioname_dir": str(bioname_dir.resolve()),
+        "files": files,
+        "previous_build": previous["timestamp"] if previous else None,
+        "changes": changes,
+    }
+    _dump_json(logs_dir / timestamp / PROVENANCE_FILE, provenance)
+    _dump_json(logs_dir / PROVENANCE_FILE, provenance)
+    if changes and any(changes.values()):
+        for kind, names in changes.items():
+            if names:
+                L.info(
+                    "Bioname files %s since the build %s: %s", kind, previous["timestamp"], names
+                )
+    elif changes:
+        L.info("Bioname files unchanged since the build %s", previous["timestamp"])
+    return provenance
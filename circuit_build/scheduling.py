@@ -0,0 +1,147 @@
+"""Prioritize the rules on the critical path of the workflow.
+
+The cost of each rule is the median runtime of its jobs recorded in the metrics file by the
+previous builds, or the runtime estimated with the scaling models when there is no history.
+The priority of each rule is the time needed to complete the longest chain of rules starting
+from it, so that Snakemake starts the jobs on the critical path first, while the cheap jobs
+fill the remaining slots.
+"""
+
+import functools
+import logging
+import math
+import re
+import statistics
+from collections import defaultdict
+from pathlib import Path
+
+from circuit_build.estimate import estimate_rule, load_scaling_models
+from circuit_build.metrics import combine_job_events, load_events
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_RUNTIME = 60  # seconds, used for the rules without history and without scaling model
+REFERENCE_CELLS = 10**6  # number of cells used to evaluate the scaling models
+WILDCARD_REGEX = re.compile(r"\{[^{}]*\}")
+WILDCARD = "\0"
+
+
+def _pattern(path):
+    """Return the path with each wildcard replaced by a single placeholder character."""
+    return WILDCARD_REGEX.sub(WILDCARD, str(path))
+
+
+@functools.lru_cache(maxsize=None)
+def patterns_overlap(first, second):
+    """Return True if there is any path matching both patterns.
+
+    The wildcards are represented by ``WILDCARD``, and they can match any sequence of characters.
+    """
+
+    @functools.lru_cache(maxsize=None)
+    def _match(i, j):
+        if i == len(first) and j == len(second):
+            return True
+        if i < len(first) and first[i] == WILDCARD:
+            return _match(i + 1, j) or (j < len(second) and _match(i, j + 1))
+        if j < len(second) and second[j] == WILDCARD:
+            return _match(i, j + 1) or (i < len(first) and _match(i + 1, j))
+        if i < len(first) and j < len(second) and first[i] == second[j]:
+            return _match(i + 1, j + 1)
+        return False
+
+    return _match(0, 0)
+
+
+def rule_dependencies(rules):
+    """Return a dict with the names of the rules producing the inputs of each rule.
+
+    The inputs defined by functions are evaluated only when the jobs are created, so they are
+    ignored, and the dependencies are derived only from the input and output patterns.
+    """
+    outputs = {rule.name: [_pattern(path) for path in rule.output] for rule in rules}
+    dependencies = {}
+    for rule in rules:
+        inputs = [_pattern(path) for path in rule.input if not callable(path)]
+        dependencies[rule.name] = {
+            name
+            for name, patterns in outputs.items()
+            if name != rule.name and any(patterns_overlap(i, o) for i in inputs for o in patterns)
+        }
+    return dependencies
+
+
+def historical_runtimes(metrics_file):
+    """Return a dict with the median runtime of the successful jobs of each rule."""
+    if not metrics_file or not Path(metrics_file).is_file():
+        return {}
+    runtimes = defaultdict(list)
+    for job in combine_job_events(load_events([metrics_file])):
+        if job["exit_status"] == 0 and job["runtime"] is not None:
+            runtimes[job["rule"]].append(job["runtime"])
+    return {rule: statistics.median(values) for rule, values in runtimes.items()}
+
+
+def model_runtimes(models, cells=REFERENCE_CELLS, partitions=1):
+    """Return a dict with the runtime of each job estimated with the scaling models."""
+    return {
+        rule: estimate_rule(rule, model, cells, partitions)["runtime"]
+        for rule, model in models.items()
+    }
+
+
+def critical_path(dependencies, costs):
+    """Return a dict with the time needed to complete the longest chain starting from each rule.
+
+    Args:
+        dependencies (dict): names of the rules needed by each rule.
+        costs (dict): runtime in seconds of each rule.
+    """
+    dependents = defaultdict(set)
+    for name, needed in dependencies.items():
+        for other in needed:
+            dependents[other].add(name)
+    tails = {}
+
+    def _tail(name, visiting):
+        if name not in tails:
+            # ignore the cycles, that may be caused by patterns overlapping by chance
+            children = dependents[name] - visiting
+            tails[name] = costs.get(name, 0) + max(
+                (_tail(child, visiting | {name}) for child in children), default=0
+            )
+        return tails[name]
+
+    for name in dependencies:
+        _tail(name, frozenset())
+    return tails
+
+
+def prioritize_rules(rules, metrics_file=None, models=None, partitions=1):
+    """Set the priority and the runtime resource of the rules, and return the critical paths.
+
+    The rules with an explicit priority or runtime keep the configured values.
+
+    Args:
+        rules (list): Snakemake rules of the workflow.
+        metrics_file (str): path to the metrics file of the previous builds, if any.
+        models (dict): scaling models, or None to use the default models.
+        partitions (int): number of partitions of the partitioned rules.
+    """
+    rules = list(rules)
+    models = load_scaling_models() if models is None else models
+    runtimes = {
+        **model_runtimes(models, partitions=partitions),
+        **historical_runtimes(metrics_file),
+    }
+    costs = {
+        rule.name: 0 if rule.norun else runtimes.get(rule.name, DEFAULT_RUNTIME) for rule in rules
+    }
+    tails = critical_path(rule_dependencies(rules), costs)
+    for rule in rules:
+        if not rule.priority:
+            rule.priority = math.ceil(tails[rule.name])
+        if not rule.norun and "runtime" not in rule.resources:
+            rule.resources["runtime"] = max(1, math.ceil(costs[rule.name] / 60))
+    logger.debug("Priorities of the rules: %s", {rule.name: rule.priority for rule in rules})
+    return tails
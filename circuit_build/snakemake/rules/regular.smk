@@ -1,5 +1,18 @@
 import json
+import re
 from pathlib import Path
+from circuit_build.constants import EARLY_PRIORITY, WORKFLOW_ENV
+from circuit_build.dask_cluster import dask_slurm_env, with_dask_cluster
+from circuit_build.emodels import helper_cmd as emodels_helper_cmd
+from circuit_build.morphologies import helper_cmd as morphologies_helper_cmd
+from circuit_build.morphology_staging import (
+    STAGED_CIRCUIT_CONFIG,
+    MorphologyStaging,
+    staged_inputs,
+    with_staged_release,
+    write_staged_config,
+)
+from circuit_build.parquet_stats import write_statistics
 from circuit_build.utils import (
     format_dict_to_list,
     format_if,
@@ -261,6 +274,36 @@ rule synthesize_morphologies:
         )
 
 
+if ctx.SYNTHESIZE_MORPH_CONTAINER:
+
+    rule merge_morphologies:
+        message:
+            "Merge the synthesized morphologies into an HDF5 morphology container"
+        input:
+            ctx.paths.auxiliary_path("circuit.synthesized_morphologies.h5"),
+        output:
+            ctx.SYNTHESIZE_MORPH_CONTAINER,
+        log:
+            ctx.log_path("merge_morphologies"),
+        shell:
+            ctx.bbp_env(
+                WORKFLOW_ENV,
+                [
+                    f"{morphologies_helper_cmd()} merge",
+                    "--morph-dir",
+                    ctx.SYNTHESIZE_MORPH_DIR,
+                    "--shards",
+                    ctx.conf.get(["synthesize_morphologies", "container_shards"], default=1),
+                    "--output {output}",
+                    "{input}",
+                ],
+                slurm_env="merge_morphologies",
+            )
+
+
+assign_emodels_chunk_size = ctx.conf.get(["assign_emodels", "chunk_size"])
+
+
 rule assign_emodels:
     message:
         "Assign electrical models"
@@ -272,9 +315,14 @@ rule assign_emodels:
         ctx.log_path("assign_emodels_per_type"),
     shell:
         ctx.bbp_env(
-            "brainbuilder",
+            if_then_else(assign_emodels_chunk_size, WORKFLOW_ENV, "brainbuilder"),
             [
-                "brainbuilder cells assign-emodels",
+                if_then_else(
+                    assign_emodels_chunk_size,
+                    f"{emodels_helper_cmd()} assign-emodels",
+                    "brainbuilder cells assign-emodels",
+                ),
+                format_if("--chunk-size {}", assign_emodels_chunk_size),
                 "--morphdb",
                 ctx.MORPHDB,
                 "--output {output}",
@@ -286,44 +334,60 @@ rule assign_emodels:
         )
 
 
+provide_me_info_chunk_size = ctx.conf.get(["provide_me_info", "chunk_size"])
+
+
 rule provide_me_info:
     message:
         "Provide MorphoElectrical info for SONATA nodes"
     input:
-        ctx.paths.auxiliary_path("circuit.h5"),
+        cells=ctx.paths.auxiliary_path("circuit.h5"),
+        **if_then_else(ctx.MECOMBO_INDEX_FILE, {"mecombo_info": ctx.MECOMBO_INDEX_FILE}, {}),
     output:
         ctx.nodes_neurons_file,
     log:
         ctx.log_path("provide_me_info"),
     shell:
         ctx.bbp_env(
-            "brainbuilder",
+            if_then_else(provide_me_info_chunk_size, WORKFLOW_ENV, "brainbuilder"),
             [
-                "brainbuilder sonata provide-me-info",
-                format_if("--mecombo-info {}", ctx.EMODEL_RELEASE_MECOMBO),
+                if_then_else(
+                    provide_me_info_chunk_size,
+                    f"{emodels_helper_cmd()} provide-me-info",
+                    "brainbuilder sonata provide-me-info",
+                ),
+                format_if("--chunk-size {}", provide_me_info_chunk_size),
+                format_if(
+                    "--mecombo-info {}", ctx.MECOMBO_INDEX_FILE or ctx.EMODEL_RELEASE_MECOMBO
+                ),
                 "--model-type biophysical",
                 "--output {output}",
-                "{input}",
+                "{input.cells}",
             ],
             slurm_env="provide_me_info",
         )
 
 
-if ctx.NO_EMODEL:
+if ctx.MECOMBO_INDEX_FILE:
 
-    rule bypass_emodel:
+    rule index_mecombo:
         message:
-            "Bypass any emodel related tasks"
+            "Index the ME-combo table of the emodel release"
         input:
-            ctx.paths.auxiliary_path("circuit.synthesized_morphologies.h5"),
+            ctx.EMODEL_RELEASE_MECOMBO,
         output:
-            ctx.nodes_neurons_file,
+            ctx.MECOMBO_INDEX_FILE,
         log:
-            ctx.log_path("bypass_emodel"),
+            ctx.log_path("index_mecombo"),
         shell:
-            "cp -v {input} {output}"
+            ctx.bbp_env(
+                WORKFLOW_ENV,
+                [f"{emodels_helper_cmd()} index-mecombo", "{input}", "--output {output}"],
+                slurm_env="index_mecombo",
+            )
+
 
-else:
+if not ctx.NO_EMODEL:
 
     rule assign_synthesis_emodels:
         message:
@@ -359,28 +423,31 @@ else:
         log:
             ctx.log_path("adapt_emodels"),
         shell:
-            ctx.bbp_env(
-                "emodel-generalisation",
-                [
-                    "emodel-generalisation -v adapt",
-                    "--input-node-path",
-                    "{input}",
-                    "--morphology-path",
-                    ctx.SYNTHESIZE_MORPH_DIR,
-                    "--config-path",
-                    Path(ctx.SYNTHESIZE_EMODEL_RELEASE) / "config",
-                    "--output-node-path",
-                    "{output}",
-                    "--output-hoc-path",
-                    ctx.EMODEL_RELEASE_HOC,
-                    "--parallel-lib",
-                    "dask_dataframe",
-                    "--max-scale",
-                    3.0,
-                    "--min-scale",
-                    0.8,
-                ],
-                slurm_env="adapt_emodels",
+            with_dask_cluster(
+                ctx.DASK_CLUSTER,
+                ctx.bbp_env(
+                    "emodel-generalisation",
+                    [
+                        "emodel-generalisation -v adapt",
+                        "--input-node-path",
+                        "{input}",
+                        "--morphology-path",
+                        ctx.SYNTHESIZE_MORPH_DIR,
+                        "--config-path",
+                        Path(ctx.SYNTHESIZE_EMODEL_RELEASE) / "config",
+                        "--output-node-path",
+                        "{output}",
+                        "--output-hoc-path",
+                        ctx.EMODEL_RELEASE_HOC,
+                        "--parallel-lib",
+                        "dask_dataframe",
+                        "--max-scale",
+                        3.0,
+                        "--min-scale",
+                        0.8,
+                    ],
+                    slurm_env=dask_slurm_env(ctx.DASK_CLUSTER, "adapt_emodels"),
+                ),
             )
 
     rule compute_currents:
@@ -392,31 +459,66 @@ else:
             ctx.nodes_neurons_file,
         log:
             ctx.log_path("compute_currents"),
+        shell:
+            with_dask_cluster(
+                ctx.DASK_CLUSTER,
+                ctx.bbp_env(
+                    "emodel-generalisation",
+                    [
+                        "emodel-generalisation -v compute_currents",
+                        "--input-path",
+                        "{input}",
+                        "--morphology-path",
+                        ctx.SYNTHESIZE_MORPH_DIR,
+                        "--output-path",
+                        "{output}",
+                        "--hoc-path",
+                        ctx.EMODEL_RELEASE_HOC,
+                        "--parallel-lib",
+                        "dask_dataframe",
+                    ],
+                    slurm_env=dask_slurm_env(ctx.DASK_CLUSTER, "compute_currents"),
+                ),
+            )
+
+
+if ctx.MORPH_STAGING:
+
+    rule pack_morphology_release:
+        message:
+            "Pack the morphology release in a single archive, staged on the nodes by the jobs"
+        output:
+            archive=ctx.MORPH_STAGING.archive_file,
+            index=ctx.MORPH_STAGING.index_file,
+        log:
+            ctx.log_path("pack_morphology_release"),
         shell:
             ctx.bbp_env(
-                "emodel-generalisation",
-                [
-                    "emodel-generalisation -v compute_currents",
-                    "--input-path",
-                    "{input}",
-                    "--morphology-path",
-                    ctx.SYNTHESIZE_MORPH_DIR,
-                    "--output-path",
-                    "{output}",
-                    "--hoc-path",
-                    ctx.EMODEL_RELEASE_HOC,
-                    "--parallel-lib",
-                    "dask_dataframe",
-                ],
-                slurm_env="compute_currents",
+                WORKFLOW_ENV,
+                [ctx.MORPH_STAGING.pack_cmd()],
+                slurm_env="pack_morphology_release",
             )
 
+    rule staged_circuitconfig_hpc:
+        message:
+            "Generate the template of the circuit config read from the staged morphology release"
+        input:
+            ctx.paths.auxiliary_path("circuit_config_hpc.json"),
+        output:
+            ctx.MORPH_STAGING.config_template_file,
+        log:
+            ctx.log_path("staged_circuitconfig_hpc"),
+        run:
+            with write_with_log(output[0], log[0]) as out:
+                write_staged_config(input[0], ctx.MORPH_STAGING.release_dir, out)
+
 
 rule touchdetector:
     message:
         "Detect touches between neurites"
     input:
         circuit_config=ctx.paths.auxiliary_path("circuit_config_hpc.json"),
+        **staged_inputs(ctx.MORPH_STAGING, circuit_config=True),
     output:
         success=touch(
             ctx.tmp_edges_neurons_chemical_connectome_path(
@@ -430,25 +532,34 @@ rule touchdetector:
     shell:
         ctx.bbp_env(
             "touchdetector",
-            [
-                "touchdetector",
-                "--modern",
-                "--circuit-config {input.circuit_config}",
-                "--output {params.output_dir}",
-                "--touchspace",
-                ctx.conf.get(["touchdetector", "touchspace"], default="axodendritic"),
-                f"--from {ctx.nodes_neurons_name}",
-                f"--to {ctx.nodes_neurons_name}",
-                *ctx.if_partition(
-                    [
-                        "--from-nodeset {wildcards.partition}",
-                        "--to-nodeset {wildcards.partition}",
-                    ],
-                    [],
-                ),
-                "--recipe",
-                ctx.BUILDER_RECIPE,
-            ],
+            with_staged_release(
+                ctx.MORPH_STAGING,
+                [
+                    "touchdetector",
+                    "--modern",
+                    "--circuit-config",
+                    if_then_else(
+                        ctx.MORPH_STAGING,
+                        MorphologyStaging.staged_path(STAGED_CIRCUIT_CONFIG),
+                        "{input.circuit_config}",
+                    ),
+                    "--output {params.output_dir}",
+                    "--touchspace",
+                    ctx.conf.get(["touchdetector", "touchspace"], default="axodendritic"),
+                    f"--from {ctx.nodes_neurons_name}",
+                    f"--to {ctx.nodes_neurons_name}",
+                    *ctx.if_partition(
+                        [
+                            "--from-nodeset {wildcards.partition}",
+                            "--to-nodeset {wildcards.partition}",
+                        ],
+                        [],
+                    ),
+                    "--recipe",
+                    ctx.BUILDER_RECIPE,
+                ],
+                circuit_config="{input.staged_circuit_config}",
+            ),
             slurm_env="touchdetector",
         )
 
@@ -476,6 +587,24 @@ rule touch2parquet:
         )
 
 
+rule touch_statistics:
+    message:
+        "Collect the statistics of the touches from the Parquet footers"
+    input:
+        parquet_dir=ctx.tmp_edges_neurons_chemical_connectome_path(
+            f"touches{ctx.partition_wildcard()}/parquet",
+        ),
+    output:
+        ctx.tmp_edges_neurons_chemical_connectome_path(
+            f"touches{ctx.partition_wildcard()}/statistics.json",
+        ),
+    log:
+        ctx.log_path(f"touch_statistics{ctx.partition_wildcard()}"),
+    run:
+        with write_with_log(output[0], log[0]) as out:
+            write_statistics(input.parquet_dir, out)
+
+
 rule spykfunc_s2s:
     message:
         "Convert touches into synapses (S2S)"
@@ -485,9 +614,18 @@ rule spykfunc_s2s:
             ctx.paths.auxiliary_path("circuit.synthesized_morphologies.h5"),
             ctx.nodes_neurons_file,
         ),
+        **if_then_else(
+            ctx.SYNTHESIZE_MORPH_CONTAINER,
+            {"morphologies": ctx.SYNTHESIZE_MORPH_CONTAINER},
+            {},
+        ),
+        **staged_inputs(ctx.MORPH_STAGING),
         touches=ctx.tmp_edges_neurons_chemical_connectome_path(
             f"touches{ctx.partition_wildcard()}/parquet",
         ),
+        statistics=ctx.tmp_edges_neurons_chemical_connectome_path(
+            f"touches{ctx.partition_wildcard()}/statistics.json",
+        ),
     output:
         success=ctx.tmp_edges_neurons_chemical_connectome_path(
             f"structural/spykfunc{ctx.partition_wildcard()}/circuit.parquet/_SUCCESS",
@@ -497,6 +635,9 @@ rule spykfunc_s2s:
     params:
         parquet_dirs=lambda wildcards, input: Path(input.touches, "*.parquet"),
         output_dir=lambda wildcards, output: Path(output.success).parent.parent,
+        spark_properties=lambda wildcards, input: ctx.spark_properties(
+            "spykfunc_s2s", [input.touches], [input.statistics]
+        ),
     shell:
         ctx.run_spykfunc("spykfunc_s2s")
 
@@ -510,9 +651,18 @@ rule spykfunc_s2f:
             ctx.paths.auxiliary_path("circuit.synthesized_morphologies.h5"),
             ctx.nodes_neurons_file,
         ),
+        **if_then_else(
+            ctx.SYNTHESIZE_MORPH_CONTAINER,
+            {"morphologies": ctx.SYNTHESIZE_MORPH_CONTAINER},
+            {},
+        ),
+        **staged_inputs(ctx.MORPH_STAGING),
         touches=ctx.tmp_edges_neurons_chemical_connectome_path(
             f"touches{ctx.partition_wildcard()}/parquet",
         ),
+        statistics=ctx.tmp_edges_neurons_chemical_connectome_path(
+            f"touches{ctx.partition_wildcard()}/statistics.json",
+        ),
     output:
         success=ctx.tmp_edges_neurons_chemical_connectome_path(
             f"functional/spykfunc{ctx.partition_wildcard()}/circuit.parquet/_SUCCESS",
@@ -522,6 +672,9 @@ rule spykfunc_s2f:
     params:
         parquet_dirs=lambda wildcards, input: Path(input.touches, "*.parquet"),
         output_dir=lambda wildcards, output: Path(output.success).parent.parent,
+        spark_properties=lambda wildcards, input: ctx.spark_properties(
+            "spykfunc_s2f", [input.touches], [input.statistics]
+        ),
     shell:
         ctx.run_spykfunc("spykfunc_s2f")
 
@@ -545,6 +698,9 @@ rule spykfunc_merge:
     params:
         parquet_dirs=lambda wildcards, input: " ".join(str(Path(i).parent) for i in input),
         output_dir=lambda wildcards, output: Path(output.success).parent.parent,
+        spark_properties=lambda wildcards, input: ctx.spark_properties(
+            "spykfunc_merge", [Path(i).parent for i in input]
+        ),
     shell:
         ctx.run_spykfunc("spykfunc_merge")
 
@@ -562,31 +718,7 @@ rule node_sets:
     log:
         ctx.log_path("node_sets"),
     shell:
-        ctx.bbp_env(
-            "brainbuilder",
-            [
-                "brainbuilder targets node-sets",
-                format_if(
-                    "--targets {}",
-                    value=ctx.conf.get(["node_sets", "targets"]),
-                    func=ctx.paths.bioname_path,
-                ),
-                if_then_else(
-                    ctx.conf.get(["node_sets", "allow_empty"], default=False),
-                    "--allow-empty",
-                    "",
-                ),
-                "--population",
-                ctx.nodes_neurons_name,
-                "--atlas",
-                ctx.ATLAS,
-                "--atlas-cache",
-                ctx.ATLAS_CACHE_DIR,
-                "--output {output}",
-                "{input}",
-            ],
-            slurm_env="node_sets",
-        )
+        ctx.run_node_sets()
 
 
 rule spatial_index_segment:
@@ -594,24 +726,37 @@ rule spatial_index_segment:
         "Generate segment spatial index"
     input:
         ctx.nodes_neurons_file,
+        **if_then_else(
+            ctx.SYNTHESIZE_MORPH_CONTAINER,
+            {"morphologies": ctx.SYNTHESIZE_MORPH_CONTAINER},
+            {},
+        ),
+        **staged_inputs(ctx.MORPH_STAGING),
     output:
         ctx.nodes_spatial_index_success_file,
     log:
         ctx.log_path("spatial_index_segment"),
+    priority: if_then_else(ctx.INDEX_EARLY, EARLY_PRIORITY, 0)
     shell:
         ctx.bbp_env(
             "spatialindexer",
-            [
-                "spatial-index-nodes",
-                "--verbose",
-                "--multi-index",
-                "{input}",
-                ctx.morphology_path(morphology_type="asc"),
-                "-o",
-                ctx.nodes_spatial_index_dir,
-                "--population",
-                ctx.nodes_neurons_name,
-            ],
+            with_staged_release(
+                ctx.MORPH_STAGING,
+                [
+                    "spatial-index-nodes",
+                    "--verbose",
+                    "--multi-index",
+                    "{input[0]}",
+                    ctx.morphology_path(
+                        morphology_type=if_then_else(ctx.SYNTHESIZE_MORPH_CONTAINER, "h5", "asc"),
+                        staged=True,
+                    ),
+                    "-o",
+                    ctx.nodes_spatial_index_dir,
+                    "--population",
+                    ctx.nodes_neurons_name,
+                ],
+            ),
             slurm_env="spatial_index_segment",
         )
 
@@ -669,6 +814,37 @@ rule parquet_to_sonata:
         )
 
 
+if ctx.projection_edges_names:
+
+    rule projection_to_sonata:
+        message:
+            "Convert projection synapses from Parquet to SONATA format"
+        input:
+            lambda wildcards: ctx.projection_parquet_dir(wildcards.projection),
+        output:
+            ctx.paths.edges_population_file("{projection}"),
+        wildcard_constraints:
+            projection="|".join(map(re.escape, ctx.projection_edges_names)),
+        log:
+            ctx.log_path("projection_to_sonata_{projection}"),
+        shell:
+            ctx.bbp_env(
+                "parquet-converters",
+                [
+                    "parquet2hdf5",
+                    "{input}",
+                    "{output}",
+                    "{wildcards.projection}",
+                ],
+                slurm_env="projection_to_sonata",
+            )
+
+
+rule projections:
+    input:
+        ctx.projection_edges_files,
+
+
 rule subcellular:
     message:
         "Assign gene expressions / protein concentrations to cells"
@@ -731,6 +907,11 @@ rule circuitconfig_hpc:
             ctx.paths.auxiliary_path("circuit.synthesized_morphologies.h5"),
             ctx.nodes_neurons_file,
         ),
+        **if_then_else(
+            ctx.SYNTHESIZE_MORPH_CONTAINER,
+            {"morphologies": ctx.SYNTHESIZE_MORPH_CONTAINER},
+            {},
+        ),
     output:
         ctx.paths.auxiliary_path("circuit_config_hpc.json"),
     log:
@@ -758,6 +939,7 @@ rule functional:
                 ctx.edges_spatial_index_success_file,
             ],
         ),
+        *ctx.projection_edges_files,
 
 
 rule structural:
@@ -766,3 +948,4 @@ rule structural:
         ctx.NODESETS_FILE,
         ctx.nodes_neurons_file,
         ctx.edges_neurons_neurons_file(connectome_type="structural"),
+        *ctx.projection_edges_files,
@@ -1,18 +1,28 @@
 """Common utilities."""
 
+import fcntl
 import importlib.resources
 import logging
+import math
 import os
+import re
 import shlex
+import shutil
+import sys
 import traceback
 from contextlib import contextmanager
+from pathlib import Path
 
 import yaml
 
-from circuit_build.constants import PACKAGE_NAME, SCHEMAS_DIR
+from circuit_build.constants import CORES_PER_NODE, MEMORY_PER_NODE_GB, PACKAGE_NAME, SCHEMAS_DIR
+from circuit_build.log_sink import build_log_sink_cmd
 
 L = logging.getLogger(__name__)
 
+FICLONE = 0x40049409  # ioctl request to clone a file on Linux (reflink)
+MEMORY_UNITS = {"K": 1 / 1024**2, "M": 1 / 1024, "G": 1, "T": 1024}  # to GB
+
 
 def load_yaml(filepath):
     """Load from YAML file."""
@@ -60,10 +70,20 @@ def format_dict_to_list(template, values):
     return [template.format(key=k, value=v) for k, v in values.items()]
 
 
-def redirect_to_file(cmd, filename="{log}"):
-    """Return a command string with the right redirection."""
+def redirect_to_file(cmd, filename="{log}", log_config=None):
+    """Return a command string with the right redirection.
+
+    Args:
+        cmd (str): command to be executed.
+        filename (str): path to the log file, or placeholder to be formatted by Snakemake.
+        log_config (dict): optional log configuration. If specified, the output is piped
+            to the log sink, that caps the size of the log file and compresses the full output.
+    """
     # very verbose output, but may be useful
     cmd = f"""set -ex; {cmd}"""
+    if log_config is not None:
+        sink = build_log_sink_cmd(filename, log_config, tee=env_true("LOG_ALL_TO_STDERR"))
+        return f"set -o pipefail; ( {cmd} ) 2>&1 | {sink}"
     if env_true("LOG_ALL_TO_STDERR"):
         # Redirect stdout and stderr to file, and propagate everything to stderr.
         # Calling ``set -o pipefail`` is needed to propagate the exit code through the pipe.
@@ -84,6 +104,40 @@ def write_with_log(out_file, log_file):
             raise
 
 
+def _reflink(source, target):
+    """Clone source to target sharing the data blocks, if supported by the file system."""
+    with open(source, "rb") as src, open(target, "wb") as dst:
+        fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+
+
+def promote_file(source, target):
+    """Make the content of ``source`` available as ``target``, avoiding to copy the data.
+
+    It should be used by the rules that only relocate data, when the paths in the SONATA config
+    cannot point to the source instead. The file is cloned with a reflink, and it's copied
+    if reflinks are not supported, for example on GPFS or across file systems.
+
+    Args:
+        source (str|Path): source file.
+        target (str|Path): target file, replaced if it exists.
+
+    Returns:
+        the method used to promote the file: ``reflink`` or ``copy``.
+    """
+    target = Path(target)
+    target.parent.mkdir(parents=True, exist_ok=True)
+    target.unlink(missing_ok=True)
+    try:
+        _reflink(source, target)
+        method = "reflink"
+    except OSError:
+        target.unlink(missing_ok=True)
+        shutil.copy2(source, target)
+        method = "copy"
+    L.info("Promoted %s to %s with %s", source, target, method)
+    return method
+
+
 def read_schema(schema_name):
     """Load a schema and return the result as a dictionary."""
     resource = importlib.resources.files(PACKAGE_NAME) / SCHEMAS_DIR / schema_name
@@ -106,3 +160,117 @@ def clean_slurm_env():
         if key.startswith(("PMI_", "SLURM_")) and not key.endswith(("_ACCOUNT", "_PARTITION")):
             L.debug("Deleting env variable %s", key)
             del os.environ[key]
+
+
+def parse_salloc(salloc):
+    """Return a dict with the resources of each node requested with the given salloc parameters.
+
+    The returned dict contains the keys ``nodes``, ``cores_per_node`` and ``memory_per_node``
+    (in GB). If the allocation is exclusive, or the resources cannot be derived from the
+    parameters, the full resources of the nodes are considered.
+
+    It contains also the keys ``tasks_per_node``, ``cpus_per_task`` and ``memory_per_task``
+    (in GB), where the latter is None if the memory isn't requested explicitly and the allocation
+    isn't exclusive, because in that case it depends on the defaults of the partition.
+    """
+    options = {}
+    tokens = salloc.split()
+    for i, token in enumerate(tokens):
+        match = re.fullmatch(
+            r"(-N|-n|-c|--nodes|--ntasks|--cpus-per-task|--ntasks-per-node|--mem|--mem-per-cpu)"
+            r"=?(\d\S*)?",
+            token,
+        )
+        if match:
+            key, value = match.groups()
+            if not value and i + 1 < len(tokens):
+                value = tokens[i + 1]
+            options[key] = value
+        elif token == "--exclusive":
+            options[token] = True
+    nodes = int(options.get("-N") or options.get("--nodes") or 1)
+    cpus_per_task = options.get("-c") or options.get("--cpus-per-task")
+    if "--exclusive" in options or not cpus_per_task:
+        cores_per_node = CORES_PER_NODE
+    else:
+        cores_per_node = int(cpus_per_task) * int(options.get("--ntasks-per-node") or 1)
+    memory_per_node = MEMORY_PER_NODE_GB
+    match = re.fullmatch(r"(\d+)([KMGT]?)", options.get("--mem", ""))
+    if match and int(match.group(1)) > 0:
+        memory_per_node = int(match.group(1)) * MEMORY_UNITS[match.group(2) or "M"]
+    ntasks = options.get("-n") or options.get("--ntasks")
+    tasks_per_node = int(
+        options.get("--ntasks-per-node") or (math.ceil(int(ntasks) / nodes) if ntasks else 1)
+    )
+    # the tasks are distributed over more nodes if they don't fit in one node
+    tasks_per_node = max(1, min(tasks_per_node, cores_per_node // int(cpus_per_task or 1)))
+    if not cpus_per_task:
+        # without --cpus-per-task, only the exclusive allocations use all the cores of the node
+        cpus_per_task = cores_per_node // tasks_per_node if "--exclusive" in options else 1
+    cpus_per_task = int(cpus_per_task)
+    memory_per_task = None
+    if match := re.fullmatch(r"(\d+)([KMGT]?)", options.get("--mem-per-cpu", "")):
+        memory_per_task = int(match.group(1)) * MEMORY_UNITS[match.group(2) or "M"] * cpus_per_task
+    elif "--mem" in options or "--exclusive" in options:
+        memory_per_task = memory_per_node / tasks_per_node
+    return {
+        "nodes": nodes,
+        "cores_per_node": cores_per_node,
+        "memory_per_node": memory_per_node,
+        "tasks_per_node": tasks_per_node,
+        "cpus_per_task": cpus_per_task,
+        "memory_per_task": memory_per_task,
+    }
+
+
+def python_module_cmd(module):
+    """Return the command executing the given module with the current interpreter and PYTHONPATH.
+
+    The command should be executed in the environment ``WORKFLOW_ENV``, not in the environment of
+    other tools, since the modules loaded or the container started could provide libraries
+    incompatible with the interpreter executing the workflow.
+    """
+    pythonpath = shlex.quote(os.environ.get("PYTHONPATH", ""))
+    return f"PYTHONPATH={pythonpath} {shlex.quote(sys.executable)} -m {module}"
+
+
+class PathRegistry:
+    """Registry of the paths used by the workflow.
+
+    Each path is computed only once, and the parent directories are collected instead of being
+    created immediately, so that they can be created together when the workflow starts.
+    This avoids a filesystem round-trip for each rule in each process parsing the workflow.
+    """
+
+    def __init__(self):
+        """Initialize the object."""
+        self._paths = {}
+        self._dirs = set()
+        self._created = set()
+
+    def get(self, key, func):
+        """Return the path registered with the given key, computed with ``func`` only once."""
+        if key not in self._paths:
+            path = self._paths[key] = func()
+            parent = Path(path).parent
+            # the directories with wildcards are created by Snakemake, after they're expanded
+            if "{" not in str(parent):
+                self._dirs.add(parent)
+        return self._paths[key]
+
+    @property
+    def dirs(self):
+        """Return the sorted list of the parent directories of the registered paths."""
+        return sorted(self._dirs)
+
+    def makedirs(self, dirs=None):
+        """Create the given directories, or all the registered ones, if not already created.
+
+        Returns:
+            the list of the directories created in this call.
+        """
+        dirs = sorted(set(dirs or self._dirs).difference(self._created))
+        for path in dirs:
+            os.makedirs(path, exist_ok=True)
+        self._created.update(dirs)
+        return dirs
@@ -33,7 +33,10 @@ setup(
     python_requires=">=3.9",
     install_requires=[
         "click>=7.0",
+        "h5py",
         "jsonschema>=3.2.0",
+        "libsonata",
+        "numpy>=1.19",
         "pyyaml>=5.0",
         "snakemake>=6.0",
         # Explicitly pin pulp because snakemake<8.0 is broken with pulp>=2.8.0
@@ -42,6 +45,8 @@ setup(
     ],
     extras_require={
         "reports": ["snakemake[reports]"],
+        "parquet": ["pyarrow"],
+        "zstd": ["zstandard"],
     },
     packages=find_namespace_packages(include=["circuit_build*"]),
     include_package_data=True,
@@ -0,0 +1,19 @@
+import pytest
+from synthetic import make_bioname
+from utils import TEST_PROJ_TINY
+
+
+@pytest.fixture(scope="session")
+def tiny_bioname():
+    return TEST_PROJ_TINY
+
+
+@pytest.fixture(scope="session")
+def large_bioname(tmp_path_factory):
+    """Return a bioname with synthesis, NGV, many partitions and a large morphology release."""
+    return make_bioname(tmp_path_factory.mktemp("large") / "bioname", ngv=True, local=False)
+
+
+@pytest.fixture(params=["tiny", "large"])
+def bioname(request):
+    return request.getfixturevalue(f"{request.param}_bioname")
@@ -0,0 +1,303 @@
+"""Local stand-in of ``salloc``, ``srun`` and ``sbatch``, executing the jobs on the local cores.
+
+The stand-in simulates a cluster with a limited number of nodes and cores, shared by all the jobs
+submitted concurrently, and a configurable queue delay before each allocation is granted.
+The jobs wait in the queue until enough cores are available, and the commands are pinned to the
+local cores corresponding to the simulated cores of the allocation.
+
+The simulated cluster is configured with the env variables:
+
+- ``LOCAL_SLURM_NODES``: number of nodes (default 1).
+- ``LOCAL_SLURM_CORES_PER_NODE``: number of cores of each node (default: the local cores).
+- ``LOCAL_SLURM_QUEUE_DELAY``: seconds spent in the queue by each job before the allocation,
+  simulating the pending time in a busy cluster (default 0).
+- ``LOCAL_SLURM_STATE_DIR``: directory containing the state of the cluster, shared by the jobs,
+  and the accounting file ``jobs.jsonl`` with the queue and run times of the jobs.
+
+The executables are written by ``install``, and they must be found in PATH before the real ones.
+"""
+
+import fcntl
+import json
+import math
+import os
+import shlex
+import signal
+import stat
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+POLL_INTERVAL = 0.1
+COMMANDS = ["salloc", "srun", "sbatch"]
+# options without value, the other options are expected to have a value
+FLAGS = {
+    "--exclusive",
+    "--overcommit",
+    "-O",
+    "--contiguous",
+    "-k",
+    "--no-kill",
+    "-Q",
+    "--quiet",
+    "-v",
+    "--verbose",
+    "-W",
+    "--wait",
+}
+ALIASES = {
+    "-J": "--job-name",
+    "-N": "--nodes",
+    "-n": "--ntasks",
+    "-c": "--cpus-per-task",
+    "-o": "--output",
+    "-A": "--account",
+    "-p": "--partition",
+    "-C": "--constraint",
+    "-t": "--time",
+}
+
+
+def nodes_limit():
+    return int(os.environ.get("LOCAL_SLURM_NODES", 1))
+
+
+def cores_per_node():
+    return int(os.environ.get("LOCAL_SLURM_CORES_PER_NODE", os.cpu_count()))
+
+
+def queue_delay():
+    return float(os.environ.get("LOCAL_SLURM_QUEUE_DELAY", 0))
+
+
+def state_dir():
+    default = Path(tempfile.gettempdir(), f"local_slurm_{os.getuid()}")
+    path = Path(os.environ.get("LOCAL_SLURM_STATE_DIR", default))
+    path.mkdir(parents=True, exist_ok=True)
+    return path
+
+
+def parse_options(args):
+    """Return the dict of options, and the remaining command."""
+    options = {}
+    i = 0
+    while i < len(args) and args[i].startswith("-"):
+        token = args[i]
+        i += 1
+        if token in FLAGS:
+            options[ALIASES.get(token, token)] = True
+            continue
+        name, sep, value = token.partition("=")
+        if not sep:
+            if not name.startswith("--") and len(name) > 2:
+                # short option with attached value, e.g. -n2
+                name, value = name[:2], name[2:]
+            else:
+                value = args[i]
+                i += 1
+        options[ALIASES.get(name, name)] = value
+    return options, args[i:]
+
+
+def requested_resources(options):
+    """Return the number of nodes, tasks, cpus per task, and the total cpus of the allocation."""
+    per_node = cores_per_node()
+    cpus_per_task = int(options.get("--cpus-per-task", 1))
+    nodes = int(options["--nodes"]) if "--nodes" in options else None
+    ntasks = options.get("--ntasks")
+    if ntasks is None:
+        ntasks = (nodes or 1) * int(options.get("--ntasks-per-node", 1))
+    ntasks = int(ntasks)
+    if nodes is None:
+        nodes = math.ceil(ntasks * cpus_per_task / per_node)
+    cpus = nodes * per_node if options.get("--exclusive") else ntasks * cpus_per_task
+    return nodes, ntasks, cpus_per_task, cpus
+
+
+@contextmanager
+def _locked_state():
+    """Yield the state of the cluster, saved when the context exits."""
+    path = state_dir() / "state.json"
+    with open(state_dir() / "state.lock", "w", encoding="utf-8") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            state = json.loads(path.read_text(encoding="utf-8")) if path.exists() else {}
+            state.setdefault("last_job_id", 0)
+            state.setdefault("jobs", {})
+            # release the cores of the jobs killed without releasing them
+            state["jobs"] = {k: v for k, v in state["jobs"].items() if _pid_alive(v["pid"])}
+            yield state
+            path.write_text(json.dumps(state), encoding="utf-8")
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def new_job_id():
+    with _locked_state() as state:
+        state["last_job_id"] += 1
+        return state["last_job_id"]
+
+
+def _allocate(job_id, cpus):
+    """Return the list of the simulated cores allocated to the job, or None if not available."""
+    total = nodes_limit() * cores_per_node()
+    with _locked_state() as state:
+        used = {core for job in state["jobs"].values() for core in job["cores"]}
+        free = [core for core in range(total) if core not in used]
+        if len(free) < cpus:
+            return None
+        cores = free[:cpus]
+        state["jobs"][str(job_id)] = {"pid": os.getpid(), "cores": cores}
+        return cores
+
+
+def _release(job_id):
+    with _locked_state() as state:
+        state["jobs"].pop(str(job_id), None)
+
+
+def _account(record):
+    with open(state_dir() / "jobs.jsonl", "a", encoding="utf-8") as fd:
+        fd.write(json.dumps(record) + "\n")
+
+
+def _error(message):
+    print(f"salloc: error: {message}", file=sys.stderr)
+    return 1
+
+
+def salloc(args, job_id=None):
+    """Wait for the allocation, execute the command, and return its exit code."""
+    options, cmd = parse_options(args)
+    nodes, ntasks, cpus_per_task, cpus = requested_resources(options)
+    if nodes > nodes_limit() or cpus > nodes * cores_per_node():
+        return _error("Job submit/allocate failed: Requested node configuration is not available")
+    job_id = job_id or new_job_id()
+    name = options.get("--job-name", Path(cmd[0]).name if cmd else "interactive")
+    submitted = time.time()
+    time.sleep(queue_delay())
+    while (cores := _allocate(job_id, cpus)) is None:
+        time.sleep(POLL_INTERVAL)
+    started = time.time()
+    print(f"salloc: Granted job allocation {job_id}", file=sys.stderr)
+    env = os.environ | {
+        "SLURM_JOB_ID": str(job_id),
+        "SLURM_JOB_NAME": name,
+        "SLURM_NNODES": str(nodes),
+        "SLURM_JOB_NUM_NODES": str(nodes),
+        "SLURM_NTASKS": str(ntasks),
+        "SLURM_CPUS_PER_TASK": str(cpus_per_task),
+        "LOCAL_SLURM_CORES": ",".join(map(str, cores)),
+    }
+    local_cores = {core % os.cpu_count() for core in cores}
+    returncode = 1
+    try:
+        with subprocess.Popen(
+            cmd or [os.environ.get("SHELL", "sh")],
+            env=env,
+            preexec_fn=lambda: os.sched_setaffinity(0, local_cores),
+        ) as process:
+            signal.signal(signal.SIGTERM, lambda signum, frame: process.send_signal(signum))
+            returncode = process.wait()
+    finally:
+        _release(job_id)
+        _account(
+            {
+                "job_id": job_id,
+                "name": name,
+                "nodes": nodes,
+                "cpus": cpus,
+                "submitted": submitted,
+                "started": started,
+                "finished": time.time(),
+                "returncode": returncode,
+            }
+        )
+    return returncode
+
+
+def srun(args):
+    """Execute the tasks in the current allocation, or in a new allocation if there isn't any."""
+    options, cmd = parse_options(args)
+    if "SLURM_JOB_ID" not in os.environ:
+        return salloc([*args[: len(args) - len(cmd)], *_command("srun"), *cmd])
+    ntasks = int(options.get("--ntasks", os.environ.get("SLURM_NTASKS", 1)))
+    processes = [
+        subprocess.Popen(  # pylint: disable=consider-using-with
+            cmd, env=os.environ | {"SLURM_PROCID": str(i), "SLURM_LOCALID": str(i)}
+        )
+        for i in range(ntasks)
+    ]
+    return max(process.wait() for process in processes)
+
+
+def sbatch(args):
+    """Submit the script or the wrapped command in background, and print the job id."""
+    options, cmd = parse_options(args)
+    job_id = new_job_id()
+    if "--wrap" in options:
+        cmd = ["sh", "-c", options.pop("--wrap")]
+    else:
+        cmd = ["sh", *cmd]
+    output = options.get("--output", "slurm-%j.out").replace("%j", str(job_id))
+    salloc_args = [f"{k}={v}" if v is not True else k for k, v in options.items()]
+    salloc_args = [a for a in salloc_args if not a.startswith(("--output", "--wait"))]
+    job = [*_command("salloc"), f"--local-job-id={job_id}", *salloc_args, *cmd]
+    with open(output, "w", encoding="utf-8") as fd:
+        process = subprocess.Popen(  # pylint: disable=consider-using-with
+            job, stdout=fd, stderr=subprocess.STDOUT, start_new_session=True
+        )
+    print(f"Submitted batch job {job_id}")
+    return process.wait() if options.get("--wait") else 0
+
+
+def _command(name):
+    return [sys.executable, str(Path(__file__).resolve()), name]
+
+
+def install(bin_dir):
+    """Write the executables ``salloc``, ``srun`` and ``sbatch`` in bin_dir, and return bin_dir."""
+    bin_dir = Path(bin_dir)
+    bin_dir.mkdir(parents=True, exist_ok=True)
+    for name in COMMANDS:
+        path = bin_dir / name
+        path.write_text(
+            f'#!/bin/sh\nexec {shlex.join(_command(name))} "$@"\n',
+            encoding="utf-8",
+        )
+        path.chmod(path.stat().st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+    return bin_dir
+
+
+def load_accounting(path=None):
+    """Return the records of the finished jobs."""
+    path = Path(path) if path else state_dir() / "jobs.jsonl"
+    with open(path, encoding="utf-8") as fd:
+        return [json.loads(line) for line in fd]
+
+
+def main(argv):
+    command, args = argv[0], argv[1:]
+    if command == "salloc":
+        job_id = None
+        if args and args[0].startswith("--local-job-id="):
+            job_id = int(args.pop(0).partition("=")[2])
+        return salloc(args, job_id=job_id)
+    return {"srun": srun, "sbatch": sbatch}[command](args)
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,96 @@
+"""Stub of the external tools of the connectome, writing dummy outputs of the configured size.
+
+The tool to emulate is selected by the first argument, passed by the wrapper scripts written by
+``synthetic.make_stub_tools``.
+The size in bytes of each output file and the number of files written by each job are read from
+the env variables ``STUB_OUTPUT_SIZE`` and ``STUB_OUTPUT_FILES``.
+"""
+
+import os
+import sys
+from pathlib import Path
+
+try:
+    import numpy as np
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # pragma: no cover
+    pq = None
+
+CHUNK_SIZE = 2**20
+GID_COLUMNS = ("pre_neuron_id", "post_neuron_id")
+
+
+def _option(args, name):
+    """Return the value of the option with the given name."""
+    return args[args.index(name) + 1]
+
+
+def _output_size():
+    return int(os.environ.get("STUB_OUTPUT_SIZE", CHUNK_SIZE))
+
+
+def _output_files():
+    return int(os.environ.get("STUB_OUTPUT_FILES", 1))
+
+
+def write_dummy_file(path, size):
+    """Write a file with the given size in bytes."""
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    chunk = b"\0" * min(size, CHUNK_SIZE)
+    with open(path, "wb") as fd:
+        for offset in range(0, size, CHUNK_SIZE):
+            fd.write(chunk[: size - offset])
+
+
+def write_parquet_file(path, size, seed=0):
+    """Write a Parquet file with random gids, with about the given size before compression."""
+    if pq is None:
+        write_dummy_file(path, size)
+        return
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    rows = max(1, size // (8 * len(GID_COLUMNS)))
+    rng = np.random.default_rng(seed)
+    table = pa.table({name: rng.integers(0, 10**6, rows) for name in GID_COLUMNS})
+    pq.write_table(table, path)
+
+
+def touchdetector(args):
+    output_dir = Path(_option(args, "--output"))
+    for i in range(_output_files()):
+        write_dummy_file(output_dir / f"touchesData.{i}", _output_size())
+
+
+def touch2parquet(args):
+    # executed in the output directory, with the raw touch files as arguments
+    for i, _ in enumerate(args):
+        write_parquet_file(f"touches.{i}.parquet", _output_size(), seed=i)
+
+
+def functionalizer(args):
+    output_dir = Path(_option(args, "--output-dir"), "circuit.parquet")
+    for i in range(_output_files()):
+        write_parquet_file(output_dir / f"part-{i:05d}.parquet", _output_size(), seed=i)
+    (output_dir / "_SUCCESS").touch()
+
+
+def parquet2hdf5(args):
+    _, output, _ = args
+    write_dummy_file(output, _output_size())
+
+
+def dplace(args):
+    os.execvp(args[0], args)
+
+
+TOOLS = {
+    "touchdetector": touchdetector,
+    "touch2parquet": touch2parquet,
+    "functionalizer": functionalizer,
+    "parquet2hdf5": parquet2hdf5,
+    "dplace": dplace,
+}
+
+
+if __name__ == "__main__":
+    TOOLS[sys.argv[1]](sys.argv[2:])
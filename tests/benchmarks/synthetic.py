@@ -0,0 +1,175 @@
+"""Generator of synthetic large circuits, to test and benchmark the workflow at scale offline.
+
+The generated bioname is derived from the synthesis test bioname, optionally with NGV, and it
+contains many partitions, a large morphology release with empty files, and extra projection
+populations. The environments of the connectome are replaced by stub tools writing dummy outputs,
+so the connectome rules can be executed on one machine to measure the overhead of the workflow.
+"""
+
+import json
+import shlex
+import shutil
+import stat
+import sys
+from pathlib import Path
+
+from stub_tool import TOOLS, write_dummy_file, write_parquet_file
+from utils import TEST_NGV_FULL, TEST_PROJ_SYNTH, edit_yaml
+
+from circuit_build.utils import dump_yaml
+
+STUB_TOOL = Path(__file__).resolve().parent / "stub_tool.py"
+STUB_ENVS = ["touchdetector", "parquet-converters", "spykfunc"]
+# rules executed with the stub tools, while the outputs of the other rules are generated
+CONNECTOME_RULES = [
+    "touchdetector",
+    "touch2parquet",
+    "touch_statistics",
+    "spykfunc_s2f",
+    "spykfunc_merge",
+    "parquet_to_sonata",
+    "projection_to_sonata",
+]
+
+
+def make_morphology_release(path, count):
+    """Create a morphology release with empty files, large enough to be slow to validate."""
+    for subdir, ext in [("ascii", "asc"), ("h5v1", "h5")]:
+        Path(path, subdir).mkdir(parents=True)
+        for i in range(count):
+            Path(path, subdir, f"morph_{i:06d}.{ext}").touch()
+    return path
+
+
+def make_node_sets(path, partitions, cells):
+    """Write the node sets file with one node set of contiguous ids for each partition."""
+    size = max(1, cells // len(partitions))
+    node_sets = {
+        name: {"node_id": list(range(i * size, (i + 1) * size))}
+        for i, name in enumerate(partitions)
+    }
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    Path(path).write_text(json.dumps(node_sets), encoding="utf-8")
+    return path
+
+
+def make_stub_tools(bin_dir, output_size, output_files=1):
+    """Write the stub tools and the file to be sourced to use them, and return its path.
+
+    Args:
+        bin_dir (str|Path): directory where the stub tools are written.
+        output_size (int): size in bytes of each file written by the stub tools.
+        output_files (int): number of files written by each job.
+    """
+    bin_dir = Path(bin_dir)
+    bin_dir.mkdir(parents=True, exist_ok=True)
+    for name in TOOLS:
+        path = bin_dir / name
+        path.write_text(
+            f'#!/bin/sh\nexec {shlex.quote(sys.executable)} {STUB_TOOL} {name} "$@"\n',
+            encoding="utf-8",
+        )
+        path.chmod(path.stat().st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+    activate = bin_dir / "activate"
+    activate.write_text(
+        f"export PATH={bin_dir}:$PATH "
+        f"STUB_OUTPUT_SIZE={output_size} STUB_OUTPUT_FILES={output_files}\n",
+        encoding="utf-8",
+    )
+    return activate
+
+
+def make_bioname(
+    path,
+    *,
+    partitions=64,
+    morphologies=20000,
+    projections=0,
+    ngv=False,
+    output_size=2**20,
+    output_files=1,
+    local=True,
+    cluster_config=None,
+):
+    """Create a synthetic bioname, and return its path.
+
+    Args:
+        path (str|Path): path to the bioname directory to be created.
+        partitions (int): number of partitions of the connectome.
+        morphologies (int): number of files in each directory of the morphology release.
+        projections (int): number of extra edge populations, converted from Parquet.
+        ngv (bool): True to include the NGV configuration.
+        output_size (int): size in bytes of each file written by the stub tools.
+        output_files (int): number of files written by each job of the stub tools.
+        local (bool): True to use the stub tools in the connectome rules, and to execute the jobs
+            with ``cluster_config``. If False, the environments and the cluster config are not
+            changed.
+        cluster_config (dict): cluster config used when ``local`` is True. If None, the jobs are
+            executed without Slurm.
+    """
+    source = TEST_NGV_FULL if ngv else TEST_PROJ_SYNTH
+    bioname = Path(path)
+    shutil.copytree(source, bioname, ignore=shutil.ignore_patterns("entities"))
+    entities = bioname / "entities"
+    entities.mkdir()
+    for entity in (source / "entities").resolve().iterdir():
+        if entity.name != "morphologies":
+            (entities / entity.name).symlink_to(entity.resolve())
+    make_morphology_release(entities / "morphologies", morphologies)
+    if local:
+        activate = make_stub_tools(bioname / "stubs", output_size, output_files)
+        env_config = {name: {"env_type": "VENV", "path": str(activate)} for name in STUB_ENVS}
+        dump_yaml(bioname / "environments.yaml", {"env_config": env_config})
+        dump_yaml(bioname / "cluster.yaml", cluster_config or {})
+    with edit_yaml(bioname / "MANIFEST.yaml") as manifest:
+        manifest["common"]["partition"] = [f"partition_{i}" for i in range(partitions)]
+        if ngv:
+            # the vasculature is an input of the rules, resolved from the working directory
+            vasculature = bioname / manifest["ngv"]["common"]["vasculature"]
+            manifest["ngv"]["common"]["vasculature"] = str(vasculature)
+        if projections:
+            nodes_file = entities / "projections" / "virtual_nodes.h5"
+            write_dummy_file(nodes_file, output_size)
+            edges = {}
+            for i in range(projections):
+                parquet_dir = entities / "projections" / f"projection_{i}"
+                write_parquet_file(parquet_dir / "edges.parquet", output_size, seed=i)
+                edges[f"projection_{i}"] = {
+                    "population_type": "chemical",
+                    "parquet_dir": str(parquet_dir.relative_to(bioname)),
+                }
+            manifest["extra_populations"] = {
+                "nodes": {
+                    "projections": {"population_type": "virtual", "nodes_file": str(nodes_file)}
+                },
+                "edges": edges,
+            }
+    return bioname
+
+
+def make_circuit_inputs(ctx, cells=1000, output_size=2**20):
+    """Write the dummy outputs of the rules preceding the connectome in the circuit directory.
+
+    Args:
+        ctx (circuit_build.context.Context): context of the synthetic bioname.
+        cells (int): number of cells in the node sets.
+        output_size (int): size in bytes of the dummy files.
+    """
+    for path in [
+        ctx.paths.auxiliary_path("circuit_config_hpc.json"),
+        ctx.paths.auxiliary_path("circuit.synthesized_morphologies.h5"),
+    ]:
+        write_dummy_file(path, output_size)
+    make_node_sets(ctx.NODESETS_FILE, ctx.PARTITION, cells)
+
+
+def connectome_targets(ctx):
+    """Return the files built by the connectome rules."""
+    return [
+        str(p) for p in [ctx.edges_neurons_neurons_file("functional"), *ctx.projection_edges_files]
+    ]
+
+
+def snakemake_config(bioname):
+    """Return the config passed to Snakemake, as done by the command line interface."""
+    return {"bioname": str(bioname), "cluster_config": str(bioname / "cluster.yaml")}
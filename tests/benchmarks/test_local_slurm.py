@@ -0,0 +1,65 @@
+import local_slurm as test_module
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def simulated_cluster(tmp_path, monkeypatch):
+    monkeypatch.setenv("LOCAL_SLURM_STATE_DIR", str(tmp_path / "slurm"))
+    monkeypatch.setenv("LOCAL_SLURM_NODES", "2")
+    monkeypatch.setenv("LOCAL_SLURM_CORES_PER_NODE", "4")
+
+
+@pytest.mark.parametrize(
+    "args, expected_options, expected_resources",
+    [
+        (
+            ["-J", "td", "-p", "prod", "-n2", "--time", "0:10:00", "srun", "sh"],
+            {"--job-name": "td", "--partition": "prod", "--ntasks": "2", "--time": "0:10:00"},
+            (1, 2, 1, 2),
+        ),
+        (
+            ["-N", "2", "--exclusive", "--mem=0", "srun", "sh"],
+            {"--nodes": "2", "--exclusive": True, "--mem": "0"},
+            (2, 2, 1, 8),
+        ),
+        (
+            ["--ntasks=3", "-c", "2", "srun", "sh"],
+            {"--ntasks": "3", "--cpus-per-task": "2"},
+            (2, 3, 2, 6),
+        ),
+    ],
+)
+def test_parse_options(args, expected_options, expected_resources):
+    options, cmd = test_module.parse_options(args)
+
+    assert options == expected_options
+    assert cmd == ["srun", "sh"]
+    assert test_module.requested_resources(options) == expected_resources
+
+
+def test_salloc_srun(tmp_path, capfd):
+    output = tmp_path / "output"
+
+    returncode = test_module.salloc(
+        [
+            "-J",
+            "myjob",
+            "-n2",
+            *test_module._command("srun"),
+            "sh",
+            "-c",
+            f"echo $SLURM_PROCID >> {output}",
+        ]
+    )
+
+    assert returncode == 0
+    assert sorted(output.read_text().split()) == ["0", "1"]
+    (job,) = test_module.load_accounting()
+    assert job["name"] == "myjob"
+    assert job["cpus"] == 2
+    assert "Granted job allocation 1" in capfd.readouterr().err
+
+
+def test_salloc_fails_when_nodes_are_not_available(capfd):
+    assert test_module.salloc(["-N", "3", "true"]) == 1
+    assert "Requested node configuration is not available" in capfd.readouterr().err
@@ -0,0 +1,90 @@
+"""Benchmarks of the startup of the workflow, executed once for each job by Snakemake."""
+
+from collections import Counter
+
+import pytest
+import snakemake
+from synthetic import snakemake_config
+from utils import cwd
+
+from circuit_build import context
+from circuit_build.utils import load_yaml
+from circuit_build.validators import validate_config, validate_morphology_release
+
+
+def _load_config(bioname):
+    return load_yaml(bioname / "MANIFEST.yaml") | snakemake_config(bioname)
+
+
+def _target(bioname):
+    return "ngv" if "ngv" in load_yaml(bioname / "MANIFEST.yaml") else "functional"
+
+
+@pytest.fixture
+def config_get_calls(monkeypatch):
+    """Count the calls to Config.get, by keys."""
+    calls = Counter()
+    original = context.Config.get
+
+    def get(self, keys, *, default=None):
+        calls[str(keys)] += 1
+        return original(self, keys, default=default)
+
+    monkeypatch.setattr(context.Config, "get", get)
+    return calls
+
+
+@pytest.fixture(autouse=True)
+def workdir(tmp_path, monkeypatch):
+    monkeypatch.setenv("CIRCUIT_BUILD_SKIP_GIT_CHECK", "true")
+    with cwd(tmp_path):
+        yield tmp_path
+
+
+def test_context_init(benchmark, bioname, config_get_calls):
+    config = _load_config(bioname)
+
+    benchmark(context.Context, config=config)
+
+    config_get_calls.clear()
+    context.Context(config=config)
+    benchmark.extra_info["config_get_calls"] = config_get_calls.total()
+
+
+def test_validate_manifest(benchmark, bioname):
+    config = _load_config(bioname)
+
+    benchmark(validate_config, config, "MANIFEST.yaml")
+
+
+def test_validate_cluster_config(benchmark, bioname):
+    cluster_config = load_yaml(bioname / "cluster.yaml")
+
+    benchmark(validate_config, cluster_config, "cluster.yaml")
+
+
+def test_validate_morphology_release(benchmark, bioname):
+    release = bioname / load_yaml(bioname / "MANIFEST.yaml")["common"]["morph_release"]
+
+    benchmark(validate_morphology_release, release)
+
+
+def test_build_dag(benchmark, bioname, snakefile, workdir, config_get_calls):
+    config = snakemake_config(bioname)
+
+    def build_dag():
+        return snakemake.snakemake(
+            snakefile,
+            config=config,
+            targets=[_target(bioname)],
+            workdir=str(workdir),
+            dryrun=True,
+            quiet=True,
+        )
+
+    result = benchmark.pedantic(build_dag, rounds=3, iterations=1, warmup_rounds=1)
+
+    assert result is True
+    config_get_calls.clear()
+    build_dag()
+    benchmark.extra_info["config_get_calls"] = config_get_calls.total()
@@ -0,0 +1,120 @@
+"""Benchmarks of the orchestration of the connectome rules, executed with the stub tools."""
+
+import os
+import shutil
+import statistics
+
+import local_slurm
+import pytest
+import snakemake
+from synthetic import (
+    CONNECTOME_RULES,
+    connectome_targets,
+    make_bioname,
+    make_circuit_inputs,
+    snakemake_config,
+)
+from utils import cwd
+
+from circuit_build.context import Context
+
+PARTITIONS = 8
+PROJECTIONS = 4
+CORES = 4
+# allocations of the jobs in the local stand-in of Slurm
+CLUSTER_CONFIG = {
+    "__default__": {"salloc": "-p prod -n1 --time 0:10:00"},
+    "touchdetector": {"jobname": "td", "salloc": "-p prod -n2 --time 0:10:00"},
+    "spykfunc_s2f": {"jobname": "s2f", "salloc": "-p prod -N1 --exclusive --mem 0"},
+    "spykfunc_merge": {"jobname": "merge", "salloc": "-p prod -N1 --exclusive --mem 0"},
+}
+# resources of the simulated cluster
+SLURM_NODES = 2
+SLURM_CORES_PER_NODE = 2
+
+
+@pytest.fixture(scope="module")
+def synthetic_bioname(tmp_path_factory):
+    return make_bioname(
+        tmp_path_factory.mktemp("synthetic") / "bioname",
+        partitions=PARTITIONS,
+        morphologies=1000,
+        projections=PROJECTIONS,
+    )
+
+
+@pytest.fixture(scope="module")
+def synthetic_bioname_slurm(tmp_path_factory):
+    return make_bioname(
+        tmp_path_factory.mktemp("synthetic_slurm") / "bioname",
+        partitions=PARTITIONS,
+        morphologies=1000,
+        projections=PROJECTIONS,
+        cluster_config=CLUSTER_CONFIG,
+    )
+
+
+def _run_connectome(benchmark, bioname, snakefile, circuit_dir, cores):
+    """Run the connectome rules with Snakemake, and check the targets."""
+    config = snakemake_config(bioname)
+
+    def setup():
+        shutil.rmtree(circuit_dir, ignore_errors=True)
+        circuit_dir.mkdir()
+        with cwd(circuit_dir):
+            make_circuit_inputs(Context(config=config))
+        return (), {}
+
+    def build():
+        with cwd(circuit_dir):
+            return snakemake.snakemake(
+                snakefile,
+                config=config,
+                targets=connectome_targets(Context(config=config)),
+                allowed_rules=CONNECTOME_RULES,
+                workdir=str(circuit_dir),
+                cores=cores,
+                quiet=True,
+            )
+
+    result = benchmark.pedantic(build, setup=setup, rounds=1)
+
+    assert result is True
+    with cwd(circuit_dir):
+        targets = connectome_targets(Context(config=config))
+    assert all((circuit_dir / path).stat().st_size > 0 for path in targets)
+    benchmark.extra_info["jobs"] = 4 * PARTITIONS + 2 + PROJECTIONS
+
+
+@pytest.fixture(autouse=True)
+def skip_git_check(monkeypatch):
+    monkeypatch.setenv("CIRCUIT_BUILD_SKIP_GIT_CHECK", "true")
+
+
+def test_connectome(benchmark, synthetic_bioname, snakefile, tmp_path):
+    _run_connectome(benchmark, synthetic_bioname, snakefile, tmp_path / "circuit", cores=CORES)
+
+
+@pytest.mark.parametrize("queue_delay", [0, 1])
+def test_connectome_local_slurm(
+    benchmark, synthetic_bioname_slurm, snakefile, tmp_path, monkeypatch, queue_delay
+):
+    bin_dir = local_slurm.install(tmp_path / "bin")
+    monkeypatch.setenv("PATH", f"{bin_dir}:{os.environ['PATH']}")
+    monkeypatch.setenv("LOCAL_SLURM_STATE_DIR", str(tmp_path / "slurm"))
+    monkeypatch.setenv("LOCAL_SLURM_NODES", str(SLURM_NODES))
+    monkeypatch.setenv("LOCAL_SLURM_CORES_PER_NODE", str(SLURM_CORES_PER_NODE))
+    monkeypatch.setenv("LOCAL_SLURM_QUEUE_DELAY", str(queue_delay))
+
+    # more concurrent jobs than the simulated cluster can run, so the jobs wait in the queue
+    _run_connectome(
+        benchmark, synthetic_bioname_slurm, snakefile, tmp_path / "circuit", cores=4 * CORES
+    )
+
+    jobs = local_slurm.load_accounting()
+    assert jobs
+    assert all(job["returncode"] == 0 for job in jobs)
+    benchmark.extra_info["slurm_jobs"] = len(jobs)
+    benchmark.extra_info["mean_queue_time"] = statistics.mean(
+        job["started"] - job["submitted"] for job in jobs
+    )
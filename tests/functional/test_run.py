@@ -15,7 +15,8 @@ from click.testing import CliRunner
 from utils import TEST_PROJ_TINY, cwd, edit_yaml, load_yaml
 
 from circuit_build.cli import run
-from circuit_build.constants import INDEX_SUCCESS_FILE
+from circuit_build.commands import build_command
+from circuit_build.constants import ENV_CONFIG, INDEX_SUCCESS_FILE
 
 
 def _assert_git_initialized(path):
@@ -160,6 +161,79 @@ def test_no_emodel(tmp_path):
         assert tmp_path.joinpath("auxiliary", "circuit.h5").stat().st_size > 100
 
 
+def test_emodels_in_chunks(tmp_path):
+    data_dir = TEST_PROJ_TINY
+
+    with cwd(tmp_path):
+        data_copy_dir = tmp_path / data_dir.name
+        shutil.copytree(data_dir, data_copy_dir)
+        with edit_yaml(data_copy_dir / "MANIFEST.yaml") as manifest:
+            manifest.setdefault("assign_emodels", {})["chunk_size"] = 10
+            manifest.setdefault("provide_me_info", {})["chunk_size"] = 10
+        node_population_name = manifest["common"]["node_population_name"]
+        args = [
+            "--bioname",
+            str(data_copy_dir),
+            "--cluster-config",
+            str(data_copy_dir / "cluster.yaml"),
+        ]
+
+        runner = CliRunner()
+        result = runner.invoke(run, args + ["provide_me_info"], catch_exceptions=False)
+        assert result.exit_code == 0
+        assert tmp_path.joinpath("auxiliary", "mecombo_emodel.h5").is_file()
+        nodes_file = tmp_path / f"sonata/networks/nodes/{node_population_name}/nodes.h5"
+        with h5py.File(nodes_file, "r") as h5:
+            attributes = h5[f"nodes/{node_population_name}/0"]
+            assert "me_combo" in attributes
+            assert "model_template" in attributes
+
+
+def test_node_sets__atlas_based(tmp_path):
+    data_dir = TEST_PROJ_TINY
+
+    with cwd(tmp_path):
+        data_copy_dir = tmp_path / data_dir.name
+        shutil.copytree(data_dir, data_copy_dir)
+        with edit_yaml(data_copy_dir / "targets.yaml") as targets:
+            targets["targets"]["atlas_based"] = {"cylinder": "{[mask]mc2}"}
+        manifest = load_yaml(data_copy_dir / "MANIFEST.yaml")
+        node_population_name = manifest["common"]["node_population_name"]
+        args = [
+            "--bioname",
+            str(data_copy_dir),
+            "--cluster-config",
+            str(data_copy_dir / "cluster.yaml"),
+        ]
+
+        runner = CliRunner()
+        result = runner.invoke(run, args + ["node_sets"], catch_exceptions=False)
+        assert result.exit_code == 0
+
+        # the atlas based node sets resolved by brainbuilder are used as reference
+        nodes_file = tmp_path / f"sonata/networks/nodes/{node_population_name}/nodes.h5"
+        cmd = build_command(
+            cmd=[
+                "brainbuilder targets node-sets",
+                f"--targets {data_copy_dir / 'targets.yaml'}",
+                f"--population {node_population_name}",
+                f"--atlas {data_copy_dir / 'entities/atlas'}",
+                f"--atlas-cache {tmp_path / 'brainbuilder_atlas_cache'}",
+                f"--output {tmp_path / 'expected_node_sets.json'}",
+                str(nodes_file),
+            ],
+            env_config=ENV_CONFIG,
+            env_name="brainbuilder",
+            cluster_config={},
+        )
+        subprocess.run(["bash", "-c", cmd.format(log=tmp_path / "expected.log")], check=True)
+
+        result = json.loads((tmp_path / "sonata/node_sets.json").read_text(encoding="utf-8"))
+        expected = json.loads((tmp_path / "expected_node_sets.json").read_text(encoding="utf-8"))
+        assert result == expected
+        assert len(result["cylinder"]["node_id"]) > 0
+
+
 def test_custom_module(tmp_path, caplog, capfd, snakemake_args):
     with cwd(tmp_path):
         args = snakemake_args + ["-m", "brainbuilder:invalid_module1:invalid_module_path"]
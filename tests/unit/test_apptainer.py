@@ -0,0 +1,160 @@
+import os
+import subprocess
+from unittest.mock import patch
+
+import pytest
+
+from circuit_build import apptainer as test_module
+
+
+@pytest.fixture(autouse=True)
+def clear_cache():
+    test_module.resolve_executable.cache_clear()
+
+
+def _completed(returncode=0, stdout="", stderr=""):
+    return subprocess.CompletedProcess([], returncode, stdout=stdout, stderr=stderr)
+
+
+def test_resolve_executable_with_absolute_path():
+    with patch.object(test_module.subprocess, "run") as mock_run:
+        result = test_module.resolve_executable("/bin/apptainer", "/modules", ("apptainer",))
+
+    assert result == "/bin/apptainer"
+    mock_run.assert_not_called()
+
+
+def test_resolve_executable_loads_the_modules_once():
+    with patch.object(
+        test_module.subprocess, "run", return_value=_completed(stdout="loaded\n/bin/singularity\n")
+    ) as mock_run:
+        for _ in range(2):
+            result = test_module.resolve_executable("singularity", "/modules", ("singularityce",))
+
+    assert result == "/bin/singularity"
+    mock_run.assert_called_once()
+    cmd = mock_run.call_args.args[0][-1]
+    assert "module use /modules && module load singularityce && command -v singularity" in cmd
+
+
+def test_resolve_executable_raises_when_not_found():
+    with patch.object(
+        test_module.subprocess, "run", return_value=_completed(1, stderr="module not found")
+    ):
+        with pytest.raises(RuntimeError, match="Unable to find the executable missing-executable"):
+            test_module.resolve_executable("missing-executable", "/modules", ("missing",))
+
+
+def test_apptainer_instances(tmp_path):
+    image = tmp_path / "brainbuilder_0.17.1.sif"
+    image.touch()
+    (tmp_path / "latest.sif").symlink_to(image.name)
+    env_config = {
+        "brainbuilder": {
+            "env_type": "APPTAINER",
+            "image": str(tmp_path / "latest.sif"),
+            "executable": "/bin/apptainer",
+            "options": "--cleanenv",
+            "instance": True,
+        },
+        "synthesis": {"env_type": "APPTAINER", "image": "missing.sif"},
+        "parquet-converters": {"env_type": "MODULE", "modules": ["parquet-converters"]},
+    }
+
+    with patch.object(test_module.subprocess, "run") as mock_run:
+        result = test_module.apptainer_instances(env_config, build_id="20240101T000000")
+
+    # the executable is resolved only when the instances are started
+    mock_run.assert_not_called()
+    assert result == {
+        "brainbuilder": test_module.ApptainerInstance(
+            name="circuit-build-brainbuilder-20240101T000000",
+            executable="/bin/apptainer",
+            image=image,
+            options="--cleanenv",
+        )
+    }
+    instance = result["brainbuilder"]
+    assert instance.executable_var == "CIRCUIT_BUILD_BRAINBUILDER_20240101T000000_EXECUTABLE"
+    assert instance.start_cmd("/bin/apptainer") == (
+        "/bin/apptainer --version && /bin/apptainer instance start --cleanenv "
+        f"{image} circuit-build-brainbuilder-20240101T000000"
+    )
+
+
+@pytest.mark.parametrize(
+    "options, expected",
+    [
+        ("", ""),
+        ("--cleanenv --containall --bind $TMPDIR:/tmp,/gpfs", "--cleanenv"),
+        (
+            "-C -B /gpfs --env 'A=1 2' --env-file=env.txt --no-eval",
+            "--cleanenv --env 'A=1 2' --env-file=env.txt --no-eval",
+        ),
+    ],
+)
+def test_exec_options(options, expected):
+    instance = test_module.ApptainerInstance(
+        name="instance", executable="apptainer", image="image.sif", options=options
+    )
+
+    assert instance.exec_options == expected
+
+
+@patch.dict(os.environ)
+def test_start_exports_the_resolved_executable():
+    instance = test_module.ApptainerInstance(
+        name="instance", executable="apptainer", image="image.sif", options="--cleanenv"
+    )
+    results = [_completed(stdout="/bin/apptainer\n"), _completed()]
+
+    with patch.object(test_module.subprocess, "run", side_effect=results) as mock_run:
+        instance.start()
+
+    assert os.environ[instance.executable_var] == "/bin/apptainer"
+    assert mock_run.call_count == 2
+    assert mock_run.call_args.args[0][-1] == instance.start_cmd("/bin/apptainer")
+
+
+def test_stop_without_start(monkeypatch):
+    instance = test_module.ApptainerInstance(
+        name="instance", executable="apptainer", image="image.sif", options=""
+    )
+    monkeypatch.delenv(instance.executable_var, raising=False)
+
+    with patch.object(test_module.subprocess, "run") as mock_run:
+        instance.stop()
+
+    mock_run.assert_not_called()
+
+
+def test_apptainer_instances_raises_when_the_image_is_missing(tmp_path):
+    env_config = {
+        "brainbuilder": {
+            "env_type": "APPTAINER",
+            "image": str(tmp_path / "missing.sif"),
+            "executable": "/bin/apptainer",
+            "instance": True,
+        },
+    }
+
+    with pytest.raises(ValueError, match="The image of the environment brainbuilder"):
+        test_module.apptainer_instances(env_config, build_id="1")
+
+
+@patch.dict(os.environ)
+def test_start_instances_stops_the_started_instances_on_failure():
+    instances = [
+        test_module.ApptainerInstance(
+            name=f"instance-{i}", executable="/bin/apptainer", image="image.sif", options=""
+        )
+        for i in range(3)
+    ]
+    results = [_completed(), _completed(1)]
+
+    with patch.object(test_module.subprocess, "run", side_effect=results + [_completed()]) as mock:
+        with pytest.raises(RuntimeError, match="Unable to start the container instance instance-1"):
+            test_module.start_instances(instances)
+
+    assert mock.call_count == 3
+    assert mock.call_args.args[0] == ["/bin/apptainer", "instance", "stop", "instance-0"]
@@ -0,0 +1,78 @@
+import numpy as np
+import pytest
+
+from circuit_build import atlas as test_module
+
+HIERARCHY = {
+    "id": 1,
+    "acronym": "root",
+    "children": [
+        {"id": 2, "acronym": "L1", "children": [{"id": 4, "acronym": "L1a"}]},
+        {"id": 3, "acronym": "L2"},
+    ],
+}
+
+
+def _write_nrrd(path, data, encoding="raw"):
+    header = (
+        "NRRD0004\n"
+        "# comment\n"
+        "type: unsigned short\n"
+        "dimension: 3\n"
+        f"sizes: {' '.join(str(s) for s in data.shape)}\n"
+        "space directions: (10,0,0) (0,10,0) (0,0,25)\n"
+        "space origin: (-10,0,0)\n"
+        "endian: little\n"
+        f"encoding: {encoding}\n\n"
+    )
+    path.write_bytes(header.encode() + data.astype("<u2").tobytes(order="F"))
+
+
+def test_read_nrrd_raw(tmp_path):
+    path = tmp_path / "data.nrrd"
+    data = np.arange(24, dtype=np.uint16).reshape((4, 3, 2), order="F")
+    _write_nrrd(path, data)
+
+    header, result = test_module.read_nrrd(path)
+
+    assert result.tolist() == list(range(24))
+    assert test_module.voxel_volume(header) == pytest.approx(2500e-9)
+
+
+def test_read_volume(tmp_path):
+    path = tmp_path / "data.nrrd"
+    data = np.arange(24, dtype=np.uint16).reshape((4, 3, 2))
+    _write_nrrd(path, data)
+
+    _, result = test_module.read_volume(path)
+
+    assert result.shape == (4, 3, 2)
+    assert np.array_equal(result, data)
+
+
+def test_voxel_indices(tmp_path):
+    path = tmp_path / "data.nrrd"
+    _write_nrrd(path, np.zeros((4, 3, 2)))
+    header, _ = test_module.read_nrrd(path)
+    positions = np.array([[-10, 0, 0], [29.9, 29.9, 49.9], [30, 0, 0], [-10.1, 0, 0]])
+
+    indices, valid = test_module.voxel_indices(header, positions)
+
+    assert indices[:2].tolist() == [[0, 0, 0], [3, 2, 1]]
+    assert valid.tolist() == [True, True, False, False]
+
+
+@pytest.mark.parametrize(
+    "region, expected",
+    [
+        ("root", {1, 2, 3, 4}),
+        ("L1", {2, 4}),
+        ("@^L", {2, 3, 4}),
+        ("@2$", {3}),
+        ("L3", set()),
+    ],
+)
+def test_region_map(region, expected):
+    region_map = test_module.RegionMap(HIERARCHY)
+
+    assert region_map.find(region) == expected
@@ -4,7 +4,6 @@ import pytest
 
 from circuit_build.context import CircuitPaths
 
-
 SELF_DIR = Path(__file__).resolve().parent
 
 
@@ -48,3 +47,27 @@ def test_circuit_paths__methods():
         paths.edges_population_connectome_path("pop", "p4") == SELF_DIR / "build/connectome/pop/p4"
     )
     assert paths.edges_population_touches_dir("pop1") == SELF_DIR / "build/connectome/pop1/touches"
+
+
+def test_circuit_paths__registered():
+    paths = CircuitPaths(SELF_DIR / "build", SELF_DIR / "bioname")
+
+    assert paths.auxiliary_path("temp_file.h5") is paths.auxiliary_path("temp_file.h5")
+    assert paths.nodes_population_file("p1") is paths.nodes_population_file("p1")
+    assert paths.registry.dirs == [
+        SELF_DIR / "build/auxiliary",
+        SELF_DIR / "build/sonata/networks/nodes/p1",
+    ]
+
+
+def test_circuit_paths__registered_with_wildcards():
+    paths = CircuitPaths(SELF_DIR / "build", SELF_DIR / "bioname")
+
+    paths.edges_population_file("{projection}")
+    paths.nodes_population_file("p1")
+    paths.auxiliary_path("{partition}.json")
+
+    assert paths.registry.dirs == [
+        SELF_DIR / "build/auxiliary",
+        SELF_DIR / "build/sonata/networks/nodes/p1",
+    ]
@@ -4,6 +4,7 @@ from unittest.mock import patch
 import pytest
 
 from circuit_build import commands as test_module
+from circuit_build.apptainer import ApptainerInstance
 from circuit_build.constants import (
     APPTAINER_EXECUTABLE,
     APPTAINER_IMAGEPATH,
@@ -11,6 +12,7 @@ from circuit_build.constants import (
     APPTAINER_MODULES,
     APPTAINER_OPTIONS,
     SPACK_MODULEPATH,
+    WORKFLOW_ENV,
 )
 
 VENV_DIR = "/path/to/venv"
@@ -334,6 +336,114 @@ def test_build_command(
     assert result == expected
 
 
+@pytest.mark.parametrize("slurm_env, escape", [(None, False), ("brainbuilder", True)])
+def test_build_command_template(tmp_path, slurm_env, escape):
+    env_config = {"brainbuilder": {"env_type": "VENV", "path": str(tmp_path)}}
+    (tmp_path / "bin").mkdir()
+    (tmp_path / "bin" / "activate").touch()
+    cluster_config = {"brainbuilder": {"salloc": "-p prod_small"}}
+    kwargs = {
+        "env_config": env_config,
+        "env_name": "brainbuilder",
+        "cluster_config": cluster_config,
+        "slurm_env": slurm_env,
+        "metrics_file": tmp_path / "metrics.jsonl",
+    }
+
+    result = test_module.build_command_template(**kwargs)
+
+    assert result.escape is escape
+    assert test_module.COMMAND_PLACEHOLDER not in result.prefix + result.suffix
+    for cmd in [["echo", "mytest"], ["echo", "'quoted'", 42]]:
+        assert result.format(cmd) == test_module.build_command(cmd=cmd, **kwargs)
+
+
+@pytest.mark.parametrize(
+    "slurm_env, expected",
+    [
+        (
+            None,
+            f"set -ex; {UNSET_CMD} && "
+            '"$CIRCUIT_BUILD_BRAINBUILDER_1_EXECUTABLE" exec --cleanenv --pwd "$(pwd)" '
+            "instance://circuit-build-brainbuilder-1 bash -c 'echo '\\''quoted'\\'''",
+        ),
+        (
+            "brainbuilder",
+            f"set -ex; {UNSET_CMD} && "
+            "salloc -J brainbuilder -p prod_small srun sh -c '"
+            '"$CIRCUIT_BUILD_BRAINBUILDER_1_EXECUTABLE" exec --containall --bind /gpfs '
+            "/images/brainbuilder.sif "
+            "bash <<EOF\ncd \"$(pwd)\" && echo '\\''quoted'\\''\nEOF\n'",
+        ),
+    ],
+)
+def test_build_command_template_with_instance(slurm_env, expected, monkeypatch):
+    monkeypatch.delenv("LOG_ALL_TO_STDERR", raising=False)
+    env_config = {"brainbuilder": {"env_type": "APPTAINER", "image": "brainbuilder.sif"}}
+    cluster_config = {"brainbuilder": {"salloc": "-p prod_small"}}
+    instance = ApptainerInstance(
+        name="circuit-build-brainbuilder-1",
+        executable="/bin/apptainer",
+        image=Path("/images/brainbuilder.sif"),
+        options="--containall --bind /gpfs",
+    )
+
+    result = test_module.build_command_template(
+        env_config=env_config,
+        env_name="brainbuilder",
+        cluster_config=cluster_config,
+        slurm_env=slurm_env,
+        instance=instance,
+    )
+
+    assert result.escape is True
+    assert result.format(["echo", "'quoted'"]) == f"( {expected} ) >{{log}} 2>&1"
+    assert "module load" not in result.prefix
+
+
+@pytest.mark.parametrize(
+    "slurm_env, expected",
+    [
+        (None, "echo mytest"),
+        ("brainbuilder", "salloc -J brainbuilder -p prod_small srun sh -c 'echo mytest'"),
+    ],
+)
+def test_build_command_template_with_workflow_env(slurm_env, expected, monkeypatch):
+    monkeypatch.delenv("LOG_ALL_TO_STDERR", raising=False)
+    cluster_config = {"brainbuilder": {"salloc": "-p prod_small"}}
+
+    result = test_module.build_command_template(
+        env_config={},
+        env_name=WORKFLOW_ENV,
+        cluster_config=cluster_config,
+        slurm_env=slurm_env,
+    )
+
+    assert (
+        result.format(["echo", "mytest"]) == f"( set -ex; {UNSET_CMD} && {expected} ) >{{log}} 2>&1"
+    )
+
+
+def test_build_env_cmd():
+    env_config = {
+        "brainbuilder": {
+            "env_type": "MODULE",
+            "modules": ["archive/2023-11", "brainbuilder/0.19.0"],
+            "env_vars": {"MYVAR": "VALUE"},
+        }
+    }
+
+    result = test_module.build_env_cmd(["echo", "mytest"], env_config, "brainbuilder")
+
+    assert result == (
+        "( . /etc/profile.d/modules.sh && module purge && "
+        "export MODULEPATH=/gpfs/bbp.cscs.ch/ssd/apps/bsd/modules/_meta && "
+        "module load archive/2023-11 brainbuilder/0.19.0 && "
+        "echo MODULEPATH=/gpfs/bbp.cscs.ch/ssd/apps/bsd/modules/_meta && module list && "
+        "export MYVAR=VALUE && echo mytest )"
+    )
+
+
 def test_build_command_raises_when_slurm_env_is_missing():
     env_name = "brainbuilder"
     slurm_env = "brainbuilder"
@@ -352,6 +462,64 @@ def test_build_command_raises_when_slurm_env_is_missing():
         )
 
 
+@pytest.mark.parametrize(
+    "salloc, expected",
+    [
+        ("-p prod -C cpu -n50", {"threads": "1", "spill": "False", "pause": None}),
+        (
+            "-p prod -C nvme -n8 --exclusive --mem 0",
+            {"threads": "5", "spill": "0.70", "pause": "0.80"},
+        ),
+        (
+            "-p prod -C cpu -n8 --exclusive --mem 0",
+            {"threads": "5", "spill": "False", "pause": "0.80"},
+        ),
+        (
+            "-p prod --constraint=nvme -n4 --mem-per-cpu 1G",
+            {"threads": "1", "spill": "False", "pause": "0.35"},
+        ),
+    ],
+)
+def test_dask_env_vars(salloc, expected):
+    result = test_module.dask_env_vars(salloc)
+
+    assert result["OMP_NUM_THREADS"] == expected["threads"]
+    assert result.get("DASK_DISTRIBUTED__WORKER__MEMORY__SPILL", "False") == expected["spill"]
+    assert result.get("DASK_DISTRIBUTED__WORKER__MEMORY__PAUSE") == expected["pause"]
+
+
+def test_with_env_vars_tunes_dask_defaults():
+    env_config = {
+        "env_vars": {
+            "DASK_DISTRIBUTED__WORKER__MEMORY__SPILL": "False",
+            "DASK_DISTRIBUTED__WORKER__MEMORY__PAUSE": "0.70",
+            "OMP_NUM_THREADS": "2",
+        }
+    }
+    cluster_config = {
+        "salloc": "-p prod -C nvme -N 1 -n 8 --exclusive --mem 0",
+        "env_vars": {"DASK_DISTRIBUTED__WORKER__MEMORY__TERMINATE": "0.90"},
+    }
+
+    result = test_module._with_env_vars("cmd", env_config, cluster_config)
+
+    # the defaults are tuned, while the custom values are kept
+    assert "DASK_DISTRIBUTED__WORKER__MEMORY__SPILL=0.70 " in result
+    assert "DASK_DISTRIBUTED__WORKER__MEMORY__PAUSE=0.70 " in result
+    assert "DASK_DISTRIBUTED__WORKER__MEMORY__TERMINATE=0.90 " in result
+    assert "OMP_NUM_THREADS=2 " in result
+    assert "MKL_NUM_THREADS=5 " in result
+
+    # without Slurm, or without Dask, the variables are not changed
+    result = test_module._with_env_vars("cmd", env_config, {})
+    assert result == (
+        "export DASK_DISTRIBUTED__WORKER__MEMORY__SPILL=False "
+        "DASK_DISTRIBUTED__WORKER__MEMORY__PAUSE=0.70 OMP_NUM_THREADS=2 && cmd"
+    )
+    result = test_module._with_env_vars("cmd", {"env_vars": {"A": "1"}}, cluster_config)
+    assert result == "export A=1 DASK_DISTRIBUTED__WORKER__MEMORY__TERMINATE=0.90 && cmd"
+
+
 @pytest.mark.parametrize(
     "custom_modules, expected",
     [
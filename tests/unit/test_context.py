@@ -18,6 +18,7 @@ from utils import (
 
 from circuit_build import context as test_module
 from circuit_build.constants import ENV_CONFIG
+from circuit_build.metrics import load_events
 from circuit_build.utils import dump_yaml, load_yaml
 
 
@@ -173,6 +174,84 @@ def test_context_in_isolated_phase(mocked_validate_morphology_release, monkeypat
     assert ctx.skip_morphology_release_validation() is True
 
 
+@patch(f"{test_module.__name__}.subprocess.run")
+def test_check_git(mocked_run, tmp_path, monkeypatch):
+    monkeypatch.delenv("ISOLATED_PHASE", raising=False)
+    monkeypatch.delenv("CIRCUIT_BUILD_SKIP_GIT_CHECK", raising=False)
+    with cwd(tmp_path):
+        ctx = _get_context(TEST_PROJ_TINY)
+        ctx.check_git(ctx.paths.bioname_dir)
+
+    assert mocked_run.call_count == 1
+    assert "md5sum" not in mocked_run.call_args.args[0]
+    with open(
+        tmp_path / "logs" / ctx.timestamp / "bioname_provenance.json", encoding="utf-8"
+    ) as fd:
+        provenance = json.load(fd)
+    assert "MANIFEST.yaml" in provenance["files"]
+    assert provenance["bioname_dir"] == str(TEST_PROJ_TINY.resolve())
+
+
+def test_log_path(tmp_path):
+    with cwd(tmp_path):
+        ctx = _get_context(TEST_PROJ_TINY)
+        path = ctx.log_path("my_rule")
+        logs_dir = tmp_path / "logs" / ctx.timestamp
+
+        assert path == str(logs_dir / "my_rule.log")
+        assert ctx.log_path("my_rule") is path
+        assert not logs_dir.exists()
+
+        ctx.paths.registry.makedirs()
+
+        assert logs_dir.is_dir()
+
+
+def test_context_metrics(tmp_path, monkeypatch):
+    monkeypatch.delenv("CIRCUIT_BUILD_SKIP_METRICS", raising=False)
+    monkeypatch.delenv("CIRCUIT_BUILD_METRICS_FILE", raising=False)
+    ctx = _get_context(TEST_PROJ_TINY)
+
+    assert ctx.metrics_file == str(ctx.paths.logs_dir / "metrics.jsonl")
+    assert "-m circuit_build.metrics" in ctx.bbp_env("brainbuilder", ["echo", "mytest"])
+
+    # the partition is recorded only by the jobs of the partitioned rules
+    ctx.PARTITION = ["p0", "p1"]
+    cmd = ctx.bbp_env("touchdetector", ["echo", "mytest"], slurm_env="touchdetector")
+    assert "job-queued --partition {wildcards.partition} {rule} {log}" in cmd
+    cmd = ctx.bbp_env("brainbuilder", ["echo", "mytest"], slurm_env="place_cells")
+    assert "job-queued {rule} {log}" in cmd
+
+    metrics_file = tmp_path / "metrics.jsonl"
+    monkeypatch.setenv("CIRCUIT_BUILD_METRICS_FILE", str(metrics_file))
+    ctx.record_build_event("build_finished", status="success")
+
+    [event] = load_events([metrics_file])
+    assert event["event"] == "build_finished"
+    assert event["build"] == ctx.timestamp
+    assert event["status"] == "success"
+
+    monkeypatch.setenv("CIRCUIT_BUILD_SKIP_METRICS", "true")
+
+    assert ctx.metrics_file is None
+    assert "-m circuit_build.metrics" not in ctx.bbp_env("brainbuilder", ["echo", "mytest"])
+
+
+def test_bbp_env_reuses_the_command_templates(monkeypatch):
+    monkeypatch.delenv("CIRCUIT_BUILD_SKIP_METRICS", raising=False)
+    ctx = _get_context(TEST_PROJ_TINY)
+
+    with patch.object(
+        test_module, "build_command_template", wraps=test_module.build_command_template
+    ) as mock:
+        first = ctx.bbp_env("brainbuilder", ["echo", "first"], slurm_env="place_cells")
+        second = ctx.bbp_env("brainbuilder", ["echo", "second"], slurm_env="place_cells")
+        ctx.bbp_env("brainbuilder", ["echo", "first"], slurm_env="node_sets")
+
+    assert mock.call_count == 2
+    assert first == second.replace("echo second", "echo first")
+
+
 @pytest.mark.parametrize("spine_morphologies_dir", [None, "", "/path/to/spine_morphologies"])
 @pytest.mark.parametrize("is_partial_config", [False, True])
 def test_write_network_config__release(tmp_path, is_partial_config, spine_morphologies_dir):
@@ -315,6 +394,75 @@ def test_write_network_config__synthesis(tmp_path, is_partial_config, spine_morp
     }
 
 
+def test_nodes_neurons_file_without_emodel(tmp_path):
+    with cwd(tmp_path):
+        ctx = _get_context(TEST_PROJ_SYNTH)
+        ctx_no_emodel = _get_context(TEST_PROJ_SYNTH, override={"common": {"no_emodel": True}})
+
+    assert ctx.nodes_neurons_file == ctx.paths.nodes_population_file(ctx.nodes_neurons_name)
+    # the synthesized nodes are used without copying them
+    assert ctx_no_emodel.nodes_neurons_file == ctx_no_emodel.paths.auxiliary_path(
+        "circuit.synthesized_morphologies.h5"
+    )
+
+
+def test_dask_cluster(tmp_path):
+    with cwd(tmp_path):
+        ctx = _get_context(TEST_PROJ_SYNTH)
+        assert ctx.DASK_CLUSTER is None
+
+        ctx = _get_context(TEST_PROJ_SYNTH, override={"common": {"dask_cluster": True}})
+
+    assert ctx.DASK_CLUSTER.scheduler_file == tmp_path / "auxiliary/dask_cluster/scheduler.json"
+    assert str(ctx.DASK_CLUSTER.log_file) == ctx.log_path("dask_cluster")
+    assert "salloc -J dask_cluster" in ctx.DASK_CLUSTER.start_cmd
+
+
+def test_morphology_staging(tmp_path):
+    with cwd(tmp_path):
+        ctx = _get_context(TEST_PROJ_TINY)
+        assert ctx.MORPH_STAGING is None
+        assert ctx.morphology_path("h5", staged=True) == ctx.MORPH_RELEASE / "h5v1"
+
+        ctx = _get_context(TEST_PROJ_TINY, override={"common": {"stage_morph_release": True}})
+        synth_ctx = _get_context(
+            TEST_PROJ_SYNTH, override={"common": {"stage_morph_release": True}}
+        )
+
+    assert synth_ctx.MORPH_STAGING is None
+    assert ctx.MORPH_STAGING.archive_file == tmp_path / "auxiliary/morphology_release.tar"
+    assert ctx.MORPH_STAGING.index_file == tmp_path / "auxiliary/morphology_release.json"
+    assert ctx.morphology_path("h5") == ctx.MORPH_RELEASE / "h5v1"
+    assert str(ctx.morphology_path("h5", staged=True)) == "$CIRCUIT_BUILD_STAGED_MORPHOLOGIES/h5v1"
+
+    cmd = ctx.run_spykfunc("spykfunc_s2f")
+    assert "CIRCUIT_BUILD_STAGED_MORPHOLOGIES=$(" in cmd
+    assert "--morphologies $CIRCUIT_BUILD_STAGED_MORPHOLOGIES/h5v1 " in cmd
+    assert "CIRCUIT_BUILD_STAGED_MORPHOLOGIES" not in ctx.run_spykfunc("spykfunc_merge")
+
+
+def test_write_network_config__synthesis_container(tmp_path):
+    with cwd(tmp_path):
+        ctx = _get_context(
+            TEST_PROJ_SYNTH, override={"synthesize_morphologies": {"container": True}}
+        )
+        filepath = tmp_path / "circuit_config.json"
+        ctx.write_network_config(connectome_dir="functional", output_file=filepath)
+
+        with open(filepath, "r", encoding="utf-8") as fd:
+            config = json.load(fd)
+
+    container = tmp_path / "morphologies" / "neocortex_neurons.h5"
+    assert ctx.SYNTHESIZE_MORPH_CONTAINER == container
+    assert ctx.morphology_path("h5") == container
+    assert ctx.morphology_path("asc") == tmp_path / "morphologies" / "neocortex_neurons"
+    [nodes] = config["networks"]["nodes"]
+    assert nodes["populations"]["neocortex_neurons"]["alternate_morphologies"] == {
+        "h5v1": "$BASE_DIR/morphologies/neocortex_neurons.h5",
+        "neurolucida-asc": "$BASE_DIR/morphologies/neocortex_neurons",
+    }
+
+
 @pytest.mark.parametrize("spine_morphologies_dir", [None, "", "/path/to/spine_morphologies"])
 def test_write_network_config__ngv_standalone(tmp_path, spine_morphologies_dir):
     circuit_dir = tmp_path / "test_write_network_config__ngv_standalone"
@@ -557,6 +705,90 @@ def test_write_network_config__ngv_full(tmp_path, spine_morphologies_dir):
     ]
 
 
+@pytest.mark.parametrize("connectome_dir", [None, "functional"])
+def test_write_network_config__extra_populations(tmp_path, connectome_dir):
+    circuit_dir = tmp_path / "test_write_network_config__extra_populations"
+    circuit_dir.mkdir()
+
+    bioname = TEST_PROJ_TINY
+    override = {
+        "extra_populations": {
+            "nodes": {
+                "thalamus_projections": {
+                    "population_type": "virtual",
+                    "nodes_file": "projections/nodes.h5",
+                },
+            },
+            "edges": {
+                "vpm__neocortex_neurons__chemical": {
+                    "population_type": "chemical",
+                    "parquet_dir": "projections/vpm.parquet",
+                },
+                "pom__neocortex_neurons__chemical": {
+                    "population_type": "chemical",
+                    "edges_file": "/path/to/pom/edges.h5",
+                },
+            },
+        }
+    }
+
+    with cwd(circuit_dir):
+        ctx = _get_context(bioname, override=override)
+
+        assert ctx.projection_edges_names == ["vpm__neocortex_neurons__chemical"]
+        assert ctx.projection_parquet_dir("vpm__neocortex_neurons__chemical") == str(
+            bioname / "projections/vpm.parquet"
+        )
+        assert ctx.projection_edges_files == [
+            circuit_dir / "sonata/networks/edges/vpm__neocortex_neurons__chemical/edges.h5"
+        ]
+
+        filepath = circuit_dir / "circuit_config.json"
+        ctx.write_network_config(connectome_dir=connectome_dir, output_file=filepath)
+
+        with open(filepath, "r", encoding="utf-8") as fd:
+            config = json.load(fd)
+
+    nodes = config["networks"]["nodes"]
+    edges = config["networks"]["edges"]
+    if connectome_dir is None:
+        assert len(nodes) == 1
+        assert edges == []
+        return
+
+    assert len(nodes) == 2
+    assert nodes[1] == {
+        "nodes_file": str(bioname / "projections/nodes.h5"),
+        "populations": {
+            "thalamus_projections": {
+                "type": "virtual",
+                "provenance": {"bioname_dir": f"{bioname}"},
+            }
+        },
+    }
+    assert len(edges) == 3
+    assert edges[1:] == [
+        {
+            "edges_file": "$BASE_DIR/sonata/networks/edges/vpm__neocortex_neurons__chemical/edges.h5",
+            "populations": {
+                "vpm__neocortex_neurons__chemical": {
+                    "type": "chemical",
+                    "provenance": {"bioname_dir": f"{bioname}"},
+                }
+            },
+        },
+        {
+            "edges_file": "/path/to/pom/edges.h5",
+            "populations": {
+                "pom__neocortex_neurons__chemical": {
+                    "type": "chemical",
+                    "provenance": {"bioname_dir": f"{bioname}"},
+                }
+            },
+        },
+    ]
+
+
 def test_provenance():
     context = _get_context(TEST_PROJ_TINY)
     assert context.provenance() == {"provenance": {"bioname_dir": context.paths.bioname_dir}}
@@ -570,7 +802,7 @@ def test_run_spykfunc_s2s():
     assert (
         "dplace functionalizer  "
         "--work-dir {params.output_dir}/.fz --output-dir {params.output_dir} "
-        "--s2s --output-order post "
+        "{params.spark_properties} --s2s --output-order post "
         "--from {input.neurons} neocortex_neurons --to {input.neurons} neocortex_neurons "
         f"--recipe {context.BUILDER_RECIPE} "
         f"--morphologies {context.MORPH_RELEASE}/h5v1 "
@@ -613,7 +845,7 @@ def test_run_spykfunc_s2f():
     assert (
         "dplace functionalizer  "
         "--work-dir {params.output_dir}/.fz --output-dir {params.output_dir} "
-        "--s2f --output-order post "
+        "{params.spark_properties} --s2f --output-order post "
         "--from {input.neurons} neocortex_neurons --to {input.neurons} neocortex_neurons "
         f"--recipe {context.BUILDER_RECIPE} "
         f"--morphologies {context.MORPH_RELEASE}/h5v1 "
@@ -621,6 +853,131 @@ def test_run_spykfunc_s2f():
     ) in cmd
 
 
+@pytest.mark.parametrize("chunk_size, expected", [(None, None), (1000, "mecombo_emodel.h5")])
+def test_mecombo_index_file(chunk_size, expected):
+    override = {"provide_me_info": {"chunk_size": chunk_size}} if chunk_size else None
+    context = _get_context(TEST_PROJ_TINY, override=override)
+
+    if expected:
+        assert context.MECOMBO_INDEX_FILE == context.paths.auxiliary_path(expected)
+    else:
+        assert context.MECOMBO_INDEX_FILE is None
+
+
+def test_run_node_sets():
+    context = _get_context(TEST_PROJ_TINY)
+
+    cmd = context.run_node_sets()
+
+    assert f"--targets {TEST_PROJ_TINY}/targets.yaml " in cmd
+    assert f"--atlas {context.ATLAS} --atlas-cache .atlas " in cmd
+    assert "circuit_build.node_sets" not in cmd
+
+
+def test_run_node_sets_with_atlas_based_targets(tmp_path):
+    targets_file = tmp_path / "targets.yaml"
+    shutil.copyfile(TEST_PROJ_TINY / "targets.yaml", targets_file)
+    with edit_yaml(targets_file) as targets:
+        targets["targets"]["atlas_based"] = {"cylinder": "{[mask]mc2}"}
+    context = _get_context(TEST_PROJ_TINY, override={"node_sets": {"targets": str(targets_file)}})
+
+    cmd = context.run_node_sets()
+
+    query_targets = context.paths.auxiliary_path("targets.query_based.yaml")
+    salloc, helpers = cmd.split(" srun sh -c ")
+    # the helpers are executed in the allocation, but outside the environment of brainbuilder
+    assert "module load" not in salloc
+    split, brainbuilder, add = re.fullmatch(
+        r"'.*?(.*?) && (\(.*\)) && (.*)' \) .*", helpers
+    ).groups()
+    assert split.endswith(
+        f"-m circuit_build.node_sets split-targets {targets_file} {query_targets}"
+    )
+    assert "module load archive/2023-11 brainbuilder/0.19.0" in brainbuilder
+    assert f"--targets {query_targets} " in brainbuilder
+    assert "--atlas-cache" not in brainbuilder
+    assert add.endswith(
+        f"-m circuit_build.node_sets add-atlas-based "
+        f"--digests-file {context.paths.logs_dir / 'digests.json'} --atlas {context.ATLAS} "
+        f"--cache-dir .atlas/node_sets --population {context.nodes_neurons_name} "
+        f"{targets_file} {{input}} {{output}}"
+    )
+
+
+@pytest.mark.parametrize(
+    "checkpoints, expected_option",
+    [(None, ""), ("resume", ""), ("overwrite", " --overwrite")],
+)
+def test_run_spykfunc_s2f_checkpoints(checkpoints, expected_option):
+    override = {"spykfunc_s2f": {"checkpoints": checkpoints}} if checkpoints else None
+    context = _get_context(TEST_PROJ_TINY, override=override)
+
+    cmd = context.run_spykfunc("spykfunc_s2f")
+
+    assert (
+        f"-m circuit_build.functionalizer prepare{expected_option} {{params.output_dir}}/.fz" in cmd
+    )
+    assert cmd.endswith("-m circuit_build.functionalizer clean {params.output_dir}/.fz")
+
+
+@pytest.mark.parametrize(
+    "override, expected",
+    [
+        (
+            None,
+            "",
+        ),
+        (
+            {"auto_tune": True},
+            "--spark-property spark.sql.shuffle.partitions=480 "
+            "--spark-property spark.executor.cores=5 "
+            "--spark-property spark.executor.memory=39g",
+        ),
+        (
+            {
+                "auto_tune": True,
+                "spark_property": ["spark.executor.memory=20g", "spark.driver.memory=10g"],
+            },
+            "--spark-property spark.sql.shuffle.partitions=480 "
+            "--spark-property spark.executor.cores=5 "
+            "--spark-property spark.executor.memory=20g "
+            "--spark-property spark.driver.memory=10g",
+        ),
+        (
+            {"spark_property": ["spark.executor.memory=20g"]},
+            "--spark-property spark.executor.memory=20g",
+        ),
+    ],
+)
+def test_spark_properties(tmp_path, override, expected):
+    touches_dir = tmp_path / "touches"
+    touches_dir.mkdir()
+    for i in range(2):
+        with open(touches_dir / f"part-{i}.parquet", "wb") as f:
+            f.truncate(30 * 1024**3)
+    override = {"spykfunc_s2f": override} if override else None
+    context = _get_context(TEST_PROJ_TINY, override=override)
+
+    # the allocation for spykfunc_s2f in the cluster config is a single exclusive node
+    result = context.spark_properties("spykfunc_s2f", [touches_dir])
+
+    assert result == expected
+
+
+def test_spark_properties_from_statistics(tmp_path):
+    touches_dir = tmp_path / "touches"
+    touches_dir.mkdir()
+    statistics_file = tmp_path / "statistics.json"
+    statistics_file.write_text(
+        json.dumps({"footers": True, "uncompressed_size": 120 * 1024**3}), encoding="utf-8"
+    )
+    context = _get_context(TEST_PROJ_TINY, override={"spykfunc_s2f": {"auto_tune": True}})
+
+    result = context.spark_properties("spykfunc_s2f", [touches_dir], [statistics_file])
+
+    assert "--spark-property spark.sql.shuffle.partitions=960 " in result
+
+
 def test_run_spykfunc_s2f_with_custom_filters():
     filters = expected_filters = [
         "BoutonDistance",
@@ -797,7 +1154,7 @@ def test_run_spykfunc_merge():
     assert (
         "dplace functionalizer  "
         "--work-dir {params.output_dir}/.fz --output-dir {params.output_dir} "
-        "--merge -- {params.parquet_dirs}"
+        "{params.spark_properties} --merge -- {params.parquet_dirs}"
     ) in cmd
 
 
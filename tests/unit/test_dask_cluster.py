@@ -0,0 +1,123 @@
+import json
+import os
+import signal
+
+import pytest
+
+from circuit_build import dask_cluster as test_module
+from circuit_build.constants import ENV_CONFIG
+
+CLUSTER_CONFIG = {"dask_cluster": {"salloc": "-n 4 --time 1:00:00"}}
+
+
+def _fake_cluster_cmd(scheduler_file):
+    """Return a command writing the scheduler file and waiting like a running cluster."""
+    content = json.dumps({"address": "tcp://127.0.0.1:8786"})
+    return f"echo '{content}' > {scheduler_file} && exec sleep 60"
+
+
+@pytest.fixture(autouse=True)
+def fast_polling(monkeypatch):
+    monkeypatch.setattr(test_module, "POLL_INTERVAL", 0.05)
+
+
+def test_from_config(tmp_path):
+    log_file = tmp_path / "dask_cluster.log"
+
+    cluster = test_module.DaskCluster.from_config(
+        tmp_path / "cluster", log_file, ENV_CONFIG, CLUSTER_CONFIG
+    )
+
+    assert cluster.scheduler_file == tmp_path / "cluster" / "scheduler.json"
+    assert "salloc -J dask_cluster -n 4 --time 1:00:00" in cluster.start_cmd
+    assert f"dask scheduler --scheduler-file {cluster.scheduler_file}" in cluster.start_cmd
+    assert f">{log_file} 2>&1" in cluster.start_cmd
+    assert "{log}" not in cluster.start_cmd
+
+
+@pytest.mark.parametrize(
+    "salloc, expected",
+    [
+        ("-n 4 --time 1:00:00", "--nworkers 1 --nthreads 1"),
+        ("-N 2 -n 16 --exclusive --mem 0", "--nworkers 1 --nthreads 5 --memory-limit 48.00GB"),
+    ],
+)
+def test_worker_cmd(salloc, expected):
+    result = test_module.worker_cmd("scheduler.json", salloc)
+
+    assert result.endswith(f"dask worker --scheduler-file scheduler.json {expected}")
+
+
+def test_with_dask_cluster(tmp_path):
+    cluster = test_module.DaskCluster.from_config(
+        tmp_path, tmp_path / "dask_cluster.log", ENV_CONFIG, CLUSTER_CONFIG
+    )
+
+    result = test_module.with_dask_cluster(cluster, "mycmd")
+
+    assert result.startswith("DASK_SCHEDULER_ADDRESS=$(")
+    assert "-m circuit_build.dask_cluster start" in result
+    assert f"export PARALLEL_DASK_SCHEDULER_PATH={cluster.scheduler_file}" in result
+    assert result.endswith("&& ( mycmd )")
+    assert test_module.with_dask_cluster(None, "mycmd") == "mycmd"
+
+
+def test_dask_slurm_env(tmp_path):
+    cluster = test_module.DaskCluster.from_config(
+        tmp_path, tmp_path / "dask_cluster.log", ENV_CONFIG, CLUSTER_CONFIG
+    )
+    cluster_with_client = test_module.DaskCluster.from_config(
+        tmp_path,
+        tmp_path / "dask_cluster.log",
+        ENV_CONFIG,
+        {**CLUSTER_CONFIG, "dask_client": {"salloc": "-n 1 --time 1:00:00"}},
+    )
+
+    # the client attaching to the cluster doesn't use the allocation of the rule
+    assert test_module.dask_slurm_env(None, "adapt_emodels") == "adapt_emodels"
+    assert test_module.dask_slurm_env(cluster, "adapt_emodels") is None
+    assert test_module.dask_slurm_env(cluster_with_client, "adapt_emodels") == "dask_client"
+
+
+def test_start_and_stop_cluster(tmp_path):
+    scheduler_file = tmp_path / "scheduler.json"
+    pid_file = tmp_path / "cluster.pid"
+
+    address = test_module.start_cluster(
+        _fake_cluster_cmd(scheduler_file), scheduler_file, pid_file, timeout=10
+    )
+    pid = int(pid_file.read_text(encoding="utf-8"))
+
+    assert address == "tcp://127.0.0.1:8786"
+    assert test_module._pid_alive(pid)
+
+    # the running cluster is reused
+    address = test_module.start_cluster("exit 1", scheduler_file, pid_file, timeout=10)
+
+    assert address == "tcp://127.0.0.1:8786"
+    assert int(pid_file.read_text(encoding="utf-8")) == pid
+
+    test_module.stop_cluster(scheduler_file, pid_file)
+
+    assert not pid_file.exists()
+    assert not scheduler_file.exists()
+    # the process has been started by this test, so it must be reaped
+    _, status = os.waitpid(pid, 0)
+    assert os.WTERMSIG(status) == signal.SIGTERM
+
+
+def test_start_cluster_failure(tmp_path):
+    scheduler_file = tmp_path / "scheduler.json"
+    pid_file = tmp_path / "cluster.pid"
+
+    with pytest.raises(RuntimeError, match="exited before starting the scheduler"):
+        test_module.start_cluster("exit 1", scheduler_file, pid_file, timeout=10)
+
+
+def test_start_cluster_timeout(tmp_path):
+    scheduler_file = tmp_path / "scheduler.json"
+    pid_file = tmp_path / "cluster.pid"
+
+    with pytest.raises(RuntimeError, match="didn't start"):
+        test_module.start_cluster("exec sleep 60", scheduler_file, pid_file, timeout=0.2)
+    test_module.stop_cluster(scheduler_file, pid_file)
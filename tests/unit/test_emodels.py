@@ -0,0 +1,215 @@
+import h5py
+import libsonata
+import numpy as np
+import pytest
+from click.testing import CliRunner
+from utils import TEST_PROJ_TINY
+
+from circuit_build import emodels as test_module
+
+MORPHDB = TEST_PROJ_TINY / "extNeuronDB.dat"
+MECOMBO_INFO = TEST_PROJ_TINY / "entities/emodels/mecombo_emodel.tsv"
+CELLS = [
+    ("C290500B-I3", "3", "L23_MC", "bNAC"),
+    ("sm101020a1-6_INT_idA", "3", "L23_MC", "bAC"),
+    ("rat_20150119_LH1_cell2", "5", "L5_TPC:A", "cADpyr"),
+]
+
+
+def _write_nodes(path, cells, population="neurons"):
+    with h5py.File(path, "w") as h5:
+        root = h5.create_group(f"nodes/{population}")
+        root["node_type_id"] = np.full(len(cells), -1)
+        group = root.create_group("0")
+        for i, name in enumerate(["morphology", "layer", "mtype", "etype"]):
+            values = [cell[i] for cell in cells]
+            if name == "mtype":
+                # enumeration, as written by voxcell
+                library, codes = np.unique(values, return_inverse=True)
+                group.create_dataset(
+                    f"@library/{name}", data=library.tolist(), dtype=h5py.string_dtype()
+                )
+                group[name] = codes.astype(np.uint32)
+            else:
+                group.create_dataset(name, data=values, dtype=h5py.string_dtype())
+
+
+def _population(path, population="neurons"):
+    return libsonata.NodeStorage(str(path)).open_population(population)
+
+
+def _attribute(pop, name):
+    return pop.get_attribute(name, pop.select_all()).tolist()
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 10])
+def test_assign_emodels(tmp_path, chunk_size):
+    nodes_file = tmp_path / "nodes.h5"
+    output = tmp_path / "circuit.h5"
+    _write_nodes(nodes_file, CELLS * 2)
+
+    test_module.assign_emodels(nodes_file, MORPHDB, output, chunk_size=chunk_size)
+
+    assert (
+        _attribute(_population(output), "me_combo")
+        == [
+            "bNAC_396608557_L23_MC_3_C290500B-I3",
+            "bAC_327962063_L23_MC_2_sm101020a1-6_INT_idA",
+            "L5_cADpyr_468120757_L5_TPC:A_5_rat_20150119_LH1_cell2",
+        ]
+        * 2
+    )
+
+
+def test_assign_emodels_random_choice_independent_of_chunk_size(tmp_path):
+    morphdb = tmp_path / "extNeuronDB.dat"
+    morphdb.write_text("m1 3 L23_MC bNAC combo_a\nm1 3 L23_MC bNAC combo_b\n", encoding="utf-8")
+    nodes_file = tmp_path / "nodes.h5"
+    _write_nodes(nodes_file, [("m1", "3", "L23_MC", "bNAC")] * 100)
+    results = []
+    for chunk_size in [7, 100]:
+        output = tmp_path / f"circuit_{chunk_size}.h5"
+        test_module.assign_emodels(nodes_file, morphdb, output, seed=42, chunk_size=chunk_size)
+        results.append(_attribute(_population(output), "me_combo"))
+
+    assert results[0] == results[1]
+    assert set(results[0]) == {"combo_a", "combo_b"}
+
+
+def test_assign_emodels_missing(tmp_path):
+    nodes_file = tmp_path / "nodes.h5"
+    _write_nodes(nodes_file, [*CELLS, ("unknown", "3", "L23_MC", "bNAC")])
+
+    with pytest.raises(ValueError, match="Could not pick emodel for 1 cell"):
+        test_module.assign_emodels(nodes_file, MORPHDB, tmp_path / "circuit.h5")
+
+
+def test_provide_me_info(tmp_path):
+    nodes_file = tmp_path / "nodes.h5"
+    circuit_file = tmp_path / "circuit.h5"
+    output = tmp_path / "output.h5"
+    _write_nodes(nodes_file, CELLS)
+    test_module.assign_emodels(nodes_file, MORPHDB, circuit_file)
+
+    test_module.provide_me_info(circuit_file, output, mecombo_info=MECOMBO_INFO, chunk_size=2)
+
+    pop = _population(output)
+    assert _attribute(pop, "model_type") == ["biophysical"] * 3
+    assert _attribute(pop, "model_template") == [
+        "hoc:bNAC_396608557",
+        "hoc:bAC_327962063",
+        "hoc:L5_cADpyr",
+    ]
+    assert pop.get_dynamics_attribute("threshold_current", pop.select_all()) == pytest.approx(
+        [0.221877800558527] * 3
+    )
+    assert pop.get_dynamics_attribute("holding_current", pop.select_all()) == pytest.approx(
+        [-0.0890753044575833] * 3
+    )
+    assert _attribute(pop, "me_combo") == _attribute(_population(circuit_file), "me_combo")
+
+
+def test_mecombo_index(tmp_path):
+    index_file = tmp_path / "mecombo_emodel.h5"
+
+    test_module.write_mecombo_index(MECOMBO_INFO, index_file)
+
+    with h5py.File(index_file, "r") as h5:
+        index = test_module.MEComboIndex(h5)
+        rows = index.find(["L5_cADpyr_468120757_L5_TPC:A_5_rat_20150119_LH1_cell2", "unknown"] * 2)
+        assert rows.tolist() == [2, -1, 2, -1]
+        assert index.take("model_template", [2, 0]).tolist() == [0, 2]
+        assert h5["@library/model_template"].asstr()[:].tolist() == [
+            "hoc:L5_cADpyr",
+            "hoc:bAC_327962063",
+            "hoc:bNAC_396608557",
+        ]
+
+
+def test_mecombo_index_hash_collisions(tmp_path, monkeypatch):
+    monkeypatch.setattr(
+        test_module, "combo_hash", lambda names: np.zeros(len(names), dtype=np.uint64)
+    )
+    index_file = tmp_path / "mecombo_emodel.h5"
+    test_module.write_mecombo_index(MECOMBO_INFO, index_file)
+
+    with h5py.File(index_file, "r") as h5:
+        rows = test_module.MEComboIndex(h5).find(
+            [
+                "L5_cADpyr_468120757_L5_TPC:A_5_rat_20150119_LH1_cell2",
+                "unknown",
+                "bNAC_396608557_L23_MC_3_C290500B-I3",
+            ]
+        )
+
+    assert rows.tolist() == [2, -1, 0]
+
+
+def test_provide_me_info_from_index(tmp_path):
+    nodes_file = tmp_path / "nodes.h5"
+    circuit_file = tmp_path / "circuit.h5"
+    index_file = tmp_path / "mecombo_emodel.h5"
+    output = tmp_path / "output.h5"
+    _write_nodes(nodes_file, CELLS)
+    test_module.assign_emodels(nodes_file, MORPHDB, circuit_file)
+    test_module.write_mecombo_index(MECOMBO_INFO, index_file)
+
+    test_module.provide_me_info(circuit_file, output, mecombo_info=index_file)
+
+    assert _attribute(_population(output), "model_template") == [
+        "hoc:bNAC_396608557",
+        "hoc:bAC_327962063",
+        "hoc:L5_cADpyr",
+    ]
+
+
+def test_provide_me_info_missing_combo(tmp_path):
+    mecombo_info = tmp_path / "mecombo_emodel.tsv"
+    mecombo_info.write_text(MECOMBO_INFO.read_text(encoding="utf-8").rsplit("\n", 2)[0] + "\n")
+    nodes_file = tmp_path / "nodes.h5"
+    circuit_file = tmp_path / "circuit.h5"
+    _write_nodes(nodes_file, CELLS)
+    test_module.assign_emodels(nodes_file, MORPHDB, circuit_file)
+
+    with pytest.raises(ValueError, match="are missing from the e-model release"):
+        test_module.provide_me_info(circuit_file, tmp_path / "output.h5", mecombo_info=mecombo_info)
+
+
+def test_cli(tmp_path):
+    nodes_file = tmp_path / "nodes.h5"
+    circuit_file = tmp_path / "circuit.h5"
+    index_file = tmp_path / "mecombo_emodel.h5"
+    output = tmp_path / "output.h5"
+    _write_nodes(nodes_file, CELLS)
+    runner = CliRunner()
+
+    result = runner.invoke(
+        test_module.main,
+        [
+            "assign-emodels",
+            "--morphdb",
+            str(MORPHDB),
+            "--chunk-size",
+            "2",
+            "-o",
+            str(circuit_file),
+            str(nodes_file),
+        ],
+        catch_exceptions=False,
+    )
+    assert result.exit_code == 0
+
+    result = runner.invoke(
+        test_module.main,
+        [
+            "provide-me-info",
+            "--mecombo-info",
+            str(MECOMBO_INFO),
+            "-o",
+            str(output),
+            str(circuit_file),
+        ],
+        catch_exceptions=False,
+    )
+    assert result.exit_code == 0
+    assert _attribute(_population(output), "model_type") == ["biophysical"] * 3
@@ -0,0 +1,266 @@
+import json
+import shutil
+
+import h5py
+import numpy as np
+import pytest
+from click.testing import CliRunner
+from utils import TEST_PROJ_SYNTH, TEST_PROJ_TINY, cwd, edit_yaml
+
+from circuit_build import estimate as test_module
+from circuit_build.cli import estimate
+from circuit_build.context import Context
+from circuit_build.metrics import append_event
+from circuit_build.utils import load_yaml
+
+
+def _get_context(bioname):
+    return Context(
+        config={"bioname": str(bioname), "cluster_config": str(bioname / "cluster.yaml")}
+    )
+
+
+def test_count_cells():
+    atlas_dir = TEST_PROJ_TINY / "entities" / "atlas"
+    composition = load_yaml(TEST_PROJ_TINY / "cell_composition.yaml")
+
+    result = test_module.count_cells(
+        atlas_dir, composition, region="mc2_Column", mask="[mask]mc2", density_factor=0.1
+    )
+    assert result == 312
+
+    result = test_module.count_cells(atlas_dir, composition, region="mc2_Column")
+    assert result == 3117
+
+
+def test_load_scaling_models(tmp_path):
+    models_file = tmp_path / "models.yaml"
+    models_file.write_text(
+        "version: 1\nmodels:\n  place_cells:\n    runtime: {base: 10}\n", encoding="utf-8"
+    )
+
+    result = test_module.load_scaling_models(models_file)
+
+    assert result["place_cells"] == {"runtime": {"base": 10}}
+    assert "touchdetector" in result
+
+
+def test_estimate_with_partitions():
+    ctx = _get_context(TEST_PROJ_SYNTH)
+    models = test_module.load_scaling_models()
+
+    rows = test_module.estimate(ctx, 2_000_000, models, target="structural")
+    rows = {row["rule"]: row for row in rows}
+
+    assert "synthesize_morphologies" in rows
+    assert "spykfunc_s2s" in rows
+    assert "spykfunc_s2f" not in rows
+    assert rows["spykfunc_merge"]["jobs"] == 1
+    assert rows["touchdetector"]["jobs"] == len(ctx.PARTITION) == 2
+    assert rows["touchdetector"]["cells"] == 1_000_000
+    assert rows["place_cells"]["runtime"] == 60 + 300 * 2
+    assert rows["place_cells"]["output_size"] == 1.5e8 * 2
+    assert rows["spykfunc_s2s"]["cores"] == 160
+
+
+@pytest.mark.parametrize(
+    "model, row, expected",
+    [
+        (
+            {"tasks": 1},
+            {"runtime": 100, "memory": 4.2},
+            "-A ${{SALLOC_ACCOUNT}} -p prod -n1 --mem 9G --time 0:10:00",
+        ),
+        (
+            {"tasks": 4, "cpus_per_task": 2},
+            {"runtime": 4000, "memory": 8},
+            "-A ${{SALLOC_ACCOUNT}} -p prod -n4 -c2 --mem-per-cpu 2048M --time 2:15:00",
+        ),
+        (
+            {"nodes": 2, "salloc": "-C nvme"},
+            {"runtime": 1000, "memory": None},
+            "-A ${{SALLOC_ACCOUNT}} -p prod -N2 --exclusive --mem 0 -C nvme --time 0:35:00",
+        ),
+    ],
+)
+def test_suggest_salloc(model, row, expected):
+    assert test_module.suggest_salloc(model, row) == expected
+
+
+def test_estimate_cli(tmp_path):
+    output = tmp_path / "cluster.yaml"
+    runner = CliRunner()
+
+    with cwd(tmp_path):
+        result = runner.invoke(
+            estimate,
+            [
+                "--bioname",
+                str(TEST_PROJ_TINY),
+                "-u",
+                str(TEST_PROJ_TINY / "cluster.yaml"),
+                "-o",
+                str(output),
+            ],
+            catch_exceptions=False,
+        )
+
+    assert result.exit_code == 0
+    assert "Estimated number of cells: 312" in result.output
+    assert result.output.splitlines()[-2].startswith("total")
+    cluster_config = load_yaml(output)
+    assert cluster_config["touchdetector"]["jobname"] == "td"
+    assert cluster_config["place_cells"]["salloc"].startswith("-A ${{SALLOC_ACCOUNT}} -p prod -n1")
+
+
+def test_estimate_cli_with_remote_atlas(tmp_path):
+    bioname = shutil.copytree(TEST_PROJ_TINY, tmp_path / "bioname")
+    with edit_yaml(bioname / "MANIFEST.yaml") as manifest:
+        manifest["common"]["atlas"] = "http://voxels.example.com/api/analytics/atlas/releases/ID"
+    runner = CliRunner()
+    args = ["--bioname", str(bioname), "-u", str(bioname / "cluster.yaml")]
+
+    with cwd(tmp_path):
+        result = runner.invoke(estimate, args)
+        assert result.exit_code == 1
+        assert "use --cells to continue" in result.output
+
+        result = runner.invoke(estimate, [*args, "--cells", "1000000"])
+        assert result.exit_code == 0
+        assert "Estimated number of cells: 1000000" in result.output
+
+
+def _build_circuit(
+    circuit_dir, cells, runtimes, rule="place_cells", output_size=100, partitions=None
+):
+    """Write the nodes, the circuit config and the metrics of a circuit built with the runtimes."""
+    nodes_file = circuit_dir / "sonata/networks/nodes/neurons/nodes.h5"
+    nodes_file.parent.mkdir(parents=True)
+    with h5py.File(nodes_file, "w") as h5:
+        h5["nodes/neurons/node_type_id"] = np.full(cells, -1)
+        h5["nodes/astrocytes/node_type_id"] = np.full(7, -1)
+    config = {
+        "version": 2,
+        "manifest": {"$BASE_DIR": "."},
+        "networks": {
+            "nodes": [
+                {
+                    "nodes_file": "$BASE_DIR/networks/nodes/neurons/nodes.h5",
+                    "populations": {
+                        "neurons": {"type": "biophysical"},
+                        "astrocytes": {"type": "astrocyte"},
+                    },
+                }
+            ],
+            "edges": [],
+        },
+    }
+    (circuit_dir / "sonata/circuit_config.json").write_text(json.dumps(config), encoding="utf-8")
+    metrics_file = circuit_dir / "logs/metrics.jsonl"
+    for i, runtime in enumerate(runtimes):
+        log = f"logs/2024010{i}T000000/{rule}_{i}.log"
+        common = {"build": f"2024010{i}T000000", "rule": rule, "log": log}
+        queued = {"partition": partitions[i]} if partitions else {}
+        append_event(metrics_file, {"event": "job_queued", "time": 0, **queued, **common})
+        append_event(
+            metrics_file,
+            {
+                "event": "job_finished",
+                "time": runtime,
+                "started": 0,
+                "exit_status": 0,
+                "outputs": {"out": output_size},
+                **common,
+            },
+        )
+    append_event(
+        metrics_file,
+        {"event": "job_finished", "time": 1, "exit_status": 1, "build": "x", "rule": rule},
+    )
+    return circuit_dir
+
+
+def test_calibration_samples(tmp_path):
+    circuit_dir = _build_circuit(tmp_path, 2_000_000, [100, 120])
+
+    result = test_module.calibration_samples(circuit_dir)
+
+    assert list(result) == ["place_cells"]
+    assert [(cells, job["runtime"]) for cells, job in result["place_cells"]] == [
+        (2_000_000, 100),
+        (2_000_000, 120),
+    ]
+
+
+def test_calibration_samples_partitions(tmp_path):
+    circuit_dir = _build_circuit(tmp_path, 2_000_000, [100, 120], rule="parquet_to_sonata")
+    # the rules executed once for each partition process a subset of the cells
+    _build_circuit(tmp_path / "partitioned", 2_000_000, [100, 120], partitions=["p0", "p1"])
+
+    result = test_module.calibration_samples(circuit_dir)
+    partitioned = test_module.calibration_samples(tmp_path / "partitioned")
+
+    assert [cells for cells, _ in result["parquet_to_sonata"]] == [2_000_000, 2_000_000]
+    assert [cells for cells, _ in partitioned["place_cells"]] == [1_000_000, 1_000_000]
+
+
+@pytest.mark.parametrize(
+    "term, points, expected",
+    [
+        # the base and the coefficient are fitted
+        ({"base": 10}, [(1e6, 20), (2e6, 30), (3e6, 40)], {"base": 10, "coefficient": 10}),
+        # only the coefficient is fitted, keeping the base and the exponent
+        (
+            {"base": 10, "exponent": 2},
+            [(2e6, 50), (2e6, 50)],
+            {"base": 10, "coefficient": 10, "exponent": 2},
+        ),
+        # the values are constrained to be non-negative
+        ({"base": 100}, [(1e6, 20), (2e6, 10)], {"base": 15, "coefficient": 0}),
+        ({}, [(1e6, 10), (2e6, 30)], {"base": 0, "coefficient": 14}),
+    ],
+)
+def test_fit_term(term, points, expected):
+    result = test_module.fit_term(term, points)
+
+    assert result == pytest.approx(expected)
+
+
+def test_estimate_cli_with_calibration(tmp_path):
+    circuits = [
+        _build_circuit(tmp_path / "small", 1000, [100]),
+        _build_circuit(tmp_path / "large", 3000, [300, 300]),
+    ]
+    models_file = tmp_path / "models.yaml"
+    runner = CliRunner()
+    args = ["--bioname", str(TEST_PROJ_TINY), "-u", str(TEST_PROJ_TINY / "cluster.yaml")]
+
+    with cwd(tmp_path):
+        result = runner.invoke(estimate, [*args, "--calibrated-models", str(models_file)])
+        assert result.exit_code == 2
+        assert "--calibrated-models requires --calibrate" in result.output
+
+        result = runner.invoke(
+            estimate,
+            [
+                *args,
+                *[f"--calibrate={path}" for path in circuits],
+                "--calibrated-models",
+                str(models_file),
+            ],
+            catch_exceptions=False,
+        )
+
+    assert result.exit_code == 0
+    assert "Scaling models calibrated with 2 circuit(s)" in result.output
+    models = test_module.load_scaling_models(models_file)
+    assert models["place_cells"]["runtime"] == pytest.approx({"base": 0, "coefficient": 1e5})
+    assert models["place_cells"]["output_size"] == pytest.approx(
+        {"base": 100, "coefficient": 0}, abs=1e-6
+    )
+    assert (
+        models["place_cells"]["memory"]
+        == test_module.load_scaling_models()["place_cells"]["memory"]
+    )
+    # 312 cells in the tiny circuit
+    assert "place_cells" in result.output and "0:00:31" in result.output
@@ -0,0 +1,158 @@
+import os
+import subprocess
+
+import pytest
+from click.testing import CliRunner
+
+from circuit_build import functionalizer as test_module
+
+
+def _stale_dirs(work_dir):
+    return sorted(work_dir.parent.glob(f"{work_dir.name}.stale.*"))
+
+
+def test_prepare_work_dir(tmp_path):
+    work_dir = tmp_path / ".fz"
+    input_file = tmp_path / "nodes.h5"
+    input_file.write_text("nodes", encoding="utf-8")
+    args = ["--s2f", "--from", str(input_file), "neurons"]
+
+    assert test_module.prepare_work_dir(work_dir, args) is False
+    assert (work_dir / test_module.FINGERPRINT_FILE).is_file()
+
+    # resume with the same arguments and input files
+    (work_dir / "_checkpoints" / "filtered_touches.ptable").mkdir(parents=True)
+    assert test_module.list_checkpoints(work_dir) == ["filtered_touches.ptable"]
+    assert test_module.prepare_work_dir(work_dir, args) is True
+    assert test_module.list_checkpoints(work_dir) == ["filtered_touches.ptable"]
+    assert _stale_dirs(work_dir) == []
+
+    # the input file changed
+    os.utime(input_file, (0, 0))
+    assert test_module.prepare_work_dir(work_dir, args) is False
+    assert test_module.list_checkpoints(work_dir) == []
+    [stale_dir] = _stale_dirs(work_dir)
+    assert test_module.list_checkpoints(stale_dir) == ["filtered_touches.ptable"]
+
+    # overwrite requested
+    assert test_module.prepare_work_dir(work_dir, args, overwrite=True) is False
+    assert len(_stale_dirs(work_dir)) == 2
+
+    test_module.clean_work_dir(work_dir)
+
+    assert not work_dir.exists()
+    assert _stale_dirs(work_dir) == []
+
+
+def test_prepare_resumes_with_the_same_args(tmp_path):
+    work_dir = tmp_path / "output" / ".fz"
+    output_dir = tmp_path / "output"
+    nodes = tmp_path / "nodes.h5"
+    nodes.write_text("nodes", encoding="utf-8")
+    morphologies_dir = tmp_path / "morphologies"
+    morphologies_dir.mkdir()
+    touches_dir = tmp_path / "touches"
+    touches_dir.mkdir()
+    (touches_dir / "_SUCCESS").touch()
+    touches = touches_dir / "touches.0.parquet"
+    touches.write_text("touches", encoding="utf-8")
+    # the arguments as split by the shell
+    args = [
+        "--work-dir",
+        str(work_dir),
+        "--output-dir",
+        str(output_dir),
+        "--spark-property",
+        "spark.executor.cores=5",
+        "--s2f",
+        "--from",
+        str(nodes),
+        "neurons",
+        "--morphologies",
+        str(morphologies_dir),
+        "--",
+        str(touches),
+        str(touches_dir),
+    ]
+    runner = CliRunner()
+
+    result = runner.invoke(test_module.main, ["prepare", str(work_dir), "--", *args])
+    assert result.exit_code == 0, result.output
+
+    # functionalizer writes the checkpoints and the output, modifying the dirs
+    (work_dir / "_checkpoints" / "filtered_touches.ptable").mkdir(parents=True)
+    (output_dir / "circuit.parquet").mkdir()
+    (morphologies_dir / "morph.h5").touch()
+    os.utime(output_dir, (0, 0))
+    os.utime(work_dir, (0, 0))
+
+    result = runner.invoke(test_module.main, ["prepare", str(work_dir), "--", *args])
+    assert result.exit_code == 0, result.output
+
+    assert test_module.list_checkpoints(work_dir) == ["filtered_touches.ptable"]
+    assert _stale_dirs(work_dir) == []
+
+    # the touches are written again
+    os.utime(touches_dir / "_SUCCESS", (0, 0))
+    result = runner.invoke(test_module.main, ["prepare", str(work_dir), "--", *args])
+    assert result.exit_code == 0, result.output
+
+    assert test_module.list_checkpoints(work_dir) == []
+    assert len(_stale_dirs(work_dir)) == 1
+
+
+@pytest.mark.parametrize("exit_code", [0, 3])
+def test_build_checkpoints_cmd(tmp_path, exit_code):
+    work_dir = tmp_path / ".fz"
+    args = ["--work-dir", str(work_dir), "--s2f", "--", str(tmp_path / "*.parquet")]
+    cmd = test_module.build_checkpoints_cmd(
+        f"test -f {work_dir}/{test_module.FINGERPRINT_FILE}; exit {exit_code}", work_dir, args
+    )
+
+    result = subprocess.run(["bash", "-c", f"set -euo pipefail; {cmd}"], check=False)
+
+    assert result.returncode == exit_code
+    # the work dir is kept for the next run only in case of failure
+    assert work_dir.exists() == bool(exit_code)
+
+
+def test_compute_fingerprint_ignores_spark_properties():
+    args = ["--work-dir", "/path/.fz", "--s2f"]
+    props = ["--spark-property", "spark.executor.cores=5"]
+
+    result = test_module.compute_fingerprint(args[:2] + props + args[2:])
+
+    assert result == test_module.compute_fingerprint(args)
+
+
+@pytest.mark.parametrize(
+    "data_size, nodes, expected_partitions",
+    [
+        (0, 1, 120),
+        (500 * 1024**3, 4, 4000),
+        (501 * 1024**3, 4, 4160),
+    ],
+)
+def test_tune_spark_properties(data_size, nodes, expected_partitions):
+    result = test_module.tune_spark_properties(
+        data_size, nodes=nodes, cores_per_node=40, memory_per_node=384
+    )
+
+    assert result == {
+        "spark.sql.shuffle.partitions": str(expected_partitions),
+        "spark.executor.cores": "5",
+        "spark.executor.memory": "39g",
+    }
+
+
+def test_merge_spark_properties():
+    result = test_module.merge_spark_properties(
+        {"spark.executor.cores": "5", "spark.executor.memory": "39g"},
+        ["spark.executor.memory=20g", "spark.driver.memory=10g"],
+    )
+
+    assert result == [
+        "spark.executor.cores=5",
+        "spark.executor.memory=20g",
+        "spark.driver.memory=10g",
+    ]
@@ -0,0 +1,115 @@
+import gzip
+import io
+import subprocess
+import sys
+
+import pytest
+
+from circuit_build import log_sink as test_module
+from circuit_build.utils import redirect_to_file
+
+
+def _lines(n, prefix="line"):
+    return [f"{prefix} {i:04d}\n".encode() for i in range(n)]
+
+
+def _read_segments(paths):
+    if not paths:
+        return b""
+    if paths[0].suffix == ".zst":
+        zstandard = pytest.importorskip("zstandard")
+        dctx = zstandard.ZstdDecompressor()
+        return b"".join(dctx.stream_reader(p.read_bytes()).read() for p in paths)
+    return b"".join(gzip.decompress(p.read_bytes()) for p in paths)
+
+
+def test_log_sink_small_output(tmp_path):
+    log_file = tmp_path / "rule.log"
+    lines = _lines(10)
+
+    with test_module.LogSink(log_file, max_size=1000, segment_size=1000) as sink:
+        for line in lines:
+            sink.write(line)
+
+    assert log_file.read_bytes() == b"".join(lines)
+    assert sink.truncated == 0
+    assert sink.segment_paths == []
+
+
+@pytest.mark.parametrize("compression", ["zstd", "gzip"])
+def test_log_sink_large_output(tmp_path, compression):
+    if compression == "zstd":
+        pytest.importorskip("zstandard")
+    log_file = tmp_path / "rule.log"
+    lines = _lines(1000)  # 10 bytes each
+
+    with test_module.LogSink(
+        log_file, max_size=200, segment_size=3000, compression=compression
+    ) as sink:
+        for line in lines:
+            sink.write(line)
+
+    content = log_file.read_bytes()
+    assert content.startswith(b"".join(lines[:10]))
+    assert content.endswith(b"".join(lines[-10:]))
+    assert b"9800 bytes truncated" in content
+    assert sink.truncated == 9800
+    assert len(sink.segment_paths) == 4
+    assert _read_segments(sink.segment_paths) == b"".join(lines)
+
+
+def test_log_sink_summary_and_tee(tmp_path):
+    summary = io.BytesIO()
+    lines = [b"starting\n", b"progress: 50%\n", b"ERROR: failure\n", b"done\n"]
+
+    with test_module.LogSink(
+        tmp_path / "rule.log", max_size=1000, segment_size=1000, summary=summary
+    ) as sink:
+        for line in lines:
+            sink.write(line)
+
+    assert summary.getvalue() == b"progress: 50%\nERROR: failure\n"
+
+    tee = io.BytesIO()
+    with test_module.LogSink(
+        tmp_path / "rule.log", max_size=1000, segment_size=1000, summary=summary, tee=tee
+    ) as sink:
+        for line in lines:
+            sink.write(line)
+
+    assert tee.getvalue() == b"".join(lines)
+
+
+def test_build_log_sink_cmd():
+    result = test_module.build_log_sink_cmd("{log}", {"max_size": 10, "summary": False}, tee=True)
+
+    assert result == (
+        f"{sys.executable} -m circuit_build.log_sink --max-size 10 --segment-size 512 "
+        "--compression zstd --no-summary --tee {log}"
+    )
+
+
+@pytest.mark.parametrize("exit_code", [0, 3])
+def test_redirect_to_file_with_log_config(tmp_path, monkeypatch, exit_code):
+    monkeypatch.delenv("LOG_ALL_TO_STDERR", raising=False)
+    log_file = tmp_path / "rule.log"
+    cmd = redirect_to_file(
+        f"echo 'some output'; echo 'Error!'; exit {exit_code}",
+        filename=str(log_file),
+        log_config={"max_size": 1},
+    )
+
+    result = subprocess.run(["bash", "-c", cmd], capture_output=True, check=False, encoding="utf-8")
+
+    assert result.returncode == exit_code
+    assert result.stderr == "Error!\n"
+    assert "some output\n" in log_file.read_text(encoding="utf-8")
+
+
+def test_redirect_to_file_with_empty_log_config(monkeypatch):
+    monkeypatch.delenv("LOG_ALL_TO_STDERR", raising=False)
+
+    # the log sink is used with the default options when the log configuration is defined but empty
+    cmd = redirect_to_file("echo 'some output'", filename="{log}", log_config={})
+
+    assert cmd.endswith(f"| {test_module.build_log_sink_cmd('{log}', {})}")
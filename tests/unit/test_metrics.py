@@ -0,0 +1,194 @@
+import json
+import subprocess
+from types import SimpleNamespace
+
+import pytest
+from click.testing import CliRunner
+
+from circuit_build import metrics as test_module
+from circuit_build.cli import stats
+
+
+def _job_events(build, rule, queued, started, finished, exit_status=0, size=100):
+    log = f"/circuit/logs/{build}/{rule}.log"
+    return [
+        {"event": "job_queued", "build": build, "rule": rule, "log": log, "time": queued},
+        {
+            "event": "job_finished",
+            "build": build,
+            "rule": rule,
+            "log": log,
+            "time": finished,
+            "started": started,
+            "exit_status": exit_status,
+            "outputs": {"out": size},
+        },
+    ]
+
+
+def test_append_and_load_events(tmp_path):
+    metrics_file = tmp_path / "logs" / "metrics.jsonl"
+
+    test_module.append_event(metrics_file, {"event": "build_started", "time": 1.0})
+    with metrics_file.open("a", encoding="utf-8") as fd:
+        fd.write('{"event": "incomplete')
+    result = test_module.load_events([metrics_file])
+
+    assert result == [{"time": 1.0, "event": "build_started"}]
+
+
+def test_output_sizes(tmp_path):
+    (tmp_path / "file.h5").write_bytes(b"x" * 10)
+    (tmp_path / "dir").mkdir()
+    (tmp_path / "dir" / "part-0.parquet").write_bytes(b"x" * 5)
+    (tmp_path / "dir" / "part-1.parquet").write_bytes(b"x" * 7)
+
+    paths = [tmp_path / "file.h5", tmp_path / "dir", tmp_path / "none"]
+
+    result = test_module.output_sizes(paths)
+    assert result == {str(tmp_path / "file.h5"): 10, str(tmp_path / "dir"): None}
+
+    result = test_module.output_sizes(paths, recursive=True)
+    assert result == {str(tmp_path / "file.h5"): 10, str(tmp_path / "dir"): 12}
+
+
+def test_combine_job_events_with_unknown_size():
+    events = _job_events("b1", "spatial_index_synapse", 0, 10, 110)
+    events[-1]["outputs"] = {"out": 100, "dir": None}
+
+    (job,) = test_module.combine_job_events(events)
+
+    assert job["output_size"] is None
+
+
+@pytest.mark.parametrize("exit_code", [0, 3])
+def test_build_metrics_cmd(tmp_path, exit_code):
+    metrics_file = tmp_path / "metrics.jsonl"
+    log_file = tmp_path / "20240101T000000" / "rule.log"
+    log_file.parent.mkdir()
+    output_file = tmp_path / "output.txt"
+    cmd = test_module.build_started_marker_cmd(f"echo 'some output' > {{output}}; exit {exit_code}")
+    cmd = test_module.build_metrics_cmd(f"( {cmd} ) >{{log}} 2>&1", metrics_file)
+    # format the placeholders as done by Snakemake
+    cmd = cmd.format(rule="myrule", log=log_file, output=output_file)
+
+    result = subprocess.run(["bash", "-c", f"set -euo pipefail; {cmd}"], check=False)
+
+    assert result.returncode == exit_code
+    assert not log_file.with_name("rule.log.started").exists()
+    queued, finished = test_module.load_events([metrics_file])
+    assert queued["event"] == "job_queued"
+    assert queued["build"] == finished["build"] == "20240101T000000"
+    assert queued["rule"] == finished["rule"] == "myrule"
+    assert finished["event"] == "job_finished"
+    assert finished["exit_status"] == exit_code
+    assert finished["outputs"] == {str(output_file): 12}
+    assert queued["time"] <= finished["started"] <= finished["time"]
+
+
+def test_build_metrics_cmd_with_partition(tmp_path):
+    metrics_file = tmp_path / "metrics.jsonl"
+    log_file = tmp_path / "20240101T000000" / "touchdetector_p0.log"
+    log_file.parent.mkdir()
+    cmd = test_module.build_metrics_cmd("true", metrics_file, partition="{wildcards.partition}")
+    # format the placeholders as done by Snakemake
+    cmd = cmd.format(
+        rule="touchdetector", log=log_file, output="", wildcards=SimpleNamespace(partition="p0")
+    )
+
+    result = subprocess.run(["bash", "-c", f"set -euo pipefail; {cmd}"], check=False)
+
+    assert result.returncode == 0
+    [job] = test_module.combine_job_events(test_module.load_events([metrics_file]))
+    assert job["rule"] == "touchdetector"
+    assert job["partition"] == "p0"
+
+
+def test_combine_and_summarize_jobs():
+    events = [
+        {"event": "build_started", "build": "b1", "time": 0},
+        *_job_events("b1", "place_cells", 0, 10, 110),
+        *_job_events("b1", "touchdetector", 110, 120, 130, exit_status=1),
+        *_job_events("b2", "place_cells", 0, 20, 220, size=200),
+        {"event": "job_queued", "build": "b2", "rule": "touchdetector", "log": "x", "time": 220},
+    ]
+
+    jobs = test_module.combine_job_events(events)
+
+    assert len(jobs) == 4
+    assert jobs[0]["allocation_wait"] == 10
+    assert jobs[0]["runtime"] == 100
+    assert jobs[-1]["exit_status"] is None
+    assert jobs[-1]["runtime"] is None
+
+    result = test_module.summarize_jobs(jobs)
+
+    assert result == [
+        {
+            "rule": "place_cells",
+            "jobs": 2,
+            "failed": 0,
+            "runtime_mean": 150,
+            "runtime_max": 200,
+            "allocation_wait_mean": 15,
+            "output_size_last": 200,
+            "builds": 2,
+            "trend": 2.0,
+        },
+        {
+            "rule": "touchdetector",
+            "jobs": 2,
+            "failed": 1,
+            "runtime_mean": None,
+            "runtime_max": None,
+            "allocation_wait_mean": 10,
+            "output_size_last": None,
+            "builds": 2,
+            "trend": None,
+        },
+    ]
+
+    result = test_module.summarize_jobs(jobs, by_build=True)
+
+    assert [(row["build"], row["rule"], row["runtime_mean"]) for row in result] == [
+        ("b1", "place_cells", 100),
+        ("b1", "touchdetector", None),
+        ("b2", "place_cells", 200),
+        ("b2", "touchdetector", None),
+    ]
+
+
+def test_stats(tmp_path):
+    metrics_file = tmp_path / "logs" / "metrics.jsonl"
+    for event in _job_events("b1", "place_cells", 0, 10, 110, size=3 * 1024**2):
+        test_module.append_event(metrics_file, event)
+    runner = CliRunner()
+
+    result = runner.invoke(stats, ["-d", str(tmp_path)], catch_exceptions=False)
+
+    assert result.exit_code == 0
+    header, row = result.output.splitlines()
+    assert header.split() == [
+        "rule",
+        "jobs",
+        "failed",
+        "runtime_mean",
+        "runtime_max",
+        "allocation_wait_mean",
+        "output_size_last",
+        "builds",
+        "trend",
+    ]
+    assert row.split() == ["place_cells", "1", "0", "100.0s", "100.0s", "10.0s", "3.0MB", "1", "-"]
+
+    result = runner.invoke(
+        stats, ["--metrics-file", str(metrics_file), "--rule", "other", "--json"]
+    )
+
+    assert result.exit_code == 0
+    assert json.loads(result.output) == []
+
+    result = runner.invoke(stats, ["-d", str(tmp_path / "logs")])
+
+    assert result.exit_code == 1
+    assert "Metrics file not found" in result.output
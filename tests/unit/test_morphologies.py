@@ -0,0 +1,87 @@
+import h5py
+import numpy as np
+import pytest
+from click.testing import CliRunner
+
+from circuit_build import morphologies as test_module
+
+NAMES = ["hashed/aa/morph_a", "hashed/aa/morph_b", "hashed/bb/morph_c"]
+
+
+def _write_morphology(path, value):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with h5py.File(path, "w") as h5:
+        h5.attrs["value"] = value
+        h5["points"] = np.full((2, 4), value, dtype=np.float32)
+        h5["structure"] = np.zeros((1, 3), dtype=np.int32)
+        h5.create_group("metadata").attrs["version"] = np.array([1, 3], dtype=np.uint32)
+
+
+def _write_nodes(path, names):
+    with h5py.File(path, "w") as h5:
+        group = h5.create_group("nodes/default/0")
+        h5["nodes/default/node_type_id"] = np.full(len(names) + 1, -1)
+        group["@library/morphology"] = np.array(names, dtype=h5py.string_dtype())
+        group["morphology"] = np.array([2, 0, 1, 0])
+
+
+@pytest.fixture(name="morph_dir")
+def fixture_morph_dir(tmp_path):
+    morph_dir = tmp_path / "morphologies"
+    for i, name in enumerate(NAMES):
+        _write_morphology(morph_dir / f"{name}.h5", i)
+    # not assigned to any cell
+    _write_morphology(morph_dir / "hashed/cc/morph_d.h5", 99)
+    _write_nodes(tmp_path / "nodes.h5", NAMES[::-1])
+    return morph_dir
+
+
+def _check_container(path):
+    with h5py.File(path, "r") as h5:
+        assert "hashed/cc/morph_d" not in h5
+        for i, name in enumerate(NAMES):
+            assert h5[name].attrs["value"] == i
+            assert np.all(h5[name]["points"][:] == i)
+            assert h5[name]["metadata"].attrs["version"].tolist() == [1, 3]
+
+
+def test_morphology_names(tmp_path):
+    path = tmp_path / "nodes.h5"
+    _write_nodes(path, NAMES[::-1])
+
+    assert test_module.morphology_names(path) == NAMES
+
+
+def test_merge_morphologies(tmp_path, morph_dir):
+    output = tmp_path / "container.h5"
+
+    test_module.merge_morphologies(tmp_path / "nodes.h5", morph_dir, output)
+
+    _check_container(output)
+    assert not test_module.shard_path(output, 0).exists()
+
+
+def test_merge_morphologies_sharded(tmp_path, morph_dir, monkeypatch):
+    output = tmp_path / "container.h5"
+
+    test_module.merge_morphologies(tmp_path / "nodes.h5", morph_dir, output, shards=2)
+
+    assert test_module.shard_path(output, 0) == tmp_path / "container.000.h5"
+    with h5py.File(test_module.shard_path(output, 1), "r") as h5:
+        assert "hashed/bb/morph_c" in h5
+        assert "hashed/aa/morph_a" not in h5
+    # the external links are resolved relatively to the container
+    monkeypatch.chdir(morph_dir)
+    _check_container(output)
+
+
+def test_merge_cmd(tmp_path, morph_dir):
+    output = tmp_path / "container.h5"
+
+    result = CliRunner().invoke(
+        test_module.main,
+        ["merge", "--morph-dir", str(morph_dir), "-o", str(output), str(tmp_path / "nodes.h5")],
+    )
+
+    assert result.exit_code == 0, result.output
+    _check_container(output)
@@ -0,0 +1,145 @@
+import json
+import subprocess
+from pathlib import Path
+
+import pytest
+
+from circuit_build import morphology_staging as test_module
+
+
+def _make_release(path):
+    for subdir, ext in [("ascii", "asc"), ("h5v1", "h5")]:
+        (path / subdir).mkdir(parents=True)
+        for i in range(3):
+            (path / subdir / f"morph_{i}.{ext}").write_text(f"{subdir} {i}", encoding="utf-8")
+    (path / "annotations.json").write_text("{}", encoding="utf-8")
+    return path
+
+
+@pytest.fixture
+def staging(tmp_path):
+    release_dir = _make_release(tmp_path / "release")
+    staging = test_module.MorphologyStaging.from_release(
+        release_dir, lambda path: tmp_path / "auxiliary" / path
+    )
+    staging.archive_file.parent.mkdir()
+    test_module.pack_release(staging.release_dir, staging.archive_file, staging.index_file)
+    return staging
+
+
+def test_pack_release(staging):
+    index = json.loads(staging.index_file.read_text(encoding="utf-8"))
+
+    assert index["release_dir"] == str(staging.release_dir)
+    assert index["subdirs"] == ["ascii", "h5v1"]
+    assert len(index["files"]) == 6
+    with staging.archive_file.open("rb") as fd:
+        for name, offset, size in index["files"]:
+            fd.seek(offset)
+            assert fd.read(size) == (staging.release_dir / name).read_bytes()
+
+
+def test_pack_release_raises_without_morphologies(tmp_path):
+    with pytest.raises(ValueError, match="No morphology directory found"):
+        test_module.pack_release(tmp_path, tmp_path / "archive.tar", tmp_path / "index.json")
+
+
+def test_write_staged_config(tmp_path):
+    release_dir = tmp_path / "release"
+    circuit_config = tmp_path / "circuit" / "auxiliary" / "circuit_config_hpc.json"
+    circuit_config.parent.mkdir(parents=True)
+    config = {
+        "version": 2,
+        "manifest": {"$BASE_DIR": "."},
+        "networks": {
+            "nodes": [
+                {
+                    "nodes_file": "$BASE_DIR/nodes.h5",
+                    "populations": {
+                        "neurons": {
+                            "alternate_morphologies": {
+                                "h5v1": str(release_dir / "h5v1"),
+                                "neurolucida-asc": str(release_dir / "ascii"),
+                            },
+                            "spatial_segment_index_dir": str(tmp_path / "index"),
+                        }
+                    },
+                }
+            ],
+            "edges": [],
+        },
+    }
+    circuit_config.write_text(json.dumps(config), encoding="utf-8")
+    output_file = tmp_path / "circuit_config.staged.json"
+
+    with output_file.open("w", encoding="utf-8") as out:
+        test_module.write_staged_config(circuit_config, release_dir, out, tmp_path / "local")
+
+    result = json.loads(output_file.read_text(encoding="utf-8"))
+    assert result["manifest"] == {"$BASE_DIR": str(circuit_config.parent)}
+    node = result["networks"]["nodes"][0]
+    assert node["nodes_file"] == "$BASE_DIR/nodes.h5"
+    assert node["populations"]["neurons"] == {
+        "alternate_morphologies": {
+            "h5v1": str(tmp_path / "local" / "h5v1"),
+            "neurolucida-asc": str(tmp_path / "local" / "ascii"),
+        },
+        "spatial_segment_index_dir": str(tmp_path / "index"),
+    }
+
+
+def _run_staged(staging, cmd, circuit_config=None):
+    cmd = test_module.with_staged_release(staging, cmd, circuit_config=circuit_config)
+    # the braces are doubled for Snakemake
+    cmd = " ".join(map(str, cmd)).format()
+    return subprocess.run(["sh", "-c", cmd], capture_output=True, text=True, check=False)
+
+
+def test_stage_cmd(staging, tmp_path, monkeypatch):
+    monkeypatch.setenv("TMPDIR", str(tmp_path / "node"))
+    circuit_config = tmp_path / "circuit_config.json"
+    circuit_config.write_text(
+        json.dumps({"morphologies_dir": str(staging.release_dir / "ascii")}), encoding="utf-8"
+    )
+    with staging.config_template_file.open("w", encoding="utf-8") as out:
+        test_module.write_staged_config(circuit_config, staging.release_dir, out)
+
+    result = _run_staged(
+        staging,
+        ["cat", test_module.MorphologyStaging.staged_path("circuit_config.json")],
+        circuit_config=staging.config_template_file,
+    )
+
+    assert result.returncode == 0, result.stderr
+    morphologies_dir = Path(json.loads(result.stdout)["morphologies_dir"])
+    local_dir = morphologies_dir.parent
+    assert morphologies_dir.name == "ascii"
+    assert local_dir.parent == tmp_path / "node" / "circuit-build-morphologies"
+    assert (local_dir / "ascii" / "morph_0.asc").is_file()
+    assert (local_dir / "h5v1" / "morph_2.h5").read_text(encoding="utf-8") == "h5v1 2"
+    assert not (local_dir / "annotations.json").exists()
+
+    # the local copy is reused
+    (local_dir / "h5v1" / "morph_2.h5").unlink()
+    result = _run_staged(staging, ["echo", test_module.MorphologyStaging.staged_path()])
+    assert result.returncode == 0, result.stderr
+    assert result.stdout.strip() == str(local_dir)
+    assert not (local_dir / "h5v1" / "morph_2.h5").exists()
+
+
+def test_stage_cmd_fails_with_corrupted_archive(staging, tmp_path, monkeypatch):
+    monkeypatch.setenv("TMPDIR", str(tmp_path / "node"))
+    staging.archive_file.write_bytes(staging.archive_file.read_bytes()[:1000])
+
+    result = _run_staged(staging, ["echo", "executed"])
+
+    assert result.returncode != 0
+    assert "executed" not in result.stdout
+    # the incomplete copy isn't kept
+    staging_dir = tmp_path / "node" / "circuit-build-morphologies"
+    assert all(p.suffix == ".lock" for p in staging_dir.iterdir())
+
+
+def test_with_staged_release_without_staging():
+    assert test_module.with_staged_release(None, ["echo"]) == ["echo"]
+    assert test_module.staged_inputs(None) == {}
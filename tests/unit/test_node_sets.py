@@ -0,0 +1,146 @@
+import json
+from pathlib import Path
+from unittest.mock import patch
+
+import h5py
+import numpy as np
+import pytest
+from click.testing import CliRunner
+from utils import TEST_PROJ_TINY
+
+from circuit_build import node_sets as test_module
+from circuit_build.atlas import read_volume
+from circuit_build.utils import dump_yaml, load_yaml
+
+ATLAS_DIR = TEST_PROJ_TINY / "entities/atlas"
+MASK = "{[mask]mc2}"
+
+
+def _positions(mask_name=MASK):
+    """Return the positions of one voxel inside the mask and of one voxel outside the mask."""
+    header, data = read_volume(ATLAS_DIR / f"{mask_name.strip('{}')}.nrrd")
+    origin = np.array([float(v) for v in header["space origin"].strip("()").split(",")])
+    inside = np.argwhere(data != 0)[0]
+    outside = np.argwhere(data == 0)[0]
+    return origin + (np.array([inside, outside]) + 0.5) * 5.0
+
+
+def _write_nodes(path, population, positions):
+    with h5py.File(path, "w") as h5:
+        group = h5.create_group(f"nodes/{population}")
+        group["node_type_id"] = np.full(len(positions), -1)
+        group["node_group_id"] = np.zeros(len(positions), dtype=np.uint32)
+        group["node_group_index"] = np.arange(len(positions), dtype=np.uint64)
+        for i, axis in enumerate("xyz"):
+            group[f"0/{axis}"] = positions[:, i]
+
+
+def test_load_mask_cached(tmp_path):
+    cache_dir = tmp_path / "cache"
+
+    header, mask = test_module.load_mask(ATLAS_DIR, MASK, cache_dir)
+
+    assert len(list(cache_dir.glob("*.npz"))) == 1
+    with patch.object(test_module, "compile_mask", side_effect=AssertionError("not cached")):
+        cached_header, cached_mask = test_module.load_mask(ATLAS_DIR, MASK, cache_dir)
+    assert cached_header == header
+    assert np.array_equal(cached_mask, mask)
+
+
+def test_mask_digest_depends_on_definition():
+    digest = test_module.mask_digest(ATLAS_DIR, MASK)
+
+    assert digest == test_module.mask_digest(ATLAS_DIR, MASK)
+    assert digest != test_module.mask_digest(ATLAS_DIR, {"region": "mc2"})
+
+
+def test_compile_mask_from_region():
+    _, brain_regions = read_volume(ATLAS_DIR / "brain_regions.nrrd")
+
+    _, mask = test_module.compile_mask(ATLAS_DIR, {"region": "@.*"})
+
+    assert mask.shape == brain_regions.shape
+    assert np.count_nonzero(mask) == np.count_nonzero(brain_regions)
+
+
+def test_resolve_atlas_node_sets(tmp_path):
+    positions = _positions()
+
+    result = test_module.resolve_atlas_node_sets(
+        {"cylinder": MASK}, ATLAS_DIR, positions, "neurons", tmp_path, allow_empty=False
+    )
+
+    assert result == {"cylinder": {"population": "neurons", "node_id": [0]}}
+
+
+def test_resolve_atlas_node_sets_outside_atlas(tmp_path):
+    positions = np.vstack([_positions(), [[1e6, 1e6, 1e6]]])
+
+    # the positions outside the atlas aren't dropped silently, as done by voxcell
+    with pytest.raises(ValueError, match="1 positions are outside the atlas"):
+        test_module.resolve_atlas_node_sets(
+            {"cylinder": MASK}, ATLAS_DIR, positions, "neurons", tmp_path, allow_empty=False
+        )
+
+
+def test_resolve_atlas_node_sets_empty(tmp_path):
+    positions = _positions()[1:]
+
+    with pytest.raises(ValueError, match="Empty atlas based node set: cylinder"):
+        test_module.resolve_atlas_node_sets(
+            {"cylinder": MASK}, ATLAS_DIR, positions, "neurons", tmp_path, allow_empty=False
+        )
+    result = test_module.resolve_atlas_node_sets(
+        {"cylinder": MASK}, ATLAS_DIR, positions, "neurons", tmp_path, allow_empty=True
+    )
+    assert result == {"cylinder": {"population": "neurons", "node_id": []}}
+
+
+def test_cli(tmp_path):
+    targets_file = tmp_path / "targets.yaml"
+    query_targets_file = tmp_path / "targets.query_based.yaml"
+    nodes_file = tmp_path / "nodes.h5"
+    node_sets_file = tmp_path / "node_sets.json"
+    digests_file = tmp_path / "logs" / "digests.json"
+    dump_yaml(
+        targets_file,
+        {"targets": {"query_based": {"L1": {"layer": 1}}, "atlas_based": {"cylinder": MASK}}},
+    )
+    _write_nodes(nodes_file, "neurons", _positions())
+    node_sets_file.write_text(json.dumps({"L1": {"layer": 1}}), encoding="utf-8")
+    runner = CliRunner()
+
+    result = runner.invoke(
+        test_module.main,
+        ["split-targets", str(targets_file), str(query_targets_file)],
+        catch_exceptions=False,
+    )
+    assert result.exit_code == 0
+    assert load_yaml(query_targets_file) == {"targets": {"query_based": {"L1": {"layer": 1}}}}
+
+    result = runner.invoke(
+        test_module.main,
+        [
+            "add-atlas-based",
+            "--atlas",
+            str(ATLAS_DIR),
+            "--cache-dir",
+            str(tmp_path / "cache"),
+            "--population",
+            "neurons",
+            "--digests-file",
+            str(digests_file),
+            str(targets_file),
+            str(nodes_file),
+            str(node_sets_file),
+        ],
+        catch_exceptions=False,
+    )
+    assert result.exit_code == 0
+    assert json.loads(node_sets_file.read_text(encoding="utf-8")) == {
+        "L1": {"layer": 1},
+        "cylinder": {"population": "neurons", "node_id": [0]},
+    }
+    # the digests of the atlas files are cached with the digests of the bioname files
+    digests = json.loads(digests_file.read_text(encoding="utf-8"))["files"]
+    assert str(Path(ATLAS_DIR, "[mask]mc2.nrrd").resolve()) in digests
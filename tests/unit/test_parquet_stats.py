@@ -0,0 +1,93 @@
+import io
+import json
+
+import pytest
+
+from circuit_build import parquet_stats as test_module
+
+pa = pytest.importorskip("pyarrow")
+pq = pytest.importorskip("pyarrow.parquet")
+
+
+def _write_touches(path, pre, post, row_group_size=None):
+    table = pa.table({"pre_neuron_id": pre, "post_neuron_id": post, "distance": [1.0] * len(pre)})
+    pq.write_table(table, path, row_group_size=row_group_size)
+
+
+def test_collect_statistics(tmp_path):
+    _write_touches(tmp_path / "part-0.parquet", [0, 1, 2, 3], [5, 6, 7, 8], row_group_size=2)
+    _write_touches(tmp_path / "part-1.parquet", [4, 9], [1, 2])
+
+    result = test_module.collect_statistics(tmp_path)
+
+    assert result["footers"] is True
+    assert result["files"] == 2
+    assert result["rows"] == 6
+    assert result["row_groups"] == 3
+    assert result["rows_per_file"] == {"min": 2, "max": 4, "mean": 3}
+    assert result["rows_per_row_group"] == {"min": 2, "max": 2, "mean": 2}
+    assert result["columns"] == {
+        "pre_neuron_id": {"min": 0, "max": 9},
+        "post_neuron_id": {"min": 1, "max": 8},
+    }
+    assert result["skew"] == pytest.approx(4 / 3)
+    assert result["uncompressed_size"] > 0
+    assert [f["name"] for f in result["per_file"]] == ["part-0.parquet", "part-1.parquet"]
+
+
+def test_collect_statistics_skewed(tmp_path, caplog):
+    _write_touches(tmp_path / "part-0.parquet", list(range(100)), list(range(100)))
+    for i in range(1, 4):
+        _write_touches(tmp_path / f"part-{i}.parquet", [i], [i])
+
+    result = test_module.collect_statistics(tmp_path)
+
+    assert result["skew"] == pytest.approx(100 / 25.75)
+    assert "Skewed Parquet files" in caplog.text
+
+
+def test_collect_statistics_empty(tmp_path):
+    result = test_module.collect_statistics(tmp_path)
+
+    assert result["files"] == 0
+    assert result["rows"] == 0
+    assert result["skew"] is None
+
+
+def test_write_and_load_statistics(tmp_path):
+    parquet_dir = tmp_path / "parquet"
+    parquet_dir.mkdir()
+    _write_touches(parquet_dir / "part-0.parquet", [0, 1], [2, 3])
+    output_file = tmp_path / "statistics.json"
+
+    with open(output_file, "w", encoding="utf-8") as out:
+        test_module.write_statistics(parquet_dir, out)
+
+    result = test_module.load_statistics(output_file)
+    assert result["rows"] == 2
+    assert test_module.load_statistics(tmp_path / "missing.json") is None
+    assert test_module.input_data_size([parquet_dir], [output_file]) == result["uncompressed_size"]
+
+
+def test_input_data_size_without_statistics(tmp_path):
+    (tmp_path / "part-0.parquet").write_bytes(b"x" * 10)
+    statistics_file = tmp_path / "statistics.json"
+    statistics_file.write_text(json.dumps({"footers": False, "size": 10}), encoding="utf-8")
+
+    assert test_module.input_data_size([tmp_path]) == 10
+    assert test_module.input_data_size([tmp_path], [statistics_file]) == 10
+
+
+def test_write_statistics_without_pyarrow(tmp_path, monkeypatch):
+    monkeypatch.setattr(test_module, "pq", None)
+    (tmp_path / "part-0.parquet").write_bytes(b"x" * 10)
+    (tmp_path / "part-1.parquet").write_bytes(b"x" * 30)
+    out = io.StringIO()
+
+    test_module.write_statistics(tmp_path, out)
+
+    result = json.loads(out.getvalue())
+    assert result["footers"] is False
+    assert result["size"] == 40
+    assert result["skew"] == 1.5
+    assert "rows" not in result
@@ -0,0 +1,101 @@
+import json
+from unittest.mock import patch
+
+from circuit_build import preflight as test_module
+
+
+def _write(path, content):
+    path.write_text(content, encoding="utf-8")
+
+
+def test_file_digest(tmp_path):
+    path = tmp_path / "file.txt"
+    _write(path, "content")
+
+    result = test_module.file_digest(path)
+
+    assert result == "ed7002b439e9ac845f22357d822bac1444730fbdb6016d3ec9432297b9ec9f73"
+
+
+def test_digest_cache(tmp_path):
+    cache_file = tmp_path / "cache" / "digests.json"
+    paths = [tmp_path / f"file_{i}.txt" for i in range(3)]
+    for i, path in enumerate(paths):
+        _write(path, f"content {i}")
+
+    cache = test_module.DigestCache(cache_file)
+    expected = cache.digests(paths)
+    cache.save()
+
+    assert expected == {str(p): test_module.file_digest(p) for p in paths}
+    assert cache_file.exists()
+
+    cache = test_module.DigestCache(cache_file)
+    with patch.object(test_module, "file_digest") as mocked:
+        assert cache.digests(paths) == expected
+    assert mocked.call_count == 0
+
+    # the digest is computed again only if the size or the mtime changed
+    _write(paths[1], "modified")
+    cache = test_module.DigestCache(cache_file)
+    with patch.object(test_module, "file_digest", wraps=test_module.file_digest) as mocked:
+        result = cache.digests(paths)
+    mocked.assert_called_once_with(str(paths[1]))
+    assert result[str(paths[1])] == test_module.file_digest(paths[1])
+
+
+def test_digest_cache_invalid_file(tmp_path):
+    cache_file = tmp_path / "digests.json"
+    cache_file.write_text("{invalid", encoding="utf-8")
+    path = tmp_path / "file.txt"
+    _write(path, "content")
+
+    cache = test_module.DigestCache(cache_file)
+
+    assert cache.digest(path) == test_module.file_digest(path)
+
+
+def test_compare_digests():
+    result = test_module.compare_digests(
+        {"a": "1", "b": "2", "c": "3"},
+        {"b": "2", "c": "4", "d": "5"},
+    )
+
+    assert result == {"added": ["d"], "removed": ["a"], "changed": ["c"]}
+
+
+def test_run_preflight(tmp_path):
+    bioname_dir = tmp_path / "bioname"
+    bioname_dir.mkdir()
+    (bioname_dir / "subdir").mkdir()
+    logs_dir = tmp_path / "logs"
+    _write(bioname_dir / "MANIFEST.yaml", "manifest")
+    _write(bioname_dir / "recipe.xml", "recipe")
+
+    result = test_module.run_preflight(bioname_dir, logs_dir, "20240101T000000")
+
+    assert sorted(result["files"]) == ["MANIFEST.yaml", "recipe.xml"]
+    assert result["files"]["recipe.xml"] == {
+        "size": 6,
+        "sha256": test_module.file_digest(bioname_dir / "recipe.xml"),
+    }
+    assert result["previous_build"] is None
+    assert result["changes"] is None
+    assert (logs_dir / test_module.DIGEST_CACHE_FILE).exists()
+    with open(logs_dir / "20240101T000000" / test_module.PROVENANCE_FILE, encoding="utf-8") as fd:
+        assert json.load(fd) == result
+
+    _write(bioname_dir / "recipe.xml", "modified recipe")
+    _write(bioname_dir / "mtypes.tsv", "mtypes")
+    (bioname_dir / "MANIFEST.yaml").unlink()
+
+    result = test_module.run_preflight(bioname_dir, logs_dir, "20240102T000000")
+
+    assert result["previous_build"] == "20240101T000000"
+    assert result["changes"] == {
+        "added": ["mtypes.tsv"],
+        "removed": ["MANIFEST.yaml"],
+        "changed": ["recipe.xml"],
+    }
+    with open(logs_dir / test_module.PROVENANCE_FILE, encoding="utf-8") as fd:
+        assert json.load(fd) == result
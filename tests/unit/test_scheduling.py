@@ -0,0 +1,126 @@
+from types import SimpleNamespace
+
+import pytest
+
+from circuit_build import scheduling as test_module
+from circuit_build.metrics import append_event
+
+
+def _rule(name, input=(), output=(), norun=False, priority=0, resources=None):
+    return SimpleNamespace(
+        name=name,
+        input=list(input),
+        output=list(output),
+        norun=norun,
+        priority=priority,
+        resources=resources or {"_cores": 1},
+    )
+
+
+def _rules():
+    return [
+        _rule("nodes", output=["nodes.h5"]),
+        _rule("node_sets", input=["nodes.h5"], output=["node_sets.json"]),
+        _rule("touches", input=["nodes.h5"], output=["touches_{partition}/_SUCCESS"]),
+        _rule(
+            "synapses",
+            input=["touches_p0/_SUCCESS", "touches_p1/_SUCCESS", lambda wildcards: "ignored"],
+            output=["{connectome_dir}/edges.h5"],
+        ),
+        _rule("functional", input=["functional/edges.h5", "node_sets.json"], norun=True),
+    ]
+
+
+@pytest.mark.parametrize(
+    "first, second, expected",
+    [
+        ("a/b", "a/b", True),
+        ("a/b", "a/c", False),
+        ("a/{x}/c", "a/b/c", True),
+        ("{x}/edges.h5", "functional/edges.h5", True),
+        ("{x}/spykfunc/_SUCCESS", "{y}/spykfunc_p0/_SUCCESS", False),
+        ("{x}_p0/c", "a_{y}/c", True),
+    ],
+)
+def test_patterns_overlap(first, second, expected):
+    result = test_module.patterns_overlap(test_module._pattern(first), test_module._pattern(second))
+    assert result is expected
+
+
+def test_rule_dependencies():
+    result = test_module.rule_dependencies(_rules())
+
+    assert result == {
+        "nodes": set(),
+        "node_sets": {"nodes"},
+        "touches": {"nodes"},
+        "synapses": {"touches"},
+        "functional": {"synapses", "node_sets"},
+    }
+
+
+def test_critical_path():
+    dependencies = {"a": set(), "b": {"a"}, "c": {"a"}, "d": {"b", "c"}}
+    costs = {"a": 1, "b": 10, "c": 2, "d": 5}
+
+    result = test_module.critical_path(dependencies, costs)
+
+    assert result == {"a": 16, "b": 15, "c": 7, "d": 5}
+
+
+def test_critical_path_with_cycle():
+    result = test_module.critical_path({"a": {"b"}, "b": {"a"}}, {"a": 1, "b": 2})
+
+    assert result == {"a": 3, "b": 2}
+
+
+def test_historical_runtimes(tmp_path):
+    metrics_file = tmp_path / "metrics.jsonl"
+    for build, runtime, exit_status in [("b1", 10, 0), ("b2", 30, 0), ("b3", 20, 0), ("b4", 99, 1)]:
+        log = f"/circuit/logs/{build}/touches.log"
+        event = {"build": build, "rule": "touches", "log": log}
+        append_event(metrics_file, {**event, "event": "job_queued", "time": 0})
+        append_event(
+            metrics_file,
+            {**event, "event": "job_finished", "time": runtime, "exit_status": exit_status},
+        )
+
+    assert test_module.historical_runtimes(metrics_file) == {"touches": 20}
+    assert test_module.historical_runtimes(tmp_path / "missing.jsonl") == {}
+    assert test_module.historical_runtimes(None) == {}
+
+
+def test_prioritize_rules(tmp_path):
+    models = {
+        "touches": {"partitioned": True, "runtime": {"base": 0, "coefficient": 600}},
+        "synapses": {"runtime": {"base": 300}},
+    }
+    rules = _rules()
+    rules[1].priority = 1000
+    rules[1].resources["runtime"] = 5
+
+    result = test_module.prioritize_rules(
+        rules, metrics_file=tmp_path / "missing.jsonl", models=models, partitions=2
+    )
+
+    assert result == {
+        "nodes": 660,
+        "node_sets": 60,
+        "touches": 600,
+        "synapses": 300,
+        "functional": 0,
+    }
+    assert {rule.name: rule.priority for rule in rules} == {
+        "nodes": 660,
+        "node_sets": 1000,
+        "touches": 600,
+        "synapses": 300,
+        "functional": 0,
+    }
+    assert {rule.name: rule.resources.get("runtime") for rule in rules} == {
+        "nodes": 1,
+        "node_sets": 5,
+        "touches": 5,
+        "synapses": 5,
+        "functional": None,
+    }
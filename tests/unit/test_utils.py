@@ -0,0 +1,110 @@
+import pytest
+
+from circuit_build import utils as test_module
+
+
+def test_path_registry(tmp_path):
+    registry = test_module.PathRegistry()
+    calls = []
+
+    def compute():
+        calls.append(1)
+        return tmp_path / "a" / "file.txt"
+
+    assert registry.get("key", compute) == tmp_path / "a" / "file.txt"
+    assert registry.get("key", compute) == tmp_path / "a" / "file.txt"
+    assert len(calls) == 1
+    registry.get("other", lambda: tmp_path / "b" / "file.txt")
+    assert registry.dirs == [tmp_path / "a", tmp_path / "b"]
+    assert not (tmp_path / "a").exists()
+
+    assert registry.makedirs([tmp_path / "a"]) == [tmp_path / "a"]
+    assert registry.makedirs() == [tmp_path / "b"]
+    assert registry.makedirs() == []
+    assert (tmp_path / "a").is_dir()
+    assert (tmp_path / "b").is_dir()
+
+
+def _raise_oserror(*args):
+    raise OSError("not supported")
+
+
+def test_promote_file(tmp_path, monkeypatch):
+    source = tmp_path / "source.h5"
+    source.write_text("data", encoding="utf-8")
+    target = tmp_path / "sub" / "target.h5"
+    target.parent.mkdir()
+    target.write_text("old", encoding="utf-8")
+
+    monkeypatch.setattr(test_module, "_reflink", _raise_oserror)
+    assert test_module.promote_file(source, target) == "copy"
+    assert not target.samefile(source)
+    assert target.read_text(encoding="utf-8") == "data"
+
+    monkeypatch.setattr(test_module, "_reflink", lambda src, dst: dst.write_text("cloned"))
+    assert test_module.promote_file(source, target) == "reflink"
+    assert target.read_text(encoding="utf-8") == "cloned"
+
+
+@pytest.mark.parametrize(
+    "salloc, expected",
+    [
+        (
+            "-A ${{SALLOC_ACCOUNT}} -p prod --ntasks-per-node=1 -C nvme --exclusive --mem 0",
+            {
+                "nodes": 1,
+                "cores_per_node": 40,
+                "memory_per_node": 384,
+                "tasks_per_node": 1,
+                "cpus_per_task": 40,
+                "memory_per_task": 384,
+            },
+        ),
+        (
+            "-p prod -N 4 -c 36 --mem=100G --time 1:00:00",
+            {
+                "nodes": 4,
+                "cores_per_node": 36,
+                "memory_per_node": 100,
+                "tasks_per_node": 1,
+                "cpus_per_task": 36,
+                "memory_per_task": 100,
+            },
+        ),
+        (
+            "-p prod --nodes=2 --cpus-per-task 4 --ntasks-per-node 2 --mem 2048 --mem-per-cpu 4G",
+            {
+                "nodes": 2,
+                "cores_per_node": 8,
+                "memory_per_node": 2,
+                "tasks_per_node": 2,
+                "cpus_per_task": 4,
+                "memory_per_task": 16,
+            },
+        ),
+        (
+            "-A ${{SALLOC_ACCOUNT}} -p prod_small -C cpu -n50 --time 0:30:00",
+            {
+                "nodes": 1,
+                "cores_per_node": 40,
+                "memory_per_node": 384,
+                "tasks_per_node": 40,
+                "cpus_per_task": 1,
+                "memory_per_task": None,
+            },
+        ),
+        (
+            "-p prod -N 2 -n 16 --exclusive --mem 0",
+            {
+                "nodes": 2,
+                "cores_per_node": 40,
+                "memory_per_node": 384,
+                "tasks_per_node": 8,
+                "cpus_per_task": 5,
+                "memory_per_task": 48,
+            },
+        ),
+    ],
+)
+def test_parse_salloc(salloc, expected):
+    assert test_module.parse_salloc(salloc) == expected